@@ -4,17 +4,51 @@
 '''
  
 import argparse
+import collections
 import logging
 import datetime
+import json
 import os.path
 import os
+import queue
 import re
+import shlex
 import subprocess
 import sys
+import threading
+import time
+
+import metrics
 
 BKUP_LABEL_ROOT = '/dev/label'
 BKUP_DISK_PREFIX = 'bkup'
 DEFAULT_ENCODING = 'utf-8'
+PUMP_CHUNK_SIZE = 1024 * 1024
+DEFAULT_PUMP_BUFFER_MB = 256
+FANOUT_ON_ERROR = ['continue', 'abort']
+DEFAULT_STATE_FILE = '/var/db/fnas_backup.json'
+THROUGHPUT_HISTORY = 20
+
+# A field of a resume token as printed by zfs send -nv -t, such as
+# "toname = data/docs@20240101-0000"
+TOKEN_FIELD_RE = re.compile(r'\s+(\w+) = (.*)$')
+SNAPSHOT_TS_FORMAT = '%Y%m%d-%H%M'
+DESTROY_BATCH_SIZE = 200
+
+# Stands for the snapshot a backup would create in a --plan
+NEW_SNAPSHOT_LABEL = 'new'
+
+# Periods a retention policy counts, with the key grouping snapshot times
+# into each period
+RETENTION_PERIODS = collections.OrderedDict([
+    ('hourly', lambda t: (t.year, t.month, t.day, t.hour)),
+    ('daily', lambda t: t.date()),
+    ('weekly', lambda t: t.isocalendar()[:2]),
+    ('monthly', lambda t: (t.year, t.month)),
+    ('yearly', lambda t: t.year)])
+
+# Timings and counters of this run
+run_metrics = metrics.Metrics('fnas_backup')
 
 class BackupException(Exception):
     '''Exception thrown if an error is encuntered during backup'''
@@ -35,6 +69,12 @@ def parse_args():
     parser.add_argument('-u', action= "store_true", dest = 'unmount',
                         default = False,
                         help = 'export backup pools and geli detach')
+
+    parser.add_argument('--geli-passfile', metavar = 'FILE', dest = 'geli_passfile',
+                        default = None,
+                        help = 'With -m, read the passphrase of the backup disks from FILE '
+                               '(geli attach -j) and attach them all at once. Without it geli '
+                               'prompts for the passphrase of each disk in turn.')
     
     parser.add_argument('-d', metavar = 'ZPOOL_NAME', dest = 'dest_zpools', 
                         action = 'append',
@@ -48,16 +88,79 @@ def parse_args():
                         default = False,
                         help = 'Uses the latest snapshot rather than creating a new one')
 
+    parser.add_argument('-f', dest = 'fan_out',
+                        action = "store_true",
+                        default = False,
+                        help = 'Send each dataset once and receive the stream on every destination '
+                               'pool that needs the same stream')
+
+    parser.add_argument('--fan-out-on-error', dest = 'fan_out_on_error',
+                        choices = FANOUT_ON_ERROR,
+                        default = 'continue',
+                        help = 'When a receiver fails during a fan-out, either keep sending to the '
+                               'remaining pools or abort the stream for all of them '
+                               '(default continue)')
+
+    parser.add_argument('-b', metavar = 'MB', dest = 'buffer_mb',
+                        type = int, default = DEFAULT_PUMP_BUFFER_MB,
+                        help = 'Size of the buffers between zfs send and zfs receive, shared '
+                               'evenly by the -j transfers running at once. Each transfer only '
+                               'allocates as much of its share as it fills (default %d)' % \
+                               DEFAULT_PUMP_BUFFER_MB)
+
+    parser.add_argument('-j', metavar = 'N', dest = 'jobs',
+                        type = int, default = 1,
+                        help = 'Number of dataset transfers to run at once (default 1)')
+
+    parser.add_argument('--max-per-source', metavar = 'N', dest = 'max_per_source',
+                        type = int, default = 0,
+                        help = 'Maximum transfers reading from one source pool at once '
+                               '(default 0, limited only by -j)')
+
+    parser.add_argument('--max-per-dest', metavar = 'N', dest = 'max_per_dest',
+                        type = int, default = 0,
+                        help = 'Maximum transfers writing to one destination pool at once '
+                               '(default 0, limited only by -j)')
+
+    parser.add_argument('--state', metavar = 'FILE', dest = 'state_file',
+                        default = DEFAULT_STATE_FILE,
+                        help = 'File recording the progress of interrupted transfers '
+                               '(default %s)' % DEFAULT_STATE_FILE)
+
     parser.add_argument('-v', dest = 'verbose',
                         action = "store_true",
                         default = False,
                         help = 'Produce verbose output')
 
+    parser.add_argument('--retain', metavar = 'POLICY', dest = 'retain',
+                        type = parse_retention, default = None,
+                        help = 'After the transfers, destroy the snapshots of the source datasets '
+                               'that POLICY does not keep. POLICY is a list of PERIOD=COUNT, such '
+                               'as hourly=24,daily=7,weekly=4,monthly=12, keeping the newest '
+                               'snapshot of each of the last COUNT periods that have one. PERIOD '
+                               'is one of %s. Only snapshots named like those this script creates '
+                               'are destroyed.' % ', '.join(RETENTION_PERIODS))
+
+    parser.add_argument('--dest-retain', metavar = 'POLICY', dest = 'dest_retain',
+                        type = parse_retention, default = None,
+                        help = 'Retention policy for the copies of the datasets on the '
+                               'destination pools')
+
+    parser.add_argument('--plan', dest = 'plan',
+                        action = "store_true",
+                        default = False,
+                        help = 'Report the transfers a backup would make, their sizes and an ETA '
+                               'from the throughput of earlier runs, without creating snapshots '
+                               'or sending anything. Destination pools that are not imported '
+                               'are planned from the snapshots they held when last used')
+
     parser.add_argument('--dry-run', dest = 'dry_run',
                         action = "store_true",
                         default = False,
                         help = 'Don''t actually run commands')
     
+    metrics.add_arguments(parser)
+
     parser.add_argument('dataset', nargs='+')
 
     args = parser.parse_args()
@@ -71,11 +174,12 @@ def parse_args():
 def make_ts_str():
     '''Creates a timestamp string containing the date and time'''
     now = datetime.datetime.utcnow()
-    return now.strftime('%Y%m%d-%H%M')
+    return now.strftime(SNAPSHOT_TS_FORMAT)
 
 def make_zfs_snapshots(snapshot_names):
     cmd_list = ['zfs', 'snapshot'] + snapshot_names
-    retval = subprocess.call(cmd_list)
+    with run_metrics.phase('snapshot'):
+        retval = subprocess.call(cmd_list)
     if retval != 0:
         raise BackupException('Failed to create zfs snapshots. Error code: %d' % retval)
 
@@ -90,25 +194,6 @@ def get_backup_devs(devdir = BKUP_LABEL_ROOT, devprefix = BKUP_DISK_PREFIX):
     dev_re = re.compile('%s[0-9]+' % devprefix)
     return [dev for dev in os.listdir(BKUP_LABEL_ROOT) if dev_re.fullmatch(dev)]
         
-def get_zpools(names = None):
-    '''Retrieve a list of zpools. Optionally supply pool names to list'''
-    cmd_list = ['zpool','list','-H']
-    if names:
-        cmd_list += names
-        
-    pool_str = subprocess.check_output(cmd_list).decode(DEFAULT_ENCODING, 'ignore')
-    pool_list = []
-    for pool_data in pool_str.splitlines():
-        pool_fields = pool_data.split('\t')
-        pool_list.append(pool_fields[0])
-    return pool_list
-
-def validate_zpools(pools):
-    cmd_list = ['zpool', 'status', '-x'] + pools
-    retval = subprocess.call(cmd_list)
-    if retval != 0:
-        raise BackupException('Failed to validate zfs pools. Error code: %d' % retval)
-    
 def zpool_import(pool, logger, dry_run = False):
     '''Imports a zpool'''
     logger.info('Importing %s' % pool)
@@ -123,12 +208,84 @@ def zpool_export(pool, logger, dry_run = False):
     if retval != 0:
         raise BackupException('Failed to zfs export %s, error code %d' % (pool, retval))
     
-def existing_snapshots(dataset):
-    '''Returns a list of snapshots for the dataset in ascending order of creation'''
-    cmd_list = ['zfs', 'list', '-H', '-t', 'snapshot', '-s', 'creation', '-r', dataset]
-    snapshot_str = subprocess.check_output(cmd_list).decode(DEFAULT_ENCODING, 'ignore')
-    snapshot_list = [x.split('\t')[0] for x in snapshot_str.splitlines()]
-    return snapshot_list
+Snapshot = collections.namedtuple('Snapshot', ['name', 'guid', 'createtxg'])
+
+class SnapshotInventory(object):
+    '''Datasets and snapshots of a set of pools, each pool fetched with a
+       single zfs list. Snapshots are indexed by dataset, in ascending
+       order of creation, and by GUID within each dataset.'''
+    def __init__(self):
+        self.datasets = {}
+        self.guids = {}
+        self.resume_tokens = {}
+        self.pools = set()
+        self.lock = threading.Lock()
+
+    def load_pool(self, pool):
+        '''Fetches (or re-fetches) the datasets and snapshots of a pool'''
+        cmd_list = ['zfs', 'list', '-H', '-p', '-t', 'filesystem,volume,snapshot',
+                    '-o', 'name,guid,createtxg,receive_resume_token', '-r', pool]
+        with run_metrics.phase('zfs_list'):
+            list_str = subprocess.check_output(cmd_list).decode(DEFAULT_ENCODING, 'ignore')
+
+        with self.lock:
+            self._replace_pool(pool, list_str)
+            self.pools.add(pool)
+
+    def _replace_pool(self, pool, list_str):
+        for dataset in [d for d in self.datasets if zpool(d) == pool]:
+            del self.datasets[dataset]
+            self.guids.pop(dataset, None)
+            self.resume_tokens.pop(dataset, None)
+
+        for line in list_str.splitlines():
+            (name, guid, createtxg, token) = line.split('\t')[:4]
+            if '@' not in name:
+                self.datasets.setdefault(name, [])
+                if token != '-':
+                    self.resume_tokens[name] = token
+            else:
+                self.add(Snapshot(name, int(guid), int(createtxg)))
+
+        for dataset, snaps in self.datasets.items():
+            if zpool(dataset) == pool:
+                snaps.sort(key = lambda snap: snap.createtxg)
+
+    def add(self, snapshot):
+        '''Adds a snapshot after the existing snapshots of its dataset. Snapshots
+           that have not been created, as in a dry run, have a guid of None.'''
+        dataset = strip_snapshot(snapshot.name)
+        self.datasets.setdefault(dataset, []).append(snapshot)
+        self.guids.pop(dataset, None)
+
+    def has_dataset(self, dataset):
+        return dataset in self.datasets
+
+    def resume_token(self, dataset):
+        '''Returns the receive_resume_token left on a dataset by an interrupted
+           zfs receive -s, or None'''
+        return self.resume_tokens.get(dataset)
+
+    def snapshots(self, dataset):
+        '''Returns the snapshots of a dataset in ascending order of creation'''
+        return self.datasets.get(dataset, [])
+
+    def by_guid(self, dataset):
+        '''Returns a dict of GUID to snapshot for a dataset'''
+        if dataset not in self.guids:
+            self.guids[dataset] = dict((snap.guid, snap) for snap in self.snapshots(dataset)
+                                       if snap.guid is not None)
+        return self.guids[dataset]
+
+    def newest_common_snapshot(self, source_dataset, dest_dataset):
+        '''Returns the newest snapshot of source_dataset that dest_dataset has
+           also received, matched by GUID since received snapshots keep the
+           GUID of their source. Returns None if there is none.'''
+        source_guids = self.by_guid(source_dataset)
+        for snap in reversed(self.snapshots(dest_dataset)):
+            if snap.guid in source_guids:
+                return source_guids[snap.guid]
+        return None
 
 def strip_zpool(dataset):
     '''Removes the pool (first component) of the dataset path'''
@@ -140,31 +297,1012 @@ def strip_snapshot(dataset):
     comps = dataset.split('@')
     return comps[0]
 
+def snapshot_suffix(snapshot_name):
+    '''Returns the part of a snapshot name after the "@"'''
+    return snapshot_name.split('@', 1)[1]
+
 def zpool(dataset):
     return dataset.split('/')[0]
 
-def common_snapshots(a, b):
-    '''Return a list of snapshots in common.
-       Order is maintained'''
-    ap = [strip_zpool(s) for s in a]
-    bp = [strip_zpool(s) for s in b]
-    return [s for s in ap if s in bp]
-
-def geli_attach(dev, logger, dry_run = False):    
-    '''Attach a geli device'''
+def geli_attach(dev, logger, dry_run = False, passfile = None):
+    '''Attach a geli device, reading its passphrase from passfile if given'''
     logger.info('Attaching %s' % dev)
-    retval = run_shell_cmd(['geli','attach', dev], logger, dry_run, shell = False)
+    cmd_list = ['geli', 'attach']
+    if passfile:
+        cmd_list += ['-j', passfile]
+    retval = run_shell_cmd(cmd_list + [dev], logger, dry_run, shell = False)
     if retval != 0:
         raise BackupException('Failed to geli attach %s, error code %d' % (dev, retval))
 
 def geli_detach(dev, logger, dry_run = False):
-    '''Attach a geli device'''
+    '''Detach a geli device'''
     logger.info('Detaching %s' % dev)
     retval = run_shell_cmd(['geli','detach', dev], logger, dry_run, shell = False)
     if retval != 0:
-        raise BackupException('Failed to geli attach %s, error code %d' % (dev, retval))
+        raise BackupException('Failed to geli detach %s, error code %d' % (dev, retval))
+
+class PoolManager(object):
+    '''Imports and exports the backup pools, each on the geli device
+       <label_root>/<pool>. The pools imported and their health are read
+       with one zpool list and cached. Pools are attached and imported, or
+       exported and detached, all at once in threads. Without a passfile
+       geli prompts for each passphrase on the terminal, so the attaches
+       take turns while the imports still overlap.'''
+    def __init__(self, logger, dry_run = False, passfile = None, label_root = BKUP_LABEL_ROOT):
+        self.logger = logger
+        self.dry_run = dry_run
+        self.passfile = passfile
+        self.label_root = label_root
+        self.lock = threading.Lock()
+        self.prompt_lock = threading.Lock()
+        self.health = {}
+
+    def refresh(self):
+        '''Re-reads the name and health of every imported pool'''
+        with run_metrics.phase('zpool_list'):
+            pool_str = subprocess.check_output(['zpool', 'list', '-H', '-o', 'name,health'])
+        health = {}
+        for line in pool_str.decode(DEFAULT_ENCODING, 'ignore').splitlines():
+            (name, pool_health) = line.split('\t')[:2]
+            health[name] = pool_health
+        with self.lock:
+            self.health = health
+
+    def imported(self, pool):
+        with self.lock:
+            return pool in self.health
+
+    def device(self, pool):
+        return os.path.join(self.label_root, pool)
+
+    def _run_all(self, pools, func, action):
+        '''Calls func(pool) for each pool in its own thread, and raises a
+           BackupException naming the pools it failed on'''
+        errors = {}
+        def run(pool):
+            try:
+                func(pool)
+            except (BackupException, subprocess.CalledProcessError) as e:
+                errors[pool] = e
+        threads = [threading.Thread(target = run, args = (pool,), name = '%s-%s' % (action, pool))
+                   for pool in pools]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise BackupException('Failed to %s %s' % \
+                                  (action, ', '.join('%s (%s)' % (pool, errors[pool])
+                                                     for pool in sorted(errors))))
+
+    def _mount(self, pool):
+        with run_metrics.phase('mount', {'pool': pool}):
+            device = self.device(pool)
+            if os.path.exists(device + '.eli'):
+                self.logger.info('%s is already attached' % device)
+            elif self.passfile:
+                geli_attach(device, self.logger, self.dry_run, self.passfile)
+            else:
+                with self.prompt_lock:
+                    geli_attach(device, self.logger, self.dry_run)
+            zpool_import(pool, self.logger, self.dry_run)
+        if self.dry_run:
+            with self.lock:
+                self.health[pool] = 'ONLINE'
+
+    def mount(self, pools):
+        '''Attaches and imports the pools that are not imported'''
+        self._run_all([pool for pool in pools if not self.imported(pool)], self._mount, 'mount')
+        if not self.dry_run:
+            self.refresh()
+
+    def unusable(self, pools):
+        '''Returns a dict of pool to health for the pools that are not
+           imported and online or degraded'''
+        with self.lock:
+            health = dict((pool, self.health.get(pool, 'not imported')) for pool in pools)
+        return dict((pool, health[pool]) for pool in pools
+                    if health[pool] not in ('ONLINE', 'DEGRADED'))
+
+    def validate(self, pools):
+        '''Raises a BackupException unless every pool is imported and online
+           or degraded'''
+        bad = self.unusable(pools)
+        if bad:
+            raise BackupException('Destination pools unusable: %s' % \
+                                  ', '.join('%s is %s' % (pool, bad[pool]) for pool in pools if pool in bad))
+        with self.lock:
+            degraded = [pool for pool in pools if self.health.get(pool) == 'DEGRADED']
+        for pool in degraded:
+            self.logger.warning('%s is DEGRADED' % pool)
+
+    def unmount(self, pool):
+        '''Exports and detaches a pool'''
+        with run_metrics.phase('unmount', {'pool': pool}):
+            zpool_export(pool, self.logger, self.dry_run)
+            with self.lock:
+                self.health.pop(pool, None)
+            geli_detach(self.device(pool), self.logger, self.dry_run)
+
+    def unmount_all(self, pools):
+        self._run_all(pools, self.unmount, 'unmount')
+
+def plan_transfer(source_dataset, dest_pool, inventory, logger):
+    '''Works out how to bring dest_pool up to date with the latest snapshot of
+       source_dataset. Returns (send_cmd, receive_cmd) lists, or None if the
+       latest snapshot is already on the destination'''
+    latest = inventory.snapshots(source_dataset)[-1]
+    dest_dataset = os.path.join(dest_pool, strip_zpool(source_dataset))
+    if inventory.resume_token(dest_dataset):
+        logger.warning('%s still has an interrupted receive that could not be resumed. Skipping' % \
+                       dest_dataset)
+        return None
+    if not inventory.has_dataset(dest_dataset):
+        logger.info('Destination dataset %s does not exist. Sending full replication stream' % dest_dataset)
+        return (['zfs', 'send', '-v', '-R', latest.name],
+                ['zfs', 'receive', '-s', dest_dataset])
+
+    common_snap = inventory.newest_common_snapshot(source_dataset, dest_dataset)
+    if common_snap:
+        if common_snap.name != latest.name:
+            logger.info('Sending incremental stream from %s to %s for %s' % \
+                        (common_snap.name, latest.name, dest_dataset))
+            return (['zfs', 'send', '-v', '-p', '-I', common_snap.name, latest.name],
+                    ['zfs', 'receive', '-s', '-F', dest_dataset])
+        else :
+            logger.info('Latest snapshot %s already exists on %s. No backup required.' % \
+                        (common_snap.name, dest_dataset))
+            return None
+    else:
+        logger.info('No common snapshots. Sending non-incremental package for %s' % latest.name)
+        return (['zfs', 'send', '-v', '-p', latest.name],
+                ['zfs', 'receive', '-s', dest_dataset])
+
+def recorded_transfer(source_dataset, dest_pool, common_name, inventory, logger):
+    '''Works out the transfer plan_transfer would, for a dest_pool that is not
+       imported, from common_name, the newest snapshot it held when last seen.
+       Returns (send_cmd, receive_cmd) lists, or None if that is the latest.'''
+    latest = inventory.snapshots(source_dataset)[-1]
+    dest_dataset = os.path.join(dest_pool, strip_zpool(source_dataset))
+    common = '%s@%s' % (source_dataset, common_name)
+    if common == latest.name:
+        return None
+    if common not in set(snap.name for snap in inventory.snapshots(source_dataset)):
+        logger.info('%s no longer exists. Planning a non-incremental package for %s' % \
+                    (common, dest_dataset))
+        return (['zfs', 'send', '-v', '-p', latest.name],
+                ['zfs', 'receive', '-s', dest_dataset])
+    return (['zfs', 'send', '-v', '-p', '-I', common, latest.name],
+            ['zfs', 'receive', '-s', '-F', dest_dataset])
+
+class BackupState(object):
+    '''Progress of interrupted transfers and the throughput of recent
+       transfers to each pool, kept in a JSON file between runs'''
+    def __init__(self, filename, dry_run = False):
+        self.filename = filename
+        self.dry_run = dry_run
+        self.lock = threading.Lock()
+        self.data = {}
+        if filename and os.path.exists(filename):
+            with open(filename) as f:
+                self.data = json.load(f)
+        self.data.setdefault('partial', {})
+        self.data.setdefault('throughput', {})
+        self.data.setdefault('common', {})
+
+    def save(self):
+        if self.dry_run or not self.filename:
+            return
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.data, f, indent = 1, sort_keys = True)
+        os.rename(tmp, self.filename)
+
+    def partial(self, dest_dataset):
+        '''Returns the recorded progress of an interrupted transfer to dest_dataset, or None'''
+        return self.data['partial'].get(dest_dataset)
+
+    def record_partial(self, dest_dataset, send_cmd, byte_count):
+        with self.lock:
+            previous = self.partial(dest_dataset)
+            if previous and previous['send'] == send_cmd:
+                byte_count += previous['bytes']
+            self.data['partial'][dest_dataset] = {'send': send_cmd,
+                                                  'bytes': byte_count,
+                                                  'time': make_ts_str()}
+            self.save()
+
+    def partial_datasets(self):
+        '''Returns the destination datasets with an interrupted transfer'''
+        return list(self.data['partial'])
+
+    def clear_partial(self, dest_dataset):
+        with self.lock:
+            if self.data['partial'].pop(dest_dataset, None) is not None:
+                self.save()
+
+    def record_common(self, source_dataset, pool, snapshot_name):
+        '''Records the newest snapshot of source_dataset that pool holds'''
+        with self.lock:
+            commons = self.data['common'].setdefault(source_dataset, {})
+            if commons.get(pool) != snapshot_name:
+                commons[pool] = snapshot_name
+                self.save()
+
+    def common_snapshots(self, source_dataset):
+        '''Returns a dict of pool to the newest snapshot of source_dataset it
+           held when last seen'''
+        return dict(self.data['common'].get(source_dataset, {}))
+
+    def record_throughput(self, pool, byte_count, seconds):
+        '''Records a completed transfer to pool, keeping the last THROUGHPUT_HISTORY'''
+        with self.lock:
+            history = self.data['throughput'].setdefault(pool, [])
+            history.append([make_ts_str(), byte_count, seconds])
+            del history[:-THROUGHPUT_HISTORY]
+            self.save()
+
+    def throughput(self, pool):
+        '''Returns the bytes per second of recent transfers to pool, or of
+           recent transfers to any pool if there are none, or None'''
+        history = self.data['throughput'].get(pool)
+        if not history:
+            history = [h for pool_history in self.data['throughput'].values() for h in pool_history]
+        byte_count = sum(h[1] for h in history)
+        seconds = sum(h[2] for h in history)
+        if seconds <= 0:
+            return None
+        return byte_count / seconds
+
+def resume_size(token, logger):
+    '''Returns (bytes left to send or None, dict of the token's contents
+       such as toname and toguid) for a resume token, from zfs send -nvP -t.
+       The size is None if the stream can't be sent, whether because its
+       source snapshot has been destroyed or for a passing reason such as a
+       busy pool. The contents are printed even when the send fails.'''
+    cmd_list = ['zfs', 'send', '-n', '-v', '-P', '-t', token]
+    with run_metrics.phase('estimate'):
+        proc = subprocess.Popen(cmd_list, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        (out, err) = proc.communicate()
+    (out, err) = (out.decode(DEFAULT_ENCODING, 'ignore'), err.decode(DEFAULT_ENCODING, 'ignore'))
+    contents = {}
+    size = 0
+    for line in (out + '\n' + err).splitlines():
+        fields = line.split('\t')
+        match = TOKEN_FIELD_RE.match(line)
+        if fields[0] == 'size' and len(fields) > 1:
+            size = int(fields[1])
+        elif match:
+            contents[match.group(1)] = match.group(2)
+    if proc.returncode != 0:
+        logger.warning('zfs send -t failed: %s' % err.strip())
+        return (None, contents)
+    return (size, contents)
+
+def resume_source_exists(contents, inventory):
+    '''Returns whether the snapshots a resume token sends, named by its
+       contents, still exist in the inventory, matched by GUID. Returns None
+       if that can't be told, as when the token could not be decoded or its
+       source pool was not loaded.'''
+    (toname, toguid) = (contents.get('toname'), contents.get('toguid'))
+    if not toname or not toguid or zpool(toname) not in inventory.pools:
+        return None
+    snapshots = inventory.by_guid(strip_snapshot(toname))
+    if int(toguid, 0) not in snapshots:
+        return False
+    if contents.get('fromguid') and int(contents['fromguid'], 0) not in snapshots:
+        return False
+    return True
+
+def plan_resumes(source_datasets, dest_pools, inventory, state, logger, dry_run = False):
+    '''Returns TransferJobs finishing the receives of source_datasets that
+       were interrupted on an earlier run, using the receive_resume_token left
+       on the destination, so the stream continues where it stopped rather
+       than starting over. Also returns the list of destination datasets
+       whose resume state is settled by this run, for settle_resumes.
+       Tokens whose source snapshot is confirmed gone from the inventory are
+       discarded here with zfs receive -A, after which the normal plan sends
+       a new stream. Tokens that can't be sent for any other reason are kept
+       for the next run, and their datasets skipped by this one.'''
+    jobs = []
+    settled = []
+    for dest_pool in dest_pools:
+        targets = dict((os.path.join(dest_pool, strip_zpool(d)), d) for d in source_datasets)
+        interrupted = sorted((dataset, token) for dataset, token in inventory.resume_tokens.items()
+                             if any(dataset == t or dataset.startswith(t + '/') for t in targets))
+        for dest_dataset, token in interrupted:
+            partial = state.partial(dest_dataset)
+            if partial:
+                logger.info('%s received %d bytes of %s before being interrupted at %s' % \
+                            (dest_dataset, partial['bytes'], ' '.join(partial['send']), partial['time']))
 
-def run_shell_cmd(cmd_str, logger, dry_run = False, shell = True):
+            (remaining, contents) = resume_size(token, logger)
+            if remaining is None and resume_source_exists(contents, inventory) is False:
+                logger.warning('Source %s of the interrupted receive on %s no longer exists. '
+                               'Discarding its resume state' % (contents['toname'], dest_dataset))
+                run_shell_cmd(['zfs', 'receive', '-A', dest_dataset], logger, dry_run)
+                state.clear_partial(dest_dataset)
+                settled.append(dest_dataset)
+            elif remaining is None:
+                logger.warning('Can\'t resume the interrupted receive on %s. Keeping its resume '
+                               'state for the next run' % dest_dataset)
+            else:
+                logger.info('Resuming interrupted receive on %s, %d bytes remaining' % \
+                            (dest_dataset, remaining))
+                target = next(t for t in targets if dest_dataset == t or dest_dataset.startswith(t + '/'))
+                job = TransferJob(targets[target] + dest_dataset[len(target):],
+                                  ['zfs', 'send', '-v', '-t', token],
+                                  [(dest_pool, ['zfs', 'receive', '-s', dest_dataset])])
+                job.size = remaining
+                jobs.append(job)
+                settled.append(dest_dataset)
+    return (jobs, settled)
+
+def settle_resumes(settled, inventory, dry_run = False):
+    '''Brings the inventory up to date once the resumes of plan_resumes have
+       run, so the normal plan starts from their results'''
+    if dry_run:
+        # Plan as if the resumes had succeeded
+        for dest_dataset in settled:
+            inventory.resume_tokens.pop(dest_dataset, None)
+    else:
+        for pool in sorted(set(zpool(d) for d in settled)):
+            inventory.load_pool(pool)
+
+class TransferJob(object):
+    '''One zfs send of a source dataset and the (pool, receive_cmd) pairs
+       receiving it'''
+    def __init__(self, source_dataset, send_cmd, receivers):
+        self.source_dataset = source_dataset
+        self.send_cmd = send_cmd
+        self.receivers = receivers
+        self.size = None
+        self.results = None
+        self.elapsed = 0.0
+
+    @property
+    def name(self):
+        return '%s -> %s' % (self.source_dataset, ','.join(self.dest_pools))
+
+    @property
+    def source_pool(self):
+        return zpool(self.source_dataset)
+
+    @property
+    def dest_pools(self):
+        return [pool for pool, receive_cmd in self.receivers]
+
+def plan_jobs(source_datasets, dest_pools, inventory, logger, fan_out = False):
+    '''Returns the TransferJobs bringing dest_pools up to date. With fan_out,
+       pools needing the same send stream of a dataset share one job.'''
+    jobs = []
+    for source_dataset in source_datasets:
+        streams = collections.OrderedDict()
+        for dest_pool in dest_pools:
+            transfer = plan_transfer(source_dataset, dest_pool, inventory, logger)
+            if transfer:
+                (send_cmd, receive_cmd) = transfer
+                if fan_out:
+                    streams.setdefault(tuple(send_cmd), []).append((dest_pool, receive_cmd))
+                else:
+                    jobs.append(TransferJob(source_dataset, send_cmd, [(dest_pool, receive_cmd)]))
+
+        for send_cmd, receivers in streams.items():
+            if len(receivers) > 1:
+                logger.info('Fanning out %s to %s' % \
+                            (' '.join(send_cmd), ', '.join(p for p, r in receivers)))
+            jobs.append(TransferJob(source_dataset, list(send_cmd), receivers))
+    return jobs
+
+def estimate_send_size(send_cmd, logger):
+    '''Returns the size in bytes of the stream send_cmd would produce, from a
+       zfs send -nvP dry run, or None if it can't be estimated'''
+    cmd_list = send_cmd[:2] + ['-n', '-P'] + send_cmd[2:]
+    with run_metrics.phase('estimate'):
+        proc = subprocess.Popen(cmd_list, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        (out, err) = proc.communicate()
+    if proc.returncode != 0:
+        logger.debug('Could not estimate size of %s: %s' % \
+                     (' '.join(send_cmd), err.decode(DEFAULT_ENCODING, 'ignore').strip()))
+        return None
+    # Older versions print the dry run to stderr
+    for line in (out + err).decode(DEFAULT_ENCODING, 'ignore').splitlines():
+        fields = line.split('\t')
+        if fields[0] == 'size' and len(fields) > 1:
+            return int(fields[1])
+    return None
+
+class JobLogger(logging.LoggerAdapter):
+    '''Prefixes log messages with the name of the transfer job'''
+    def process(self, msg, kwargs):
+        return ('[%s] %s' % (self.extra['job'], msg), kwargs)
+
+class TransferScheduler(object):
+    '''Runs transfer jobs in threads, largest first, with at most max_jobs
+       running at once and, when non-zero, at most max_per_source reading
+       from any source pool and max_per_dest writing to any destination
+       pool. When the largest pending job can't start because its pools are
+       busy, a smaller job using other pools starts instead. Once every job
+       writing to a destination pool has finished, on_pool_done(pool) is
+       called in that job's thread, while the other jobs carry on.'''
+    def __init__(self, max_jobs, max_per_source = 0, max_per_dest = 0):
+        self.max_jobs = max(1, max_jobs)
+        self.max_per_source = max_per_source
+        self.max_per_dest = max_per_dest
+        self.running = 0
+        self.source_count = collections.Counter()
+        self.dest_count = collections.Counter()
+        self.remaining = collections.Counter()
+        self.cond = threading.Condition()
+
+    def _can_start(self, job):
+        if self.running >= self.max_jobs:
+            return False
+        if self.max_per_source and self.source_count[job.source_pool] >= self.max_per_source:
+            return False
+        if self.max_per_dest and any(self.dest_count[pool] >= self.max_per_dest
+                                     for pool in job.dest_pools):
+            return False
+        return True
+
+    def _update_counts(self, job, delta):
+        self.running += delta
+        self.source_count[job.source_pool] += delta
+        for pool in job.dest_pools:
+            self.dest_count[pool] += delta
+
+    def _run_job(self, job, runner, logger, on_pool_done):
+        done_pools = []
+        try:
+            runner(job)
+        except Exception as e:
+            logger.error('Transfer %s failed: %s' % (job.name, e))
+            job.results = dict((pool, False) for pool in job.dest_pools)
+        finally:
+            with self.cond:
+                self._update_counts(job, -1)
+                for pool in job.dest_pools:
+                    self.remaining[pool] -= 1
+                    if self.remaining[pool] == 0:
+                        done_pools.append(pool)
+                self.cond.notify_all()
+        for pool in done_pools:
+            self._pool_done(pool, on_pool_done, logger)
+
+    def _pool_done(self, pool, on_pool_done, logger):
+        if on_pool_done is None:
+            return
+        try:
+            on_pool_done(pool)
+        except Exception as e:
+            logger.error('Finishing %s failed: %s' % (pool, e))
+
+    def run(self, jobs, runner, logger, pools = (), on_pool_done = None):
+        '''Calls runner(job) for each job and waits for them all to finish,
+           and on_pool_done(pool) for each destination pool of the jobs and
+           each of pools, including those no job writes to'''
+        pending = sorted(jobs, key = lambda job: job.size or 0, reverse = True)
+        for job in jobs:
+            for pool in job.dest_pools:
+                self.remaining[pool] += 1
+        threads = [threading.Thread(target = self._pool_done, args = (pool, on_pool_done, logger),
+                                    name = 'pool-%s' % pool)
+                   for pool in pools if not self.remaining[pool]]
+        for thread in threads:
+            thread.start()
+        with self.cond:
+            while pending:
+                job = next((j for j in pending if self._can_start(j)), None)
+                if job is None:
+                    self.cond.wait()
+                    continue
+                pending.remove(job)
+                self._update_counts(job, 1)
+                thread = threading.Thread(target = self._run_job,
+                                          args = (job, runner, logger, on_pool_done),
+                                          name = 'job-%s' % job.source_dataset)
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+def run_job(job, logger, dry_run = False, buffer_mb = DEFAULT_PUMP_BUFFER_MB,
+            on_error = 'continue', state = None, progress = None):
+    '''Runs the transfer of a job, logging with the job name. If progress is
+       given, its total is the estimated size of all jobs and the progress
+       of the run is logged when the job finishes.'''
+    job_logger = JobLogger(logger, {'job': job.name})
+    if job.size is not None:
+        job_logger.info('Starting, estimated %s' % pretty_bytes(job.size))
+    else:
+        job_logger.info('Starting')
+    start = time.time()
+    job.results = transfer_stream(job.send_cmd, job.receivers, job_logger, dry_run,
+                                  buffer_mb, on_error, state)
+    job.elapsed = time.time() - start
+    if state is not None and not dry_run and '-t' not in job.send_cmd and job.results:
+        # The last argument of a planned send is the snapshot it brings the pools up to
+        for pool in job.dest_pools:
+            if job.results.get(pool, False):
+                state.record_common(job.source_dataset, pool, snapshot_suffix(job.send_cmd[-1]))
+    if progress is not None:
+        run_metrics.count('estimated_bytes_done', job.size or 0)
+        done = run_metrics.value('estimated_bytes_done')
+        job_logger.info('Finished in %0.1fs. %s of %s done (%s), ETA %s' % \
+                        (job.elapsed, pretty_bytes(done), pretty_bytes(progress.total or 0),
+                         pretty_rate(done, time.time() - progress.start_time),
+                         pretty_duration(progress.eta(done))))
+
+def log_summary(jobs, logger):
+    '''Logs the outcome of every transfer'''
+    if not jobs:
+        return
+    logger.info('Summary:')
+    for job in jobs:
+        for pool in job.dest_pools:
+            ok = job.results is not None and job.results.get(pool, False)
+            logger.info('  %-8s %-40s %-10s %10s %8.1fs' % \
+                        ('OK' if ok else 'FAILED', job.source_dataset, pool,
+                         pretty_bytes(job.size) if job.size is not None else '?',
+                         job.elapsed))
+    failed = sum(1 for job in jobs for pool in job.dest_pools
+                 if job.results is None or not job.results.get(pool, False))
+    if failed:
+        logger.error('%d of %d transfers failed' % \
+                     (failed, sum(len(job.dest_pools) for job in jobs)))
+
+PlanEntry = collections.namedtuple('PlanEntry', ['dataset', 'pool', 'kind', 'snapshots', 'size', 'eta'])
+
+def transfer_kind(send_cmd):
+    '''Describes a send command as a replication, incremental or full stream'''
+    if '-t' in send_cmd:
+        return 'resume'
+    elif '-R' in send_cmd:
+        return 'replication'
+    elif '-I' in send_cmd or '-i' in send_cmd:
+        return 'incremental'
+    return 'full'
+
+def record_commons(source_datasets, dest_pools, inventory, state):
+    '''Records the newest snapshot of each source dataset that each of
+       dest_pools holds, so later plans can be made without the pools'''
+    for source_dataset in source_datasets:
+        for dest_pool in dest_pools:
+            common = inventory.newest_common_snapshot(
+                source_dataset, os.path.join(dest_pool, strip_zpool(source_dataset)))
+            if common:
+                state.record_common(source_dataset, dest_pool, snapshot_suffix(common.name))
+
+def make_plan(source_datasets, dest_pools, inventory, state, logger, new_snapshot_bytes = None):
+    '''Returns a PlanEntry for each dataset and destination pool, describing
+       the transfer the next backup would make. Sizes come from zfs send -nP
+       and ETAs from the recorded throughput of the destination pool; either
+       is None if unknown. If new_snapshot_bytes is given, a dict of dataset
+       to the bytes written since its latest snapshot, the plan includes the
+       snapshot the backup would create and those bytes are added to each
+       transfer, including one from the latest snapshot when the destination
+       already has it. Pools that are not in inventory are planned from the
+       newest common snapshot recorded in state.'''
+    plan = []
+    for dest_pool in dest_pools:
+        rate = state.throughput(dest_pool)
+        for source_dataset in source_datasets:
+            dest_dataset = os.path.join(dest_pool, strip_zpool(source_dataset))
+            token = inventory.resume_token(dest_dataset)
+            transfer = None
+            if token:
+                (kind, snapshots) = ('resume', 'interrupted receive')
+                size = resume_size(token, logger)[0]
+            elif dest_pool in inventory.pools:
+                transfer = plan_transfer(source_dataset, dest_pool, inventory, logger)
+            else:
+                common_name = state.common_snapshots(source_dataset).get(dest_pool)
+                if common_name is None:
+                    logger.warning('%s is not imported and has no recorded snapshot of %s' % \
+                                   (dest_pool, source_dataset))
+                    plan.append(PlanEntry(source_dataset, dest_pool, 'unknown', '', None, None))
+                    continue
+                transfer = recorded_transfer(source_dataset, dest_pool, common_name, inventory, logger)
+            if transfer:
+                send_cmd = transfer[0]
+                (kind, snapshots) = (transfer_kind(send_cmd),
+                                     ' -> '.join(strip_zpool(a) for a in send_cmd if '@' in a))
+                size = estimate_send_size(send_cmd, logger)
+            elif not token and new_snapshot_bytes is None:
+                plan.append(PlanEntry(source_dataset, dest_pool, 'none', '', 0, 0))
+                continue
+            elif not token:
+                # Only the new snapshot is sent
+                latest = inventory.snapshots(source_dataset)[-1]
+                (kind, snapshots, size) = ('incremental', strip_zpool(latest.name), 0)
+
+            if new_snapshot_bytes is not None:
+                snapshots += ' -> @' + NEW_SNAPSHOT_LABEL
+                written = new_snapshot_bytes.get(source_dataset)
+                size = None if size is None or written is None else size + written
+            eta = size / rate if size is not None and rate else None
+            plan.append(PlanEntry(source_dataset, dest_pool, kind, snapshots, size, eta))
+    return plan
+
+def written_since_snapshot(datasets):
+    '''Returns a dict of dataset to the bytes written to it since its latest
+       snapshot, which a snapshot taken now would hold, or None if unknown'''
+    cmd_list = ['zfs', 'list', '-H', '-p', '-o', 'name,written'] + datasets
+    with run_metrics.phase('estimate'):
+        list_str = subprocess.check_output(cmd_list).decode(DEFAULT_ENCODING, 'ignore')
+    written = {}
+    for line in list_str.splitlines():
+        (name, value) = line.split('\t')[:2]
+        written[name] = int(value) if value.isdigit() else None
+    return written
+
+def pretty_duration(seconds):
+    if seconds is None:
+        return '?'
+    seconds = int(seconds + 0.5)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def print_plan(plan):
+    '''Prints a plan with the total size and ETA of each destination pool'''
+    row_format = '%-24s %-8s %-12s %-36s %12s %10s'
+    print(row_format % ('DATASET', 'POOL', 'KIND', 'SNAPSHOTS', 'SIZE', 'ETA'))
+    for entry in plan:
+        print(row_format % (entry.dataset, entry.pool, entry.kind, entry.snapshots,
+                            '?' if entry.size is None else pretty_bytes(entry.size),
+                            pretty_duration(entry.eta)))
+
+    for pool in sorted(set(entry.pool for entry in plan)):
+        entries = [entry for entry in plan if entry.pool == pool]
+        size = sum(entry.size or 0 for entry in entries)
+        unknown = any(entry.eta is None for entry in entries if entry.kind != 'none')
+        eta = None if unknown else sum(entry.eta for entry in entries)
+        print('%s: %s in %d transfers, ETA %s' % \
+              (pool, pretty_bytes(size), sum(1 for entry in entries if entry.kind != 'none'),
+               pretty_duration(eta)))
+
+RetentionEntry = collections.namedtuple('RetentionEntry', ['dataset', 'snapshots', 'destroy'])
+
+def parse_retention(spec):
+    '''Parses a retention policy such as hourly=24,daily=7 into a dict of
+       period to the number of periods to keep'''
+    policy = {}
+    for item in spec.split(','):
+        (period, sep, count) = item.strip().partition('=')
+        if period not in RETENTION_PERIODS or not count.isdigit():
+            raise argparse.ArgumentTypeError('Invalid retention %s. Expected PERIOD=COUNT with '
+                                             'PERIOD one of %s' % (item, ', '.join(RETENTION_PERIODS)))
+        policy[period] = int(count)
+    return policy
+
+def snapshot_time(snapshot):
+    '''Returns the time in the name of a snapshot created by this script,
+       or None for other snapshots'''
+    try:
+        return datetime.datetime.strptime(snapshot_suffix(snapshot.name), SNAPSHOT_TS_FORMAT)
+    except ValueError:
+        return None
+
+def retained_snapshots(snapshots, policy):
+    '''Returns the names of the snapshots, given in creation order, that a
+       retention policy keeps. For each period the newest snapshot of each
+       of the last COUNT periods holding one is kept. The newest snapshot
+       and snapshots not created by this script are always kept.'''
+    keep = set(snap.name for snap in snapshots if snapshot_time(snap) is None)
+    if snapshots:
+        keep.add(snapshots[-1].name)
+    for period, count in policy.items():
+        period_key = RETENTION_PERIODS[period]
+        seen = set()
+        for snap in reversed(snapshots):
+            snap_time = snapshot_time(snap)
+            if snap_time is None or period_key(snap_time) in seen:
+                continue
+            if len(seen) >= count:
+                break
+            seen.add(period_key(snap_time))
+            keep.add(snap.name)
+    return keep
+
+def retention_entry(dataset, snapshots, policy, protected):
+    '''Returns the RetentionEntry of a dataset, never destroying the
+       snapshot names in protected'''
+    keep = retained_snapshots(snapshots, policy) | protected
+    return RetentionEntry(dataset, snapshots, [snap for snap in snapshots if snap.name not in keep])
+
+def plan_retention(source_datasets, dest_pools, inventory, state, source_policy, dest_policy, logger):
+    '''Returns a RetentionEntry for each source dataset if source_policy is
+       given, and for each of its copies on dest_pools if dest_policy is.
+       The newest snapshot a destination has in common with the source, which
+       the next incremental send starts from, is never destroyed on either
+       side. This includes destinations not in dest_pools, as recorded in
+       state when they were last seen. Datasets with an interrupted receive
+       are left alone, since resuming it needs their snapshots.'''
+    entries = []
+    for source_dataset in source_datasets:
+        dest_datasets = [os.path.join(pool, strip_zpool(source_dataset)) for pool in dest_pools]
+        dest_datasets = [d for d in dest_datasets if inventory.has_dataset(d)]
+
+        interrupted = [d for d in dest_datasets if inventory.resume_token(d)] + \
+                      [d for d in state.partial_datasets() if strip_zpool(d) == strip_zpool(source_dataset)]
+        if interrupted:
+            logger.warning('Not destroying snapshots of %s while the receive on %s is interrupted' % \
+                           (source_dataset, ', '.join(sorted(set(interrupted)))))
+            continue
+
+        dest_commons = {}
+        for dest_dataset in dest_datasets:
+            common = inventory.newest_common_snapshot(source_dataset, dest_dataset)
+            if common:
+                dest_commons[dest_dataset] = common
+                state.record_common(source_dataset, zpool(dest_dataset), snapshot_suffix(common.name))
+
+        if source_policy:
+            protected = set('%s@%s' % (source_dataset, name)
+                            for name in state.common_snapshots(source_dataset).values())
+            protected.update(common.name for common in dest_commons.values())
+            entries.append(retention_entry(source_dataset, inventory.snapshots(source_dataset),
+                                           source_policy, protected))
+        if dest_policy:
+            for dest_dataset in dest_datasets:
+                protected = set()
+                if dest_dataset in dest_commons:
+                    protected.add('%s@%s' % (dest_dataset, snapshot_suffix(dest_commons[dest_dataset].name)))
+                entries.append(retention_entry(dest_dataset, inventory.snapshots(dest_dataset),
+                                               dest_policy, protected))
+    return entries
+
+def destroy_commands(entry):
+    '''Returns the zfs destroy commands of a RetentionEntry. Runs of
+       consecutive snapshots are destroyed as FIRST%LAST ranges, and each
+       command destroys up to DESTROY_BATCH_SIZE names or ranges.'''
+    doomed = set(snap.name for snap in entry.destroy)
+    ranges = []
+    run = []
+    for snap in entry.snapshots + [None]:
+        if snap is not None and snap.name in doomed:
+            run.append(snapshot_suffix(snap.name))
+        elif run:
+            ranges.append(run[0] if len(run) == 1 else '%s%%%s' % (run[0], run[-1]))
+            run = []
+    return [['zfs', 'destroy', '%s@%s' % (entry.dataset, ','.join(ranges[i:i + DESTROY_BATCH_SIZE]))]
+            for i in range(0, len(ranges), DESTROY_BATCH_SIZE)]
+
+def destroy_snapshots(entries, logger, dry_run = False):
+    '''Runs the destroy commands of each RetentionEntry'''
+    for entry in entries:
+        if not entry.destroy:
+            continue
+        logger.info('Destroying %d of %d snapshots of %s' % \
+                    (len(entry.destroy), len(entry.snapshots), entry.dataset))
+        for cmd in destroy_commands(entry):
+            if dry_run:
+                logger.info('Would execute: %s' % ' '.join(cmd))
+            retval = run_shell_cmd(cmd, logger, dry_run)
+            if retval != 0:
+                logger.error('Failed to destroy snapshots of %s, error code %d' % (entry.dataset, retval))
+                break
+        run_metrics.count('snapshots_destroyed', len(entry.destroy), {'pool': zpool(entry.dataset)})
+
+def print_retention(entries):
+    '''Prints the snapshots each RetentionEntry keeps and destroys, and the
+       commands destroying them'''
+    row_format = '%-32s %8s %8s  %s'
+    print(row_format % ('DATASET', 'KEEP', 'DESTROY', 'DESTROYED'))
+    for entry in entries:
+        destroyed = ''
+        if entry.destroy:
+            destroyed = '%s .. %s' % (snapshot_suffix(entry.destroy[0].name),
+                                      snapshot_suffix(entry.destroy[-1].name))
+        print(row_format % (entry.dataset, len(entry.snapshots) - len(entry.destroy),
+                            len(entry.destroy), destroyed))
+    for entry in entries:
+        for cmd in destroy_commands(entry):
+            print(' '.join(shlex.quote(a) for a in cmd))
+
+def pipeline_str(send_cmd, receive_cmd):
+    '''Describes a send and receive pair as the equivalent shell pipeline'''
+    return '%s | %s' % (' '.join(shlex.quote(a) for a in send_cmd),
+                        ' '.join(shlex.quote(a) for a in receive_cmd))
+
+def pretty_bytes(byte_count):
+    '''Print bytes in friendly units'''
+    (MB, GB) = (1024**2, 1024**3)
+    if byte_count > GB:
+        return '%0.2f GB' % (float(byte_count) / GB)
+    else:
+        return '%0.2f MB' % (float(byte_count) / MB)
+
+def pretty_rate(byte_count, seconds):
+    return '%0.1f MB/s' % (byte_count / (1024.0 ** 2) / seconds if seconds > 0 else 0.0)
+
+class PumpReceiver(object):
+    '''A zfs receive fed from a StreamPump, with its transfer statistics'''
+    def __init__(self, pool, cmd):
+        self.pool = pool
+        self.cmd = cmd
+        self.proc = None
+        self.chunks = queue.Queue()
+        self.failed = threading.Event()
+        self.thread = None
+        self.bytes = 0
+        self.stall = 0.0
+
+class StreamPump(object):
+    '''Runs a zfs send and one or more zfs receives as subprocesses and copies
+       the stream between them through a ring of buffers, like mbuffer.
+       Buffers are allocated as the ring fills, up to buffer_bytes, so a
+       stream whose receivers keep up only uses a few of them. The send side fills buffers with readinto and each receiver
+       writes them out from its own thread, so a burst on either side is
+       absorbed by the buffer instead of stalling the other. A buffer is
+       reused once every receiver has written it, so the sender runs no
+       faster than the slowest receiver.
+
+       Stall times record how long the sender waited for a free buffer
+       (receivers too slow) and how long each receiver waited for data
+       (sender too slow).'''
+    def __init__(self, send_cmd, receivers, buffer_bytes, on_error = 'continue'):
+        self.send_cmd = send_cmd
+        self.receivers = [PumpReceiver(pool, cmd) for pool, cmd in receivers]
+        self.on_error = on_error
+        self.max_buffers = max(2, buffer_bytes // PUMP_CHUNK_SIZE)
+        self.buffers = []
+        self.free = queue.Queue()
+        self.refs = []
+        self.refs_lock = threading.Lock()
+        self.bytes = 0
+        self.send_stall = 0.0
+        self.elapsed = 0.0
+        self.send_returncode = None
+        self.aborted = False
+
+    def _get_buffer(self):
+        '''Returns the index of a free buffer, allocating another while the
+           ring is below its size, and otherwise waiting for one'''
+        try:
+            return self.free.get_nowait()
+        except queue.Empty:
+            pass
+        if len(self.buffers) < self.max_buffers:
+            self.buffers.append(bytearray(PUMP_CHUNK_SIZE))
+            self.refs.append(0)
+            return len(self.buffers) - 1
+        return self.free.get()
+
+    def _release(self, n):
+        with self.refs_lock:
+            self.refs[n] -= 1
+            if self.refs[n] == 0:
+                self.free.put(n)
+
+    def _feed(self, receiver):
+        '''Writes buffers to a receiver until None is queued. After the receiver
+           fails its buffers are still released so the sender is not blocked.'''
+        while True:
+            start = time.time()
+            item = receiver.chunks.get()
+            receiver.stall += time.time() - start
+            if item is None:
+                break
+            (n, length) = item
+            if not receiver.failed.is_set():
+                try:
+                    view = memoryview(self.buffers[n])[:length]
+                    while view:
+                        written = receiver.proc.stdin.write(view)
+                        view = view[written:]
+                    receiver.bytes += length
+                except OSError:
+                    receiver.failed.set()
+            self._release(n)
+        try:
+            receiver.proc.stdin.close()
+        except OSError:
+            receiver.failed.set()
+
+    def run(self):
+        '''Transfers the stream and returns a dict of pool to success'''
+        start = time.time()
+        for receiver in self.receivers:
+            receiver.proc = subprocess.Popen(receiver.cmd, stdin = subprocess.PIPE, bufsize = 0)
+            receiver.thread = threading.Thread(target = self._feed, args = (receiver,),
+                                               name = 'receive-%s' % receiver.pool)
+            receiver.thread.start()
+
+        send = subprocess.Popen(self.send_cmd, stdout = subprocess.PIPE, bufsize = 0)
+        aborted = False
+        try:
+            while True:
+                wait_start = time.time()
+                n = self._get_buffer()
+                self.send_stall += time.time() - wait_start
+
+                # Fill the whole buffer so pipe-sized reads don't waste the ring
+                view = memoryview(self.buffers[n])
+                length = 0
+                while length < len(view):
+                    count = send.stdout.readinto(view[length:])
+                    if not count:
+                        break
+                    length += count
+                if not length:
+                    self.free.put(n)
+                    break
+                self.bytes += length
+
+                live = [r for r in self.receivers
+                        if not r.failed.is_set() and r.proc.poll() is None]
+                if len(live) < len(self.receivers) and (self.on_error == 'abort' or not live):
+                    aborted = True
+                    self.free.put(n)
+                    break
+                self.refs[n] = len(live)
+                for r in live:
+                    r.chunks.put((n, length))
+        finally:
+            if aborted:
+                send.kill()
+                for r in self.receivers:
+                    r.proc.kill()
+            send.stdout.close()
+            for r in self.receivers:
+                r.chunks.put(None)
+            for r in self.receivers:
+                r.thread.join()
+                r.proc.wait()
+            send.wait()
+            self.elapsed = time.time() - start
+            self.send_returncode = send.returncode
+            self.aborted = aborted
+
+        results = {}
+        for r in self.receivers:
+            results[r.pool] = (send.returncode == 0 and r.proc.returncode == 0 and
+                               not r.failed.is_set() and not aborted)
+        return results
+
+    def log_stats(self, logger):
+        logger.info('Sent %d bytes in %0.1fs (%s), send stalled %0.1fs waiting for buffer space' % \
+                    (self.bytes, self.elapsed, pretty_rate(self.bytes, self.elapsed), self.send_stall))
+        for r in self.receivers:
+            logger.info('%s received %d bytes (%s), stalled %0.1fs waiting for data' % \
+                        (r.pool, r.bytes, pretty_rate(r.bytes, self.elapsed), r.stall))
+
+def transfer_stream(send_cmd, receivers, logger, dry_run = False, buffer_mb = DEFAULT_PUMP_BUFFER_MB,
+                    on_error = 'continue', state = None):
+    '''Sends send_cmd to the receive command of each (pool, receive_cmd) in
+       receivers through a StreamPump. Returns a dict of pool to success.
+       The bytes received by failed transfers are recorded in state.'''
+    for pool, receive_cmd in receivers:
+        logger.debug('Executing command: %s' % pipeline_str(send_cmd, receive_cmd))
+    if dry_run:
+        return dict((pool, True) for pool, receive_cmd in receivers)
+
+    pump = StreamPump(send_cmd, receivers, int(buffer_mb * 1024 * 1024), on_error)
+    results = pump.run()
+    if pump.aborted:
+        logger.error('Receiver failed, aborted stream: %s' % ' '.join(send_cmd))
+    pump.log_stats(logger)
+    run_metrics.count('send_stall_seconds', pump.send_stall)
+    for receiver in pump.receivers:
+        (pool, receive_cmd) = (receiver.pool, receiver.cmd)
+        run_metrics.add_time('transfer', pump.elapsed, {'pool': pool})
+        run_metrics.count('bytes_received', receiver.bytes, {'pool': pool})
+        run_metrics.count('receive_stall_seconds', receiver.stall, {'pool': pool})
+        run_metrics.count('transfers', 1, {'pool': pool, 'result': 'ok' if results[pool] else 'failed'})
+        if results[pool]:
+            logger.info('Execute command: %s' % pipeline_str(send_cmd, receive_cmd))
+            if state:
+                state.clear_partial(receive_cmd[-1])
+                state.record_throughput(pool, receiver.bytes, pump.elapsed)
+        else:
+            logger.error('Transfer to %s failed. send returned %s, receive returned %s: %s' % \
+                         (pool, pump.send_returncode, receiver.proc.returncode,
+                          pipeline_str(send_cmd, receive_cmd)))
+            if state:
+                state.record_partial(receive_cmd[-1], send_cmd, receiver.bytes)
+    return results
+
+def run_shell_cmd(cmd_str, logger, dry_run = False, shell = False):
     '''Run a shell command if a dry run is not specified'''
     logger.debug('Executing command: %s' % ' '.join(cmd_str))
     if not args.dry_run:        
@@ -188,74 +1326,124 @@ if __name__ == '__main__':
         logger.debug('Verbose')
 
     try:
+        run_metrics.write_at_exit(args.metrics_file, args.profile_file)
+        devices = PoolManager(logger, args.dry_run, args.geli_passfile)
+        devices.refresh()
         if args.mount:
-            existing_zpools = get_zpools()
-            for dest_zpool in args.dest_zpools:
-                if dest_zpool not in existing_zpools:
-                    geli_attach(os.path.join(BKUP_LABEL_ROOT, dest_zpool), logger, args.dry_run)
-                    zpool_import(dest_zpool, logger, args.dry_run)
+            devices.mount(args.dest_zpools)
 
-        validate_zpools(args.dest_zpools)
+        dest_pools = args.dest_zpools
+        if args.plan:
+            # A plan can be made before the pools are imported, from the
+            # snapshots and throughput recorded when they were last used
+            unusable = devices.unusable(args.dest_zpools)
+            for pool in args.dest_zpools:
+                if pool in unusable:
+                    logger.warning('%s is %s. Planning from its recorded snapshots.' % \
+                                   (pool, unusable[pool]))
+            dest_pools = [pool for pool in args.dest_zpools if pool not in unusable]
+        else:
+            devices.validate(args.dest_zpools)
         validate_datasets(args.dataset)
 
-        # Get existing snapshots by dataset
-        snapshots = {}
-        for dataset in args.dataset:
-            snapshots[dataset] = existing_snapshots(dataset)
+        # Get existing snapshots of the source and destination pools
+        inventory = SnapshotInventory()
+        source_pools = sorted(set(zpool(d) for d in args.dataset))
+        for pool in source_pools + dest_pools:
+            inventory.load_pool(pool)
         
-        if not args.use_existing_snapshots:
+        if args.plan and args.use_existing_snapshots:
+            logger.info('Planning from the latest existing snapshots. Changes made since '
+                        'they were taken are not included.')
+        elif args.plan:
+            logger.info('Planning from the latest existing snapshots and the changes '
+                        'written since, which the backup would snapshot.')
+        elif not args.use_existing_snapshots:
             snapshot_name = make_ts_str()            
             logger.info('Snapshot name is %s' % snapshot_name)
             
-            # Add snapshots being created to end of list
-            new_snapshots = []
-            for d in args.dataset:
-                cur_snapshot = '%s@%s' % (d, snapshot_name)                
-                snapshots[d].append(cur_snapshot)
-                new_snapshots.append(cur_snapshot)
-            logger.debug('Creating ZFS snapshots: ' + ', '.join(snapshots))
+            new_snapshots = ['%s@%s' % (d, snapshot_name) for d in args.dataset]
+            logger.debug('Creating ZFS snapshots: ' + ', '.join(new_snapshots))
             if not args.dry_run:
                 make_zfs_snapshots(new_snapshots)
+                for pool in source_pools:
+                    inventory.load_pool(pool)
+            else:
+                # Add snapshots that would have been created to end of list
+                for cur_snapshot in new_snapshots:
+                    inventory.add(Snapshot(cur_snapshot, None, None))
         else:
             logger.debug('Attempting to use latest snapshot rather than creating.')
-            
-        for dest_pool in args.dest_zpools:
-            for source_dataset in args.dataset:
-                source_snaps = snapshots[source_dataset]
-                dest_dataset = os.path.join(dest_pool, strip_zpool(source_dataset))
-                try :
-                    dest_snaps = existing_snapshots(dest_dataset)
-                    common_snaps = common_snapshots(source_snaps, dest_snaps)                    
-                    if common_snaps:
-                        if common_snaps[-1] != strip_zpool(source_snaps[-1]):                            
-                            incr_snap = os.path.join(zpool(source_dataset), common_snaps[-1])
-
-                            logger.info('Sending incremental stream from %s to %s for %s' % \
-                                        (incr_snap, source_snaps[-1], dest_dataset))
-                            run_shell_cmd('zfs send -v -p -I "%s" "%s" | zfs receive -F "%s"' % \
-                                          (incr_snap, source_snaps[-1], dest_dataset),
-                                          logger, args.dry_run, shell = True)
-                        else :
-                            logger.info('Latest snapshot %s already exists on %s. No backup required.' % \
-                                        (common_snaps[-1], dest_dataset))
-                    else:
-                        logger.info('No common snapshots. Sending non-incremental package for %s' % source_snaps[-1])
-                        run_shell_cmd('zfs send -v -p "%s" | zfs receive "%s"' % \
-                                      (source_snaps[-1], dest_dataset),
-                                      logger, args.dry_run, shell = True)
-                
-                except subprocess.CalledProcessError as e:
-                    logger.info('Destination dataset %s does not exist. Sending full replication stream' % dest_dataset)
-                    run_shell_cmd('zfs send -v -R "%s" | zfs receive "%s"' % \
-                                  (source_snaps[-1], dest_dataset),
-                                  logger, args.dry_run, shell = True)
+
+        state = BackupState(args.state_file, args.dry_run or args.plan)
+        record_commons(args.dataset, dest_pools, inventory, state)
+        if args.plan:
+            new_snapshot_bytes = None
+            if not args.use_existing_snapshots:
+                new_snapshot_bytes = written_since_snapshot(args.dataset)
+            print_plan(make_plan(args.dataset, args.dest_zpools, inventory, state, logger,
+                                 new_snapshot_bytes))
+            if args.retain or args.dest_retain:
+                print('')
+                print_retention(plan_retention(args.dataset, args.dest_zpools, inventory, state,
+                                               args.retain, args.dest_retain, logger))
             if args.unmount:
-                zpool_export(dest_pool, logger, args.dry_run)                
-                geli_detach(os.path.join(BKUP_LABEL_ROOT, dest_pool), logger, args.dry_run)
+                devices.unmount_all(dest_pools)
+        else:
+            # The buffer is shared by the transfers running at once
+            buffer_mb = args.buffer_mb / max(1, args.jobs)
+            scheduler = TransferScheduler(args.jobs, args.max_per_source, args.max_per_dest)
+
+            with run_metrics.phase('resume'):
+                (resume_jobs, settled) = plan_resumes(args.dataset, args.dest_zpools, inventory,
+                                                      state, logger, args.dry_run)
+                scheduler.run(resume_jobs,
+                              lambda job: run_job(job, logger, args.dry_run, buffer_mb,
+                                                  args.fan_out_on_error, state),
+                              logger)
+                settle_resumes(settled, inventory, args.dry_run)
+
+            jobs = plan_jobs(args.dataset, args.dest_zpools, inventory, logger, args.fan_out)
+            for job in jobs:
+                job.size = estimate_send_size(job.send_cmd, logger)
+            progress = metrics.Progress(sum(job.size or 0 for job in jobs))
+
+            def finish_pool(pool):
+                '''Applies the retention of a destination pool once its transfers
+                   are done, then exports it if asked to'''
+                logger.info('Transfers to %s finished' % pool)
+                if args.retain or args.dest_retain:
+                    with run_metrics.phase('retention', {'pool': pool}):
+                        if not args.dry_run:
+                            inventory.load_pool(pool)
+                        if args.dest_retain:
+                            destroy_snapshots(plan_retention(args.dataset, [pool], inventory, state,
+                                                             None, args.dest_retain, logger),
+                                              logger, args.dry_run)
+                if args.unmount:
+                    devices.unmount(pool)
+
+            scheduler.run(jobs,
+                          lambda job: run_job(job, logger, args.dry_run, buffer_mb,
+                                              args.fan_out_on_error, state, progress),
+                          logger, args.dest_zpools, finish_pool)
+            log_summary(resume_jobs + jobs, logger)
+
+            if args.retain:
+                # The destination pools were re-read before being exported
+                with run_metrics.phase('retention'):
+                    if not args.dry_run:
+                        for pool in source_pools:
+                            inventory.load_pool(pool)
+                    destroy_snapshots(plan_retention(args.dataset, args.dest_zpools, inventory, state,
+                                                     args.retain, None, logger),
+                                      logger, args.dry_run)
+        run_metrics.set('success', 1)
 
     except BackupException as e:
         logger.fatal(str(e))
     except subprocess.CalledProcessError as e:
         logger.fatal(str(e))
 
+    logger.info('Time by phase: %s' % run_metrics.phase_summary())
     logger.info('%s exiting.' % sys.argv[0])
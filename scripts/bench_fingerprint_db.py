@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+'''Measures how fast make_tree_fingerprints.py can write rows to SQLite.
+   Three modes write the same rows:
+
+   baseline   the statements of the original scanner: one insert per row,
+              reading lastrowid, a commit every FILES_PER_COMMIT files, then
+              one update per directory hash
+   default    RowWriter as a scan without --bulk-load uses it, one row per
+              statement with ids assigned in Python
+   bulk-load  RowWriter in batches with the tuning and index rebuild of
+              --bulk-load
+
+   Inserts and directory hash updates are timed and reported separately.
+   The bulk-load index rebuild is reported on its own and not counted in
+   either rate.'''
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import make_tree_fingerprints as mtf
+
+FILES_PER_DIR = 100
+MODES = ['baseline', 'default', 'bulk-load']
+
+def baseline_insert(cursor, parent_id, path, st, hash_str):
+    '''Inserts a row the way the original scanner did and returns its id'''
+    cursor.execute('''insert into files (parent, path, type, mode, uid, gid, nlink, hash, size, mtime,
+                                         inode, ctime, hash_level)
+                      values (?,?,?,?,?,?,?,?,?,?,?,?,?)''',
+                   (parent_id, path, mtf.stat.S_IFMT(st.st_mode), st.st_mode, st.st_uid, st.st_gid,
+                    st.st_nlink, hash_str, st.st_size, st.st_mtime, st.st_ino, st.st_ctime,
+                    mtf.HASH_NONE if hash_str is None else mtf.HASH_FULL))
+    return cursor.lastrowid
+
+def load_rows(db, rows, mode):
+    '''Inserts rows synthetic file rows plus their directories, then updates
+       the directory hashes. Returns a dict of the insert and update counts,
+       their rates per second, and the seconds taken by each step.'''
+    conn = mtf.sqlite3.connect(db)
+    conn.text_factory = str
+    cursor = conn.cursor()
+    mtf.create_files_table(cursor)
+    conn.commit()
+
+    index_sql = None
+    writer = None
+    if mode == 'bulk-load':
+        index_sql = mtf.begin_bulk_load(conn)
+        writer = mtf.RowWriter(conn, mtf.BULK_BATCH_SIZE, mtf.BULK_ROWS_PER_COMMIT)
+    elif mode == 'default':
+        writer = mtf.RowWriter(conn)
+
+    st = os.lstat(db)
+    hash_str = mtf.hashlib.sha256().hexdigest()
+
+    start = time.time()
+    dir_ids = []
+    for n in range(rows):
+        if writer is None:
+            if n % FILES_PER_DIR == 0:
+                dir_id = baseline_insert(cursor, None, '/bench/%d' % n, st, None)
+                dir_ids.append(dir_id)
+            baseline_insert(cursor, dir_id, '/bench/%d/file' % n, st, hash_str)
+            if (n + 1) % mtf.FILES_PER_COMMIT == 0:
+                conn.commit()
+        else:
+            if n % FILES_PER_DIR == 0:
+                dir_id = writer.insert(None, '/bench/%d' % n, st, None)
+                dir_ids.append(dir_id)
+            writer.insert(dir_id, '/bench/%d/file' % n, st, hash_str)
+    if writer is None:
+        conn.commit()
+    else:
+        writer.commit()
+    insert_seconds = time.time() - start
+
+    start = time.time()
+    for dir_id in dir_ids:
+        if writer is None:
+            cursor.execute('update files set hash = ?, total_size = ?, hash_level = ? where id = ?',
+                           (hash_str, 0, mtf.HASH_FULL, dir_id))
+        else:
+            writer.update_dir(dir_id, hash_str, 0)
+    if writer is None:
+        conn.commit()
+    else:
+        writer.commit()
+    update_seconds = time.time() - start
+
+    start = time.time()
+    if index_sql is not None:
+        mtf.end_bulk_load(conn, index_sql)
+    index_seconds = time.time() - start
+    conn.close()
+
+    inserts = rows + len(dir_ids)
+    return {'inserts': inserts,
+            'inserts_per_sec': inserts / insert_seconds,
+            'updates': len(dir_ids),
+            'updates_per_sec': len(dir_ids) / update_seconds if update_seconds > 0 else None,
+            'insert_seconds': insert_seconds,
+            'update_seconds': update_seconds,
+            'index_seconds': index_seconds}
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(message)s', level = logging.WARNING)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', metavar = 'N', dest = 'rows',
+                        type = int, default = 200000,
+                        help = 'Number of file rows to write')
+
+    parser.add_argument('--dir', metavar = 'DIR', dest = 'dir',
+                        default = None,
+                        help = 'Directory for the benchmark databases, ideally on the '
+                               'disk that will hold the real database')
+
+    parser.add_argument('--json', dest = 'json',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Print the rates as JSON, as read by bench_suite.py')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(dir = args.dir)
+    try:
+        results = dict((mode, load_rows(os.path.join(tmpdir, '%s.db' % mode), args.rows, mode))
+                       for mode in MODES)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if args.json:
+        print(json.dumps(dict((mode.replace('-', '_'), result) for mode, result in results.items())))
+    else:
+        print('%-10s %12s %12s %10s' % ('mode', 'inserts/s', 'updates/s', 'index s'))
+        for mode in MODES:
+            result = results[mode]
+            print('%-10s %12.0f %12s %10.2f' % (mode, result['inserts_per_sec'],
+                                                 '-' if result['updates_per_sec'] is None
+                                                 else '%0.0f' % result['updates_per_sec'],
+                                                 result['index_seconds']))
+        baseline = results['baseline']['inserts_per_sec']
+        for mode in MODES[1:]:
+            print('%s inserts: %0.1fx baseline' % (mode, results[mode]['inserts_per_sec'] / baseline))
@@ -0,0 +1,438 @@
+#!/usr/bin/env python
+'''Benchmarks make_tree_fingerprints.py, show_dups.py and backup.py planning
+   against generated data, storing the results so runs can be compared
+
+The tree is generated from a seed, so the same options always produce the
+same files. Each tool runs as a separate process, under --python2 or
+--python3 as it requires. Its peak RSS is reported by a small wrapper
+process that forks it, since a child starts with the high-water mark of
+the process that forked it and the harness itself is much larger. Phase
+times come from the tools' --metrics output. Backup planning runs against
+the fake zfs in fake/, with generated datasets holding many snapshots.
+
+Each run appends one JSON line to the results file. --compare prints the
+last two runs side by side.
+'''
+
+import argparse
+import datetime
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+FAKE_ZFS_DIR = os.path.join(SCRIPT_DIR, 'fake')
+DEFAULT_RESULTS_FILE = 'bench_results.jsonl'
+BENCHMARKS = ['scan', 'dups', 'db', 'plan']
+CONTENT_BLOCK_SIZE = 1024 * 1024
+FIRST_SNAPSHOT_TIME = datetime.datetime(2020, 1, 1)
+
+class BenchException(Exception):
+    '''Exception thrown if a benchmarked command fails'''
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return str(self.value)
+
+def parse_size(size_str):
+    '''Parses a number of bytes with an optional K, M or G suffix'''
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
+    if size_str[-1:].upper() in units:
+        return int(float(size_str[:-1]) * units[size_str[-1:].upper()])
+    return int(size_str)
+
+def size_distribution(spec, max_size):
+    '''Returns a function of a random.Random returning file sizes for spec,
+       one of fixed:SIZE, uniform:MIN:MAX or lognormal:MEDIAN:SIGMA. Sizes
+       are capped at max_size.'''
+    fields = spec.split(':')
+    if fields[0] == 'fixed' and len(fields) == 2:
+        size = parse_size(fields[1])
+        return lambda rng: min(size, max_size)
+    elif fields[0] == 'uniform' and len(fields) == 3:
+        (low, high) = (parse_size(fields[1]), parse_size(fields[2]))
+        return lambda rng: min(rng.randint(low, high), max_size)
+    elif fields[0] == 'lognormal' and len(fields) == 3:
+        (median, sigma) = (parse_size(fields[1]), float(fields[2]))
+        return lambda rng: min(int(rng.lognormvariate(math.log(median), sigma)), max_size)
+    raise ValueError('Unknown size distribution %s' % spec)
+
+class TreeGenerator(object):
+    '''Writes a tree of depth levels below its root, each directory holding
+       files_per_dir files and fan_out subdirectories. With probability
+       dup_ratio a file repeats the contents of an earlier file, and a
+       directory is a copy of an earlier directory at the same depth.'''
+    def __init__(self, depth, fan_out, files_per_dir, size_func, dup_ratio, seed):
+        self.depth = depth
+        self.fan_out = fan_out
+        self.files_per_dir = files_per_dir
+        self.size_func = size_func
+        self.dup_ratio = dup_ratio
+        self.rng = random.Random(seed)
+        self.block = b''.join(struct.pack('<Q', self.rng.getrandbits(64))
+                              for i in range(CONTENT_BLOCK_SIZE // 8))
+        # (size, content id) of each distinct file
+        self.contents = []
+        # Generated directories at each depth and their (files, dirs, bytes)
+        self.dirs_by_depth = {}
+        self.totals = {}
+
+    def write_file(self, path, size, content_id):
+        '''Writes size bytes that are the same for the same content_id'''
+        data = struct.pack('<Q', content_id)
+        offset = content_id * 7919 % CONTENT_BLOCK_SIZE
+        with open(path, 'wb') as f:
+            f.write(data[:size])
+            left = size - len(data)
+            while left > 0:
+                chunk = self.block[offset:offset + left]
+                f.write(chunk)
+                left -= len(chunk)
+                offset = 0
+
+    def make_dir(self, path, level = 0):
+        '''Generates the tree at path, returning its (files, dirs, bytes)'''
+        os.mkdir(path)
+        (files, dirs, byte_count) = (0, 1, 0)
+        for n in range(self.files_per_dir):
+            if self.contents and self.rng.random() < self.dup_ratio:
+                (size, content_id) = self.rng.choice(self.contents)
+            else:
+                (size, content_id) = (self.size_func(self.rng), len(self.contents))
+                self.contents.append((size, content_id))
+            self.write_file(os.path.join(path, 'f%04d' % n), size, content_id)
+            files += 1
+            byte_count += size
+
+        if level < self.depth:
+            for n in range(self.fan_out):
+                subdir = os.path.join(path, 'd%03d' % n)
+                earlier = self.dirs_by_depth.setdefault(level + 1, [])
+                if earlier and self.rng.random() < self.dup_ratio:
+                    source = self.rng.choice(earlier)
+                    shutil.copytree(source, subdir)
+                    totals = self.totals[source]
+                else:
+                    totals = self.make_dir(subdir, level + 1)
+                    earlier.append(subdir)
+                files += totals[0]
+                dirs += totals[1]
+                byte_count += totals[2]
+
+        self.totals[path] = (files, dirs, byte_count)
+        return self.totals[path]
+
+def make_zfs_state(filename, datasets, snapshots, behind, written):
+    '''Writes a fake zfs state whose data pool holds datasets datasets of
+       snapshots snapshots each. bkup0 has all but the newest behind of
+       them and bkup1 the oldest half. Returns the source dataset names.'''
+    state = {'pools': {'data': {}, 'bkup0': {}, 'bkup1': {}}, 'datasets': {}}
+    next_id = [1]
+    def new_id():
+        next_id[0] += 1
+        return next_id[0]
+
+    names = []
+    for n in range(datasets):
+        name = 'ds%03d' % n
+        snaps = [{'name': (FIRST_SNAPSHOT_TIME + datetime.timedelta(hours = i)).strftime('%Y%m%d-%H%M'),
+                  'guid': new_id(), 'createtxg': new_id(), 'written': written}
+                 for i in range(snapshots)]
+        for (pool, count) in [('data', snapshots),
+                              ('bkup0', max(1, snapshots - behind)),
+                              ('bkup1', max(1, snapshots // 2))]:
+            state['datasets'][os.path.join(pool, name)] = {
+                'guid': new_id(), 'createtxg': new_id(),
+                'snapshots': [dict(snap, createtxg = new_id()) for snap in snaps[:count]]}
+        names.append(os.path.join('data', name))
+    state['next_id'] = new_id()
+    with open(filename, 'w') as f:
+        json.dump(state, f)
+    return names
+
+# Runs argv[2:] and writes its peak RSS to argv[1]. It is kept small because
+# the RSS of the process that forks the tool is included in the tool's.
+RSS_WRAPPER = '''import os, resource, sys
+pid = os.fork()
+if pid == 0:
+    try:
+        os.execvp(sys.argv[2], sys.argv[2:])
+    finally:
+        os._exit(127)
+status = os.waitpid(pid, 0)[1]
+with open(sys.argv[1], 'w') as f:
+    f.write('%d' % resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+sys.exit(os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1)
+'''
+
+def run(cmd, env = None):
+    '''Runs cmd, discarding its output, and returns (seconds, peak RSS in KB).
+       ru_maxrss is in KB on FreeBSD and Linux. The time includes starting
+       the wrapper, a few tens of milliseconds.'''
+    logging.debug('Running %s' % ' '.join(cmd))
+    with tempfile.NamedTemporaryFile() as rss_file, tempfile.TemporaryFile() as err, \
+         open(os.devnull, 'w') as devnull:
+        start = time.time()
+        returncode = subprocess.call([sys.executable, '-S', '-c', RSS_WRAPPER, rss_file.name] + cmd,
+                                     stdout = devnull, stderr = err, env = env)
+        elapsed = time.time() - start
+        if returncode != 0:
+            err.seek(0)
+            raise BenchException('%s failed with %d:\n%s' % (' '.join(cmd), returncode,
+                                                             err.read().decode('utf-8', 'replace')))
+        rss_file.seek(0)
+        rss = int(rss_file.read())
+    return (elapsed, rss)
+
+def read_phases(metrics_file):
+    '''Returns a dict of phase name to seconds from a --metrics JSON file'''
+    with open(metrics_file) as f:
+        snapshot = json.load(f)
+    phases = {}
+    for phase in snapshot['phases']:
+        phases[phase['phase']] = phases.get(phase['phase'], 0.0) + phase['seconds']
+    return phases
+
+def bench_scan(args, workdir, tree, totals):
+    '''Scans the tree, then rescans it with --incremental. The scan writes
+       a pickle only for bench_dups. make_tree_fingerprints.py rejects
+       --incremental and --pickle with --shards, so a sharded scan runs
+       once without a pickle.'''
+    (files, dirs, byte_count) = totals
+    db = os.path.join(workdir, 'scan.db')
+    sharded = any(arg.split('=')[0] == '--shards' for arg in args.scan_args)
+    pickle = []
+    if 'dups' in args.benchmarks and not sharded:
+        pickle = ['--pickle', os.path.join(workdir, 'scan.pickle')]
+    runs = [('scan', pickle)]
+    if not sharded:
+        runs.append(('rescan', pickle + ['--incremental']))
+    results = {}
+    for (name, extra) in runs:
+        metrics_file = os.path.join(workdir, '%s.json' % name)
+        cmd = [args.python2, os.path.join(SCRIPT_DIR, 'make_tree_fingerprints.py'),
+               '--db', db, '--index', os.path.join(workdir, 'scan.idx'),
+               '--metrics', metrics_file] + extra + args.scan_args + [tree]
+        (seconds, rss) = run(cmd)
+        results[name] = {'seconds': seconds,
+                         'files_per_sec': files / seconds,
+                         'mb_per_sec': byte_count / (1024.0 ** 2) / seconds,
+                         'peak_rss_kb': rss,
+                         'phases': read_phases(metrics_file)}
+    return results
+
+def bench_dups(args, workdir):
+    '''Lists duplicates from the database, index and, unless the scan was
+       sharded, pickle of bench_scan'''
+    results = {}
+    for (name, source) in [('dups_db', ['--db', 'scan.db']),
+                           ('dups_index', ['-i', 'scan.idx']),
+                           ('dups_pickle', ['-p', 'scan.pickle'])]:
+        if not os.path.exists(os.path.join(workdir, source[1])):
+            continue
+        metrics_file = os.path.join(workdir, '%s.json' % name)
+        cmd = [args.python2, os.path.join(SCRIPT_DIR, 'show_dups.py'),
+               source[0], os.path.join(workdir, source[1]), '-a', '--metrics', metrics_file]
+        (seconds, rss) = run(cmd)
+        phases = read_phases(metrics_file)
+        results[name] = {'seconds': seconds,
+                         'load_seconds': phases.get('load', 0.0),
+                         'query_seconds': phases.get('query', 0.0),
+                         'peak_rss_kb': rss}
+    return results
+
+def bench_db(args, workdir):
+    '''Runs bench_fingerprint_db.py'''
+    cmd = [args.python2, os.path.join(SCRIPT_DIR, 'bench_fingerprint_db.py'),
+           '--rows', str(args.db_rows), '--dir', workdir, '--json']
+    logging.debug('Running %s' % ' '.join(cmd))
+    return {'db_insert': json.loads(subprocess.check_output(cmd).decode('utf-8'))}
+
+def bench_plan(args, workdir):
+    '''Plans a backup of the generated datasets to two pools'''
+    state_file = os.path.join(workdir, 'zfs.json')
+    datasets = make_zfs_state(state_file, args.datasets, args.snapshots, args.behind,
+                              args.snapshot_size)
+    env = dict(os.environ,
+               FAKE_ZFS_STATE = state_file,
+               PATH = FAKE_ZFS_DIR + os.pathsep + os.environ.get('PATH', ''))
+    metrics_file = os.path.join(workdir, 'plan.json')
+    cmd = [args.python3, os.path.join(SCRIPT_DIR, 'backup.py'), '--plan',
+           '-d', 'bkup0', '-d', 'bkup1', '--state', os.path.join(workdir, 'state.json'),
+           '--metrics', metrics_file] + datasets
+    (seconds, rss) = run(cmd, env)
+    return {'plan': {'seconds': seconds,
+                     'peak_rss_kb': rss,
+                     'phases': read_phases(metrics_file)}}
+
+def git_revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                           cwd = SCRIPT_DIR, stderr = devnull).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def flatten(results, prefix = ''):
+    '''Returns a dict of dotted names to the numbers in nested results'''
+    flat = {}
+    for (key, value) in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+def compare(results_file):
+    '''Prints the results of the last two runs in results_file'''
+    with open(results_file) as f:
+        runs = [json.loads(line) for line in f if line.strip()]
+    if len(runs) < 2:
+        raise BenchException('%s holds %d runs, two are needed' % (results_file, len(runs)))
+    (old, new) = runs[-2:]
+    for run_result in (old, new):
+        print('%s %s %s' % (run_result['time'], run_result['revision'] or '-', run_result['label'] or ''))
+    if old['params'] != new['params']:
+        print('Warning: the runs have different parameters')
+    (old_flat, new_flat) = (flatten(old['results']), flatten(new['results']))
+    print('%-44s %14s %14s %8s' % ('METRIC', 'OLD', 'NEW', 'CHANGE'))
+    for key in sorted(set(old_flat) | set(new_flat)):
+        (a, b) = (old_flat.get(key), new_flat.get(key))
+        change = '%+0.1f%%' % (100.0 * (b - a) / a) if a and b is not None else '-'
+        print('%-44s %14s %14s %8s' % (key, '-' if a is None else '%0.3f' % a,
+                                       '-' if b is None else '%0.3f' % b, change))
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(message)s', level = logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmarks', nargs = '*', metavar = 'BENCHMARK',
+                        help = 'Benchmarks to run, from %s (default all). dups also runs scan.' % \
+                               ', '.join(BENCHMARKS))
+
+    parser.add_argument('--results', metavar = 'FILE', dest = 'results_file',
+                        default = DEFAULT_RESULTS_FILE,
+                        help = 'File the results are appended to (default %s)' % DEFAULT_RESULTS_FILE)
+
+    parser.add_argument('--compare', dest = 'compare',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Print the last two results in the results file instead of running')
+
+    parser.add_argument('--label', metavar = 'TEXT', dest = 'label',
+                        default = None,
+                        help = 'Description stored with the results')
+
+    parser.add_argument('--dir', metavar = 'DIR', dest = 'dir',
+                        default = None,
+                        help = 'Directory for the generated data, ideally on the disk being measured')
+
+    parser.add_argument('--python2', metavar = 'PATH', dest = 'python2',
+                        default = 'python',
+                        help = 'Interpreter for make_tree_fingerprints.py and show_dups.py')
+
+    parser.add_argument('--python3', metavar = 'PATH', dest = 'python3',
+                        default = 'python3',
+                        help = 'Interpreter for backup.py')
+
+    tree = parser.add_argument_group('generated tree')
+    tree.add_argument('--depth', metavar = 'N', type = int, default = 3,
+                      help = 'Levels of directories below the root (default 3)')
+    tree.add_argument('--fan-out', metavar = 'N', dest = 'fan_out', type = int, default = 4,
+                      help = 'Subdirectories per directory (default 4)')
+    tree.add_argument('--files-per-dir', metavar = 'N', dest = 'files_per_dir', type = int, default = 20,
+                      help = 'Files per directory (default 20)')
+    tree.add_argument('--sizes', metavar = 'DIST', dest = 'sizes', default = 'lognormal:16K:2',
+                      help = 'File size distribution: fixed:SIZE, uniform:MIN:MAX or '
+                             'lognormal:MEDIAN:SIGMA (default lognormal:16K:2)')
+    tree.add_argument('--max-file-size', metavar = 'SIZE', dest = 'max_file_size', default = '4M',
+                      help = 'Largest file generated (default 4M)')
+    tree.add_argument('--dup-ratio', metavar = 'R', dest = 'dup_ratio', type = float, default = 0.2,
+                      help = 'Fraction of files and directories that duplicate earlier ones '
+                             '(default 0.2)')
+    tree.add_argument('--seed', metavar = 'N', type = int, default = 1,
+                      help = 'Random seed (default 1)')
+    tree.add_argument('--scan-args', metavar = 'ARGS', dest = 'scan_args', default = '',
+                      help = 'Extra make_tree_fingerprints.py options, given as '
+                             '--scan-args="--bulk-load --workers 8"')
+
+    zfs = parser.add_argument_group('backup planning')
+    zfs.add_argument('--datasets', metavar = 'N', type = int, default = 10,
+                     help = 'Source datasets (default 10)')
+    zfs.add_argument('--snapshots', metavar = 'N', type = int, default = 2000,
+                     help = 'Snapshots per source dataset (default 2000)')
+    zfs.add_argument('--behind', metavar = 'N', type = int, default = 24,
+                     help = 'Snapshots bkup0 lacks of each dataset (default 24)')
+    zfs.add_argument('--snapshot-size', metavar = 'SIZE', dest = 'snapshot_size', default = '1M',
+                     help = 'Bytes written by each snapshot (default 1M)')
+
+    parser.add_argument('--db-rows', metavar = 'N', dest = 'db_rows', type = int, default = 100000,
+                        help = 'Rows written by the db benchmark (default 100000)')
+    args = parser.parse_args()
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error('Unknown benchmark %s' % ', '.join(unknown))
+    args.benchmarks = args.benchmarks or BENCHMARKS
+
+    try:
+        if args.compare:
+            compare(args.results_file)
+            sys.exit(0)
+
+        args.scan_args = args.scan_args.split()
+        args.snapshot_size = parse_size(args.snapshot_size)
+        params = dict((k, v) for (k, v) in vars(args).items()
+                      if k not in ('benchmarks', 'results_file', 'compare', 'label', 'dir'))
+        results = {}
+        workdir = tempfile.mkdtemp(prefix = 'fnas-bench-', dir = args.dir)
+        try:
+            if 'scan' in args.benchmarks or 'dups' in args.benchmarks:
+                tree_root = os.path.join(workdir, 'tree')
+                logging.info('Generating tree in %s.' % tree_root)
+                generator = TreeGenerator(args.depth, args.fan_out, args.files_per_dir,
+                                          size_distribution(args.sizes, parse_size(args.max_file_size)),
+                                          args.dup_ratio, args.seed)
+                totals = generator.make_dir(tree_root)
+                logging.info('Generated %d files in %d directories, %d bytes.' % totals)
+                results['tree'] = dict(zip(['files', 'dirs', 'bytes'], totals))
+
+                logging.info('Benchmarking make_tree_fingerprints.py.')
+                results.update(bench_scan(args, workdir, tree_root, totals))
+                if 'dups' in args.benchmarks:
+                    logging.info('Benchmarking show_dups.py.')
+                    results.update(bench_dups(args, workdir))
+            if 'db' in args.benchmarks:
+                logging.info('Benchmarking SQLite writes.')
+                results.update(bench_db(args, workdir))
+            if 'plan' in args.benchmarks:
+                logging.info('Benchmarking backup planning with %d datasets of %d snapshots.' % \
+                             (args.datasets, args.snapshots))
+                results.update(bench_plan(args, workdir))
+        finally:
+            shutil.rmtree(workdir)
+    except (BenchException, ValueError) as e:
+        logging.fatal(str(e))
+        sys.exit(1)
+
+    record = {'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+              'revision': git_revision(),
+              'host': socket.gethostname(),
+              'label': args.label,
+              'params': params,
+              'results': results}
+    with open(args.results_file, 'a') as f:
+        f.write(json.dumps(record, sort_keys = True) + '\n')
+
+    for (key, value) in sorted(flatten(results).items()):
+        print('%-44s %14.3f' % (key, value))
+    logging.info('Appended results to %s.' % args.results_file)
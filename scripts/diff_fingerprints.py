@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+'''Compares two trees recorded by make_tree_fingerprints, such as a dataset
+   and its backup, and lists the files added, removed and changed
+
+Directories are matched by their path relative to the scanned roots and
+compared top-down. A directory's hash covers everything below it, so a
+subtree whose hashes match is skipped without reading its rows, and the
+work done is proportional to the amount of change rather than the size
+of the tree.
+'''
+
+import argparse
+import logging
+import os.path
+import sqlite3
+import stat
+import sys
+
+import make_tree_fingerprints as mtf
+
+# Kinds of difference, as printed
+(ADDED,
+ REMOVED,
+ CHANGED,
+ UNVERIFIED) = ('A', 'D', 'M', '?')
+
+class DiffException(Exception):
+    '''Exception thrown if two databases can't be compared'''
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return str(self.value)
+
+def open_db(filename):
+    conn = sqlite3.connect(filename)
+    conn.text_factory = str
+    mtf.create_meta_table(conn.cursor())
+    mtf.fix_file_types(conn.cursor())
+    logging.info('Creating parent index of %s if needed.' % filename)
+    conn.execute('create index if not exists files_parent on files (parent)')
+    conn.commit()
+    return conn
+
+def find_root(conn, path = None):
+    '''Returns the (id, path) of the root directory scanned as path, or of the
+       most recently scanned root if path is None, from the latest run'''
+    if path is None:
+        row = conn.execute('''select id, path from files where parent is null and type = ?
+                              order by id desc limit 1''', (stat.S_IFDIR,)).fetchone()
+    else:
+        path = path.rstrip(os.sep) or os.sep
+        row = conn.execute('''select id, path from files where parent is null and type = ? and path = ?
+                              order by id desc limit 1''', (stat.S_IFDIR, path)).fetchone()
+    if row is None:
+        raise DiffException('No scanned root %sfound' % ('%s ' % path if path else ''))
+    return row
+
+def children(conn, dir_id):
+    '''Returns a dict of name to (id, path, type, hash, size, total_size, hash_level)
+       for the entries of a directory'''
+    rows = conn.execute('''select id, path, type, hash, size, total_size, hash_level from files
+                           where parent = ?''', (dir_id,))
+    return dict((os.path.basename(row[1]), row) for row in rows)
+
+def check_hash_algorithms(conn_a, conn_b):
+    '''Raises DiffException unless both databases use the same hash algorithm'''
+    algorithm_a = mtf.stored_hash_algorithm(conn_a.cursor())
+    algorithm_b = mtf.stored_hash_algorithm(conn_b.cursor())
+    if algorithm_a is not None and algorithm_b is not None and algorithm_a != algorithm_b:
+        raise DiffException('Databases hold %s and %s hashes, which can\'t be compared' % \
+                            (algorithm_a, algorithm_b))
+
+def diff_trees(conn_a, root_a, conn_b, root_b, stats):
+    '''Yields (kind, relative path, entry type, size) for each difference
+       between the trees below root_a and root_b. The differences within a
+       directory are listed by name, before those below its subdirectories.
+       Added and removed directories are reported once, with their total size.
+       Files whose contents could not be compared because one side lacks a
+       full hash (as in --dups-only) and whose sizes match are UNVERIFIED.'''
+    # Directories left to compare as (relative path, id in a, id in b)
+    stack = [('', root_a, root_b)]
+    while stack:
+        (rel_dir, id_a, id_b) = stack.pop()
+        stats['dirs_read'] += 1
+        entries_a = children(conn_a, id_a)
+        entries_b = children(conn_b, id_b)
+        subdirs = []
+        for name in sorted(set(entries_a) | set(entries_b)):
+            rel_path = os.path.join(rel_dir, name)
+            a = entries_a.get(name)
+            b = entries_b.get(name)
+            if b is None:
+                yield (REMOVED, rel_path, a[2], entry_size(a))
+            elif a is None:
+                yield (ADDED, rel_path, b[2], entry_size(b))
+            elif a[2] != b[2]:
+                yield (CHANGED, rel_path, b[2], entry_size(b))
+            elif a[2] == stat.S_IFDIR:
+                if a[3] is not None and a[3] == b[3]:
+                    stats['dirs_skipped'] += 1
+                else:
+                    subdirs.append((rel_path, a[0], b[0]))
+            else:
+                kind = compare_files(a, b)
+                if kind is not None:
+                    yield (kind, rel_path, b[2], entry_size(b))
+        stack.extend(reversed(subdirs))
+
+def compare_files(a, b):
+    '''Returns CHANGED, UNVERIFIED or None if the file rows a and b match'''
+    if a[4] != b[4]:
+        return CHANGED
+    if a[6] == b[6] and a[6] in (mtf.HASH_FULL, mtf.HASH_PARTIAL):
+        if a[3] != b[3]:
+            return CHANGED
+        elif a[6] == mtf.HASH_FULL:
+            return None
+    return UNVERIFIED
+
+def entry_size(row):
+    if row[2] == stat.S_IFDIR:
+        return row[5] or 0
+    return row[4] or 0
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(message)s', level = logging.INFO)
+
+    parser = argparse.ArgumentParser(description = 'Lists differences between two scanned '
+                                     'trees as A (added), D (removed), M (changed) or ? '
+                                     '(same size, contents not hashed)')
+    parser.add_argument('db_a', metavar = 'DB_A',
+                        help = 'Database of the original tree')
+
+    parser.add_argument('db_b', metavar = 'DB_B',
+                        help = 'Database of the tree to compare, such as a backup')
+
+    parser.add_argument('--root-a', metavar = 'PATH', dest = 'root_a',
+                        default = None,
+                        help = 'Scanned path to compare in DB_A (default the last scanned)')
+
+    parser.add_argument('--root-b', metavar = 'PATH', dest = 'root_b',
+                        default = None,
+                        help = 'Scanned path to compare in DB_B (default the last scanned)')
+
+    parser.add_argument('-s', dest = 'summary_only',
+                        action = "store_true",
+                        default = False,
+                        help = 'Only report whether the trees differ')
+
+    args = parser.parse_args()
+
+    stats = {'dirs_read': 0, 'dirs_skipped': 0}
+    counts = dict((kind, 0) for kind in (ADDED, REMOVED, CHANGED, UNVERIFIED))
+    try:
+        conn_a = open_db(args.db_a)
+        conn_b = open_db(args.db_b)
+        check_hash_algorithms(conn_a, conn_b)
+        (root_a, path_a) = find_root(conn_a, args.root_a)
+        (root_b, path_b) = find_root(conn_b, args.root_b)
+        logging.info('Comparing %s in %s with %s in %s' % (path_a, args.db_a, path_b, args.db_b))
+
+        for (kind, rel_path, entry_type, size) in diff_trees(conn_a, root_a, conn_b, root_b, stats):
+            counts[kind] += 1
+            if not args.summary_only:
+                print('%s %s %20s %s' % (kind, 'd' if entry_type == stat.S_IFDIR else '-',
+                                         mtf.pretty_bytes(size), rel_path))
+    except DiffException as e:
+        logging.fatal(str(e))
+        sys.exit(2)
+
+    logging.info('Read %d directories, skipped %d identical subtrees.' % \
+                 (stats['dirs_read'], stats['dirs_skipped']))
+    logging.info('%d added, %d removed, %d changed, %d unverified.' % \
+                 (counts[ADDED], counts[REMOVED], counts[CHANGED], counts[UNVERIFIED]))
+    sys.exit(1 if any(counts.values()) else 0)
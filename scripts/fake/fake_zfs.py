@@ -0,0 +1,534 @@
+#!/usr/bin/env python3
+'''Stand-in for the zfs, zpool and geli commands, for trying backup.py without ZFS
+
+Pools, datasets and snapshots are kept in a JSON state file named by the
+FAKE_ZFS_STATE environment variable. The script acts as the command it is
+invoked as, so put this directory first on PATH:
+
+    FAKE_ZFS_STATE=/tmp/zfs.json PATH=scripts/fake:$PATH scripts/backup.py -d bkup0 data/docs
+
+State file layout:
+
+    {"pools": {"data": {}, "bkup0": {}},
+     "datasets": {"data/docs": {"guid": 1, "createtxg": 1,
+                                "snapshots": [{"name": "20240101-0000", "guid": 2,
+                                               "createtxg": 2, "written": 65536}]}},
+     "next_id": 3}
+
+"written" is the number of bytes a snapshot contributes to a send stream.
+A dataset's own "written" (default 65536) is what zfs list -o written
+reports as written since its latest snapshot, and what zfs snapshot gives
+the next snapshot.
+A snapshot may also have a "diff" list of the changes zfs diff reports
+since the previous snapshot, such as [["M", "/data/docs/a"],
+["R", "/data/docs/b", "/data/docs/c"]]. A dataset's "mountpoint"
+defaults to /NAME.
+A send stream is a JSON header line followed by that many bytes for each
+snapshot it carries, and receive applies it only if all of them arrive.
+
+Setting FAKE_ZFS_INTERRUPT_AFTER=BYTES makes zfs send fail after writing
+that many bytes of payload, as if the stream was interrupted. zfs receive -s
+then keeps a receive_resume_token on the destination, which zfs send -t
+resumes from and zfs receive -A discards. zfs send -nv -t prints the
+token's contents, including its toname and toguid, like the real command.
+Setting FAKE_ZFS_FAIL to a command and subcommand, such as "zfs send",
+makes that command fail with an I/O error, as a busy or failing pool would.
+
+zfs destroy takes snapshot lists such as data/docs@a,b%d like the real
+command, where b%d is every snapshot from b to d.
+
+A pool with "exported": true in its entry is hidden until zpool import,
+which needs the pool's "device" (default /dev/label/NAME) to have been
+attached with geli attach. Setting FAKE_ZFS_DELAY=SECONDS makes geli
+attach and detach and zpool import and export take that long, without
+holding the state lock, so several can run at once. A pool's "health"
+(default ONLINE) is what zpool list reports for it.
+'''
+
+import base64
+import fcntl
+import json
+import os
+import sys
+import time
+
+DEFAULT_WRITTEN = 64 * 1024
+DEVICE_ROOT = '/dev/label'
+STREAM_CHUNK_SIZE = 64 * 1024
+
+class FakeZfsError(Exception):
+    '''A failure reported on stderr with a non-zero exit code'''
+    pass
+
+class State(object):
+    '''The JSON state file, locked for the lifetime of the object'''
+    def __init__(self):
+        self.path = os.environ.get('FAKE_ZFS_STATE')
+        if not self.path:
+            raise FakeZfsError('FAKE_ZFS_STATE is not set')
+        self.lock = open(self.path + '.lock', 'w')
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.data = json.load(f)
+        else:
+            self.data = {}
+        self.data.setdefault('pools', {})
+        self.data.setdefault('datasets', {})
+        self.data.setdefault('next_id', 1)
+        # The root dataset of each pool
+        missing = [pool for pool in self.data['pools'] if pool not in self.datasets]
+        for pool in missing:
+            self.create_dataset(pool)
+        if missing:
+            self.save()
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.data, f, indent = 1, sort_keys = True)
+        os.rename(tmp, self.path)
+
+    def close(self):
+        self.lock.close()
+
+    def new_id(self):
+        value = self.data['next_id']
+        self.data['next_id'] += 1
+        return value
+
+    @property
+    def datasets(self):
+        return self.data['datasets']
+
+    def imported(self, dataset):
+        '''Returns whether the pool of a dataset is imported'''
+        pool = self.data['pools'].get(dataset.split('/', 1)[0])
+        return pool is not None and not pool.get('exported')
+
+    def dataset(self, name):
+        if name not in self.datasets or not self.imported(name):
+            raise FakeZfsError("cannot open '%s': dataset does not exist" % name)
+        return self.datasets[name]
+
+    def create_dataset(self, name):
+        parent = name.rsplit('/', 1)[0]
+        if '/' not in name:
+            if name not in self.data['pools']:
+                raise FakeZfsError("cannot open '%s': no such pool" % name)
+        elif parent not in self.datasets:
+            raise FakeZfsError("cannot open '%s': dataset does not exist" % parent)
+        ds = {'guid': self.new_id(), 'createtxg': self.new_id(), 'snapshots': []}
+        self.datasets[name] = ds
+        return ds
+
+    def snapshot(self, full_name):
+        (dataset, snap) = split_snapshot(full_name)
+        for s in self.dataset(dataset)['snapshots']:
+            if s['name'] == snap:
+                return s
+        raise FakeZfsError("cannot open '%s': dataset does not exist" % full_name)
+
+def split_snapshot(full_name):
+    if '@' not in full_name:
+        raise FakeZfsError("'%s' is not a snapshot" % full_name)
+    return tuple(full_name.split('@', 1))
+
+def parse_flags(args, flags_with_values):
+    '''Splits args into a dict of flags and a list of operands. Combined
+       single letter flags such as -Hp are expanded.'''
+    opts = {}
+    operands = []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg.startswith('-') and len(arg) > 1:
+            letters = arg[1:]
+            for n, letter in enumerate(letters):
+                flag = '-' + letter
+                if flag in flags_with_values:
+                    value = letters[n + 1:]
+                    if not value:
+                        i += 1
+                        value = args[i]
+                    opts[flag] = value
+                    break
+                opts[flag] = True
+        else:
+            operands.append(arg)
+        i += 1
+    return (opts, operands)
+
+def zfs_list(state, args):
+    (opts, names) = parse_flags(args, ['-t', '-o', '-s', '-S', '-d'])
+    types = opts.get('-t', 'filesystem').split(',')
+    if 'all' in types:
+        types = ['filesystem', 'volume', 'snapshot']
+    columns = opts.get('-o', 'name,used,avail,refer,mountpoint').split(',')
+    recursive = '-r' in opts
+
+    for name in names:
+        if '@' in name:
+            state.snapshot(name)
+        elif name not in state.datasets or not state.imported(name):
+            raise FakeZfsError("cannot open '%s': dataset does not exist" % name)
+
+    def selected(ds_name):
+        return not names or any(ds_name == n or (recursive and ds_name.startswith(n + '/'))
+                                for n in names)
+
+    rows = []
+    for ds_name in sorted(state.datasets):
+        if not selected(ds_name) or not state.imported(ds_name):
+            continue
+        ds = state.datasets[ds_name]
+        if 'filesystem' in types:
+            rows.append(dict(ds, name = ds_name, mountpoint = ds.get('mountpoint', '/' + ds_name),
+                             written = ds.get('written', DEFAULT_WRITTEN)))
+        if 'snapshot' in types:
+            for snap in sorted(ds['snapshots'], key = lambda s: s['createtxg']):
+                rows.append(dict(snap, name = '%s@%s' % (ds_name, snap['name'])))
+
+    for row in rows:
+        print('\t'.join(str(row.get(c, '-')) for c in columns))
+
+def zfs_snapshot(state, args):
+    created = []
+    for full_name in args:
+        (dataset, snap) = split_snapshot(full_name)
+        ds = state.dataset(dataset)
+        if any(s['name'] == snap for s in ds['snapshots']):
+            raise FakeZfsError("cannot create snapshot '%s': dataset already exists" % full_name)
+        created.append((ds, snap))
+    for (ds, snap) in created:
+        ds['snapshots'].append({'name': snap, 'guid': state.new_id(),
+                                'createtxg': state.new_id(),
+                                'written': ds.pop('written', DEFAULT_WRITTEN)})
+    state.save()
+
+def send_header(state, opts, full_name):
+    '''Returns the header of the stream zfs send would produce'''
+    (dataset, snap) = split_snapshot(full_name)
+    ds = state.dataset(dataset)
+    snaps = sorted(ds['snapshots'], key = lambda s: s['createtxg'])
+    end = state.snapshot(full_name)
+    upto = [s for s in snaps if s['createtxg'] <= end['createtxg']]
+
+    header = {'toname': full_name, 'fromname': None, 'base_guid': None, 'offset': 0}
+    base = opts.get('-I') or opts.get('-i')
+    if base:
+        if '@' not in base:
+            base = '%s@%s' % (dataset, base)
+        base_snap = state.snapshot(base)
+        sent = [s for s in upto if s['createtxg'] > base_snap['createtxg']]
+        if '-i' in opts:
+            sent = sent[-1:]
+        header['fromname'] = base
+        header['base_guid'] = base_snap['guid']
+    else:
+        sent = upto if '-R' in opts else upto[-1:]
+    header['snapshots'] = sent
+    return header
+
+def stream_size(header):
+    return sum(s.get('written', DEFAULT_WRITTEN) for s in header['snapshots'])
+
+def make_token(header, offset):
+    resume = dict(header, offset = offset)
+    return '1-' + base64.urlsafe_b64encode(json.dumps(resume).encode('utf-8')).decode('ascii')
+
+def decode_token(token):
+    try:
+        return json.loads(base64.urlsafe_b64decode(token[2:].encode('ascii')).decode('utf-8'))
+    except ValueError:
+        raise FakeZfsError('cannot resume send: malformed resume token')
+
+def print_token(header):
+    '''Prints the contents of a resume token the way zfs send -nv -t does'''
+    print('resume token contents:')
+    print('nvlist version: 0')
+    print('\toffset = 0x%x' % header['offset'])
+    if header['base_guid'] is not None:
+        print('\tfromguid = 0x%x' % header['base_guid'])
+    print('\ttoguid = 0x%x' % header['snapshots'][-1]['guid'])
+    print('\ttoname = %s' % header['toname'])
+
+def parse_token(state, token):
+    '''Returns the header of a resumed stream, checking its snapshots still exist'''
+    header = decode_token(token)
+    for name in (header['toname'], header['fromname']):
+        if name is not None:
+            try:
+                state.snapshot(name)
+            except FakeZfsError:
+                raise FakeZfsError("cannot resume send: '%s' used in the initial send no longer exists" % name)
+    return header
+
+def zfs_send(state, args):
+    (opts, operands) = parse_flags(args, ['-I', '-i', '-t'])
+    if '-t' in opts:
+        if '-n' in opts and '-v' in opts:
+            print_token(decode_token(opts['-t']))
+        header = parse_token(state, opts['-t'])
+    else:
+        header = send_header(state, opts, operands[-1])
+    state.close()
+
+    remaining = stream_size(header) - header['offset']
+    if '-n' in opts:
+        if '-P' in opts:
+            print('size\t%d' % remaining)
+        return
+
+    interrupt_after = os.environ.get('FAKE_ZFS_INTERRUPT_AFTER')
+    limit = int(interrupt_after) if interrupt_after else None
+
+    out = sys.stdout.buffer
+    out.write((json.dumps(header) + '\n').encode('utf-8'))
+    chunk = b'\0' * STREAM_CHUNK_SIZE
+    while remaining > 0:
+        n = min(remaining, STREAM_CHUNK_SIZE)
+        if limit is not None and n >= limit:
+            out.write(chunk[:limit])
+            out.flush()
+            raise FakeZfsError('warning: cannot send \'%s\': I/O error' % header['toname'])
+        out.write(chunk[:n])
+        remaining -= n
+        if limit is not None:
+            limit -= n
+    out.flush()
+
+def zfs_receive(state, args):
+    (opts, operands) = parse_flags(args, [])
+    dest = operands[-1]
+    if '-A' in opts:
+        abort_resumable(state, dest)
+        return
+    state.close()
+
+    stream = sys.stdin.buffer
+    line = stream.readline()
+    if not line:
+        raise FakeZfsError('cannot receive: failed to read from stream')
+    header = json.loads(line.decode('utf-8'))
+    expected = stream_size(header) - header['offset']
+    received = 0
+    while True:
+        data = stream.read(STREAM_CHUNK_SIZE)
+        if not data:
+            break
+        received += len(data)
+
+    state = State()
+    try:
+        if received < expected:
+            if '-s' in opts:
+                save_resumable(state, dest, header, header['offset'] + received)
+            raise FakeZfsError('cannot receive new filesystem stream: checksum mismatch or incomplete stream.')
+        apply_stream(state, opts, dest, header)
+    finally:
+        state.close()
+
+def save_resumable(state, dest, header, offset):
+    '''Keeps a partially received stream on dest so it can be resumed'''
+    if dest not in state.datasets:
+        if header['base_guid'] is not None:
+            return
+        state.create_dataset(dest)['partial_new'] = True
+    state.datasets[dest]['receive_resume_token'] = make_token(header, offset)
+    state.save()
+
+def abort_resumable(state, dest):
+    ds = state.dataset(dest)
+    if 'receive_resume_token' not in ds:
+        raise FakeZfsError("'%s' does not have any resumable receive state to abort" % dest)
+    del ds['receive_resume_token']
+    if ds.pop('partial_new', False) and not ds['snapshots']:
+        del state.datasets[dest]
+    state.save()
+
+def apply_stream(state, opts, dest, header):
+    '''Adds the snapshots of a completely received stream to dest'''
+    if dest in state.datasets:
+        ds = state.datasets[dest]
+        token = ds.get('receive_resume_token')
+        if header['offset'] > 0:
+            if token is None or parse_token(state, token)['toname'] != header['toname']:
+                raise FakeZfsError("cannot receive resume stream: destination '%s' has no matching "
+                                   "resumable state" % dest)
+            del ds['receive_resume_token']
+        elif token is not None:
+            raise FakeZfsError("cannot receive new filesystem stream: destination %s contains "
+                               "partially-complete state from \"zfs receive -s\"." % dest)
+
+        if ds.pop('partial_new', False):
+            pass
+        elif header['base_guid'] is None:
+            raise FakeZfsError("cannot receive new filesystem stream: destination '%s' exists" % dest)
+        else:
+            dest_snaps = sorted(ds['snapshots'], key = lambda s: s['createtxg'])
+            if not dest_snaps or dest_snaps[-1]['guid'] != header['base_guid']:
+                if '-F' in opts and any(s['guid'] == header['base_guid'] for s in dest_snaps):
+                    # Roll back to the base snapshot
+                    base = [s['guid'] for s in dest_snaps].index(header['base_guid'])
+                    ds['snapshots'] = dest_snaps[:base + 1]
+                else:
+                    raise FakeZfsError("cannot receive incremental stream: most recent snapshot of "
+                                       "'%s' does not match incremental source" % dest)
+    else:
+        if header['base_guid'] is not None:
+            raise FakeZfsError("cannot receive incremental stream: destination '%s' does not exist" % dest)
+        ds = state.create_dataset(dest)
+
+    for snap in header['snapshots']:
+        received_snap = dict(snap)
+        received_snap['createtxg'] = state.new_id()
+        ds['snapshots'].append(received_snap)
+    state.save()
+
+def zfs_diff(state, args):
+    (opts, operands) = parse_flags(args, [])
+    (dataset, snap) = split_snapshot(operands[0])
+    start = state.snapshot(operands[0])['createtxg']
+    if len(operands) > 1:
+        end = state.snapshot(operands[1])['createtxg']
+    else:
+        end = None
+    for snap in sorted(state.dataset(dataset)['snapshots'], key = lambda s: s['createtxg']):
+        if snap['createtxg'] > start and (end is None or snap['createtxg'] <= end):
+            for change in snap.get('diff', []):
+                print('\t'.join(change))
+
+def zfs_destroy(state, args):
+    '''Destroys DATASET@SNAPSHOTS, where SNAPSHOTS is a comma separated list
+       of names and FIRST%LAST ranges of snapshots in creation order. Either
+       end of a range may be left out to mean the oldest or newest snapshot.
+       Names that don't exist are ignored, as long as something is destroyed.'''
+    (opts, operands) = parse_flags(args, [])
+    for full_name in operands:
+        (dataset, spec) = split_snapshot(full_name)
+        ds = state.dataset(dataset)
+        names = [s['name'] for s in sorted(ds['snapshots'], key = lambda s: s['createtxg'])]
+        doomed = set()
+        for item in spec.split(','):
+            if '%' in item:
+                (first, last) = item.split('%', 1)
+                for end in (first, last):
+                    if end and end not in names:
+                        raise FakeZfsError("cannot destroy '%s': snapshot %s does not exist" % \
+                                           (full_name, end))
+                start = names.index(first) if first else 0
+                stop = names.index(last) if last else len(names) - 1
+                doomed.update(names[start:stop + 1])
+            elif item in names:
+                doomed.add(item)
+        if not doomed:
+            raise FakeZfsError('could not find any snapshots to destroy; check snapshot names.')
+        ds['snapshots'] = [s for s in ds['snapshots'] if s['name'] not in doomed]
+    state.save()
+
+def zpool_list(state, args):
+    (opts, names) = parse_flags(args, ['-o'])
+    for name in names:
+        if not state.imported(name):
+            raise FakeZfsError("cannot open '%s': no such pool" % name)
+    columns = opts.get('-o', 'name,size,alloc,free,ckpoint,expandsz,frag,dedup,health,altroot').split(',')
+    for name in sorted(state.data['pools']):
+        if state.imported(name) and (not names or name in names):
+            values = {'name': name, 'dedup': '1.00x',
+                      'health': state.data['pools'][name].get('health', 'ONLINE')}
+            print('\t'.join(values.get(c, '-') for c in columns))
+
+def zpool_status(state, args):
+    (opts, names) = parse_flags(args, [])
+    for name in names:
+        if not state.imported(name):
+            raise FakeZfsError("cannot open '%s': no such pool" % name)
+    print('all pools are healthy')
+
+def pool_device(state, name):
+    return state.data['pools'][name].get('device', os.path.join(DEVICE_ROOT, name))
+
+def zpool_import(state, args):
+    (opts, names) = parse_flags(args, [])
+    for name in names:
+        pool = state.data['pools'].get(name)
+        if pool is None or not pool.get('exported') or \
+           pool_device(state, name) not in state.data.get('geli', []):
+            raise FakeZfsError("cannot import '%s': no such pool available" % name)
+        pool['exported'] = False
+    state.save()
+
+def zpool_export(state, args):
+    (opts, names) = parse_flags(args, [])
+    for name in names:
+        if not state.imported(name):
+            raise FakeZfsError("cannot open '%s': no such pool" % name)
+        state.data['pools'][name]['exported'] = True
+    state.save()
+
+def geli_attach(state, args):
+    (opts, providers) = parse_flags(args, ['-k', '-j'])
+    attached = state.data.setdefault('geli', [])
+    for provider in providers:
+        if provider in attached:
+            raise FakeZfsError('geli: Provider %s.eli already exists.' % os.path.basename(provider))
+        attached.append(provider)
+    state.save()
+
+def geli_detach(state, args):
+    (opts, providers) = parse_flags(args, [])
+    attached = state.data.setdefault('geli', [])
+    for provider in providers:
+        if provider not in attached:
+            raise FakeZfsError('geli: No such device: %s.' % provider)
+        if any(pool_device(state, name) == provider and state.imported(name)
+               for name in state.data['pools']):
+            raise FakeZfsError('geli: Cannot destroy device %s.eli (error=16).' % os.path.basename(provider))
+        attached.remove(provider)
+    state.save()
+
+COMMANDS = {
+    'zfs': {'list': zfs_list,
+            'snapshot': zfs_snapshot,
+            'send': zfs_send,
+            'receive': zfs_receive,
+            'recv': zfs_receive,
+            'destroy': zfs_destroy,
+            'diff': zfs_diff},
+    'zpool': {'list': zpool_list,
+              'status': zpool_status,
+              'import': zpool_import,
+              'export': zpool_export},
+    'geli': {'attach': geli_attach,
+             'detach': geli_detach},
+}
+
+# Commands that take FAKE_ZFS_DELAY seconds
+SLOW_COMMANDS = [('geli', 'attach'), ('geli', 'detach'), ('zpool', 'import'), ('zpool', 'export')]
+
+def main(argv):
+    command = os.path.basename(argv[0])
+    if command not in COMMANDS or len(argv) < 2 or argv[1] not in COMMANDS[command]:
+        sys.stderr.write('%s: unsupported command: %s\n' % (command, ' '.join(argv[1:])))
+        return 2
+    delay = os.environ.get('FAKE_ZFS_DELAY')
+    if delay and (command, argv[1]) in SLOW_COMMANDS:
+        time.sleep(float(delay))
+    if os.environ.get('FAKE_ZFS_FAIL') == '%s %s' % (command, argv[1]):
+        sys.stderr.write('%s %s: I/O error\n' % (command, argv[1]))
+        return 1
+    state = None
+    try:
+        state = State()
+        COMMANDS[command][argv[1]](state, argv[2:])
+    except FakeZfsError as e:
+        sys.stderr.write('%s\n' % e)
+        return 1
+    finally:
+        if state is not None:
+            state.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
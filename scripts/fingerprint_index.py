@@ -0,0 +1,164 @@
+'''Compact, memory-mappable index of directory fingerprints
+
+The index holds one fixed-width record per directory with its id, parent
+id, raw hash bytes, total size and the location of its path in a string
+table. Records are sorted by descending total size and then by hash, so
+directories with the same hash are adjacent and the largest duplicates
+come first. A second table of record numbers sorted by id allows parent
+lookups by binary search. Readers mmap the file and decode records only
+as they are visited.
+
+Layout (all integers little-endian):
+    header      HEADER_FORMAT
+    records     record_count * RECORD_FORMAT (hash padded to MAX_HASH_SIZE)
+    id order    record_count * uint32 record numbers, sorted by id
+    strings     utf-8 paths, not terminated
+'''
+
+import binascii
+import collections
+import mmap
+import struct
+
+MAGIC = b'FNASIDX1'
+# magic, hash size, record count, id order offset, string table offset
+HEADER_FORMAT = '<8sIQQQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+MAX_HASH_SIZE = 64
+# id, parent id (-1 for a root), hash, total size, path offset, path length
+RECORD_FORMAT = '<qq%dsQQI4x' % MAX_HASH_SIZE
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+ID_ORDER_FORMAT = '<I'
+ID_ORDER_SIZE = struct.calcsize(ID_ORDER_FORMAT)
+
+DirRecord = collections.namedtuple('DirRecord', ['id', 'parent', 'hash', 'total_size', 'path'])
+
+class IndexException(Exception):
+    '''Exception thrown if an index file is not valid'''
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return str(self.value)
+
+def write_index(filename, rows):
+    '''Writes an index from a sequence of (id, parent, hash, total_size, path)
+       directory rows. rows must be a callable returning a fresh iterator over
+       the rows sorted by descending total_size and then hash, since the rows
+       are visited twice: once for the records and once for the paths.'''
+    hash_size = None
+    ids = []
+    path_offset = 0
+    with open(filename, 'wb') as f:
+        f.write(b'\0' * HEADER_SIZE)
+        for (dir_id, parent, hash_str, total_size, path) in rows():
+            hash_bytes = binascii.unhexlify(hash_str)
+            if hash_size is None:
+                hash_size = len(hash_bytes)
+            elif hash_size != len(hash_bytes):
+                raise IndexException('Mixed hash sizes in index rows')
+            path_bytes = _encode_path(path)
+            f.write(struct.pack(RECORD_FORMAT,
+                                dir_id,
+                                -1 if parent is None else parent,
+                                hash_bytes,
+                                total_size,
+                                path_offset,
+                                len(path_bytes)))
+            ids.append(dir_id)
+            path_offset += len(path_bytes)
+
+        id_order_offset = f.tell()
+        for record_no in sorted(range(len(ids)), key = ids.__getitem__):
+            f.write(struct.pack(ID_ORDER_FORMAT, record_no))
+
+        strings_offset = f.tell()
+        for row in rows():
+            f.write(_encode_path(row[4]))
+
+        f.seek(0)
+        f.write(struct.pack(HEADER_FORMAT, MAGIC, hash_size or 0, len(ids),
+                            id_order_offset, strings_offset))
+
+def _encode_path(path):
+    if isinstance(path, bytes):
+        return path
+    return path.encode('utf-8', 'surrogateescape')
+
+class FingerprintIndex(object):
+    '''Read-only view of an index file'''
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+        except ValueError:
+            raise IndexException('%s is empty' % filename)
+        if len(self.map) < HEADER_SIZE:
+            raise IndexException('%s is too short to be an index' % filename)
+        (magic, self.hash_size, self.record_count,
+         self.id_order_offset, self.strings_offset) = struct.unpack_from(HEADER_FORMAT, self.map, 0)
+        if magic != MAGIC:
+            raise IndexException('%s is not a fingerprint index' % filename)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.record_count
+
+    def record(self, record_no):
+        '''Returns the DirRecord stored at record_no'''
+        (dir_id, parent, hash_bytes, total_size,
+         path_offset, path_len) = struct.unpack_from(RECORD_FORMAT, self.map,
+                                                     HEADER_SIZE + record_no * RECORD_SIZE)
+        start = self.strings_offset + path_offset
+        path = self.map[start:start + path_len]
+        hash_str = binascii.hexlify(hash_bytes[:self.hash_size])
+        if not isinstance(path, str):
+            path = path.decode('utf-8', 'surrogateescape')
+            hash_str = hash_str.decode('ascii')
+        return DirRecord(dir_id,
+                         None if parent < 0 else parent,
+                         hash_str,
+                         total_size,
+                         path)
+
+    def records(self):
+        '''Yields all records, largest first'''
+        for record_no in range(self.record_count):
+            yield self.record(record_no)
+
+    def find_id(self, dir_id):
+        '''Returns the DirRecord with the given id, or None'''
+        (lo, hi) = (0, self.record_count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record_no = struct.unpack_from(ID_ORDER_FORMAT, self.map,
+                                           self.id_order_offset + mid * ID_ORDER_SIZE)[0]
+            mid_id = struct.unpack_from('<q', self.map, HEADER_SIZE + record_no * RECORD_SIZE)[0]
+            if mid_id < dir_id:
+                lo = mid + 1
+            elif mid_id > dir_id:
+                hi = mid
+            else:
+                return self.record(record_no)
+        return None
+
+    def duplicate_groups(self):
+        '''Yields lists of records sharing a hash, largest directories first'''
+        group = []
+        for record in self.records():
+            if group and group[0].hash != record.hash:
+                if len(group) > 1:
+                    yield group
+                group = []
+            group.append(record)
+        if len(group) > 1:
+            yield group
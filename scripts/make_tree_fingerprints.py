@@ -1,13 +1,46 @@
 #!/usr/bin/env python
-'''Creates sha256 hashes of files and directories'''
+'''Creates hashes of files and directories (sha256 unless --hash is given)'''
 
 import hashlib
+import io
+import json
+import mmap
 import os
 import sqlite3
 import argparse
 import stat
 import cPickle
 import logging
+import time
+import collections
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+import fingerprint_index
+import metrics
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    # blake2 for Python versions whose hashlib lacks it
+    import pyblake2
+except ImportError:
+    pyblake2 = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 # Directory entry indexes
 (D_IDX_ID, 
@@ -26,12 +59,62 @@ import logging
  F_IDX_STAT,
  F_IDX_HASH) = range(5)
 
+# Kinds of entries waiting to be written
+(PENDING_DIR,
+ PENDING_FILE,
+ PENDING_DIR_END) = range(3)
+
 BYTES_PER_LOG_MESSAGE = 1024 * 1024 * 1024
 FILES_PER_COMMIT = 1000
+BULK_BATCH_SIZE = 5000
+BULK_ROWS_PER_COMMIT = 200000
+BULK_CACHE_SIZE_KB = 256 * 1024
 HASH_READ_BLOCKSIZE = 1024 * 1024
+PARTIAL_HASH_BLOCKSIZE = 64 * 1024
+DEFAULT_HASH_WORKERS = 4
+DEFAULT_QUEUE_DEPTH = 256
+DEFAULT_INDEX_FILE = 'treedata.idx'
+DEFAULT_HASH_ALGORITHM = 'sha256'
+DEFAULT_ENCODING = 'utf-8'
+IGNORE_FILE = '.fingerprintignore'
 
 last_log_bytes = 0
 
+# Hash algorithm names and their constructors. Variable length digests
+# (shake) are left out since their hex digests need a length.
+HASH_ALGORITHMS = dict((name, getattr(hashlib, name))
+                       for name in getattr(hashlib, 'algorithms_guaranteed', hashlib.algorithms)
+                       if not name.startswith('shake_'))
+if pyblake2 is not None:
+    HASH_ALGORITHMS.setdefault('blake2b', pyblake2.blake2b)
+    HASH_ALGORITHMS.setdefault('blake2s', pyblake2.blake2s)
+
+# Hashing settings, set from the command line
+hash_algorithm = DEFAULT_HASH_ALGORITHM
+read_blocksize = HASH_READ_BLOCKSIZE
+mmap_threshold = 0
+
+# Read buffer of each hashing thread, reused for every file
+read_buffers = threading.local()
+
+# Timings and counters of this run, and the progress towards the size of
+# the previous scan of the same paths if there was one
+run_metrics = metrics.Metrics('fnas_fingerprint')
+progress = metrics.Progress()
+
+# How much of a file the hash column covers
+(HASH_NONE,     # not hashed; the size is unique so it can't have a duplicate
+ HASH_PARTIAL,  # first and last PARTIAL_HASH_BLOCKSIZE bytes only
+ HASH_FULL) = range(3)
+
+# Columns added to the files table after its original definition
+FILES_ADDED_COLUMNS = [('inode', 'integer'),
+                       ('ctime', 'real'),
+                       ('hash_level', 'integer')]
+
+# Bits of st_mode holding the file type, as returned by stat.S_IFMT
+FILE_TYPE_MASK = 0o170000
+
 def pretty_bytes(bytes):
     '''Print bytes in friendly units'''
     (MB, GB) = (1024**2, 1024**3)
@@ -40,22 +123,644 @@ def pretty_bytes(bytes):
     else:
         return '%0.2f MB' % (float(bytes) / MB)
 
-def log_progress(cur_path, file_count, byte_count) :
+def pretty_duration(seconds):
+    if seconds is None:
+        return '?'
+    seconds = int(seconds + 0.5)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def log_progress(cur_path, file_count, byte_count, skipped_byte_count = 0) :
     global last_log_bytes
     if (byte_count - last_log_bytes > BYTES_PER_LOG_MESSAGE):
         last_log_bytes = byte_count
-        logging.info('%s bytes read, %d files, processing: %s' % (pretty_bytes(byte_count), file_count, cur_path))
+        logging.info('%s bytes read (%s/s), %d files, ETA %s, processing: %s' % (
+                     pretty_bytes(byte_count), pretty_bytes(progress.rate(byte_count)), file_count,
+                     pretty_duration(progress.eta(byte_count + skipped_byte_count)), cur_path))
  
-def compute_dir_hashes(dir_entry, cursor, hash_dict):
-    '''Computes hashes for directories'''
-    if len(dir_entry[D_IDX_CHILD_DIRS]) > 0:
-        # compute hashes for all children
-        for child_dir in dir_entry[D_IDX_CHILD_DIRS]:
-            logging.debug('Recurse %s' % child_dir[D_IDX_PATH])
-            compute_dir_hashes(child_dir, cursor, hash_dict)
+def create_files_table(cursor):
+    '''Creates the files table if it does not exist and adds any missing columns'''
+    cursor.execute('''create table if not exists files 
+                        (id     integer primary key asc autoincrement, 
+                         parent integer references files (id),
+                         path   text,
+                         type   integer,
+                         mode   integer,
+                         uid    integer,
+                         gid    integer,
+                         nlink  integer,
+                         hash   text,
+                         size   integer,
+                         mtime  real,
+                         total_size integer,
+                         inode  integer,
+                         ctime  real,
+                         hash_level integer)''')
+
+    # Tables created by older versions lack the newer columns
+    cursor.execute('pragma table_info(files)')
+    columns = [row[1] for row in cursor.fetchall()]
+    for name, col_type in FILES_ADDED_COLUMNS:
+        if name not in columns:
+            logging.info('Adding column %s to files table' % name)
+            cursor.execute('alter table files add column %s %s' % (name, col_type))
+            if name == 'hash_level':
+                # Older versions always computed full hashes
+                cursor.execute('update files set hash_level = ? where hash is not null', (HASH_FULL,))
+
+def create_meta_table(cursor):
+    cursor.execute('''create table if not exists meta
+                        (key   text primary key,
+                         value text)''')
+
+def fix_file_types(cursor):
+    '''Older versions stored each file row with the type of its parent
+       directory. Sets the type of every row from its mode, once per
+       database. Needs the meta table.'''
+    cursor.execute("select 1 from meta where key = 'file_types_fixed'")
+    if cursor.fetchone():
+        return
+    cursor.execute("select name from sqlite_master where type = 'table' and name = 'prev_files'")
+    tables = ['files'] + [row[0] for row in cursor.fetchall()]
+    for table in tables:
+        cursor.execute('''update %s set type = mode & ? where mode is not null
+                          and type is not mode & ?''' % table, (FILE_TYPE_MASK, FILE_TYPE_MASK))
+        if cursor.rowcount > 0:
+            logging.info('Corrected the type of %d rows in %s.' % (cursor.rowcount, table))
+    cursor.execute("insert or replace into meta (key, value) values ('file_types_fixed', '1')")
+
+def stored_hash_algorithm(cursor):
+    '''Returns the hash algorithm of the hashes in the database, or None if
+       there are none yet. Databases from before the algorithm was recorded
+       hold sha256 hashes.'''
+    cursor.execute("select value from meta where key = 'hash_algorithm'")
+    row = cursor.fetchone()
+    if row is not None:
+        return row[0]
+    cursor.execute('select 1 from files where hash is not null limit 1')
+    if cursor.fetchone():
+        return 'sha256'
+    return None
+
+def previous_total_size(cursor, paths):
+    '''Returns the total size of the latest scan of paths, or None if one of
+       them has not been scanned or its directory hash was not computed'''
+    total = 0
+    for path in paths:
+        cursor.execute('''select total_size from files where parent is null and type = ? and path = ?
+                          order by id desc limit 1''', (stat.S_IFDIR, path.rstrip(os.sep) or os.sep))
+        row = cursor.fetchone()
+        if row is None or row[0] is None:
+            return None
+        total += row[0]
+    return total
+
+def record_hash_algorithm(cursor, name):
+    cursor.execute("insert or replace into meta (key, value) values ('hash_algorithm', ?)", (name,))
+
+def enclosing_root(cursor, path):
+    '''Returns a root scanned by an earlier run that contains path below
+       it, or None. An incremental run can't replace part of such a tree,
+       since the root's hash would not be recomputed.'''
+    cursor.execute('select distinct path from files where parent is null and type = ?', (stat.S_IFDIR,))
+    for (root,) in cursor.fetchall():
+        if root != path and path.startswith(root.rstrip(os.sep) + os.sep):
+            return root
+    return None
+
+def begin_incremental(cursor, paths):
+    '''Moves the rows of earlier runs below paths to prev_files so that
+       unchanged files can reuse their hashes. Rows of other trees stay.'''
+    paths = [path.rstrip(os.sep) or os.sep for path in paths]
+    cursor.execute("select name from sqlite_master where type = 'table' and name = 'prev_files'")
+    if cursor.fetchone():
+        # An earlier incremental run was interrupted. Its previous rows are
+        # still intact, so discard its partial results and put them back.
+        logging.info('Discarding results of an interrupted incremental run.')
+        cursor.execute("select value from meta where key = 'incremental_paths'")
+        row = cursor.fetchone()
+        for path in json.loads(row[0]) if row else []:
+            (condition, params) = subtree_condition(path.rstrip(os.sep) or os.sep)
+            cursor.execute('delete from files where ' + condition, params)
+        cursor.execute('insert into files select * from prev_files')
+        cursor.execute('drop table prev_files')
+
+    cursor.execute('create table prev_files as select * from files where 0')
+    for path in paths:
+        (condition, params) = subtree_condition(path)
+        cursor.execute('insert into prev_files select * from files where ' + condition, params)
+        cursor.execute('delete from files where ' + condition, params)
+    cursor.execute("insert or replace into meta (key, value) values ('incremental_paths', ?)",
+                   (json.dumps(paths),))
+    cursor.execute('create index if not exists prev_files_path on prev_files (path)')
+
+def end_incremental(cursor):
+    '''Drops the rows of the previous run once the new run is complete'''
+    cursor.execute('drop table prev_files')
+    cursor.execute("delete from meta where key = 'incremental_paths'")
+
+def previous_hash(cursor, path, pstat):
+    '''Returns the hash recorded for path by the previous run, or None
+       if the file is new or its size, mtime, inode or ctime changed'''
+    cursor.execute('''select size, mtime, inode, ctime, hash, hash_level from prev_files
+                      where path = ? order by id desc limit 1''', (path,))
+    row = cursor.fetchone()
+    if row is None or row[4] is None or row[5] != HASH_FULL:
+        return None
+    if tuple(row[:4]) != (pstat.st_size, pstat.st_mtime, pstat.st_ino, pstat.st_ctime):
+        return None
+    return row[4]
+
+def new_hash():
+    '''Returns a new hash object of the selected algorithm'''
+    return HASH_ALGORITHMS[hash_algorithm]()
+
+def read_buffer():
+    '''Returns this thread's read buffer of read_blocksize bytes'''
+    buf = getattr(read_buffers, 'buf', None)
+    if buf is None or len(buf) != read_blocksize:
+        buf = read_buffers.buf = bytearray(read_blocksize)
+    return buf
+
+def hash_file(path):
+    '''Returns the hex digest of a file's contents and the number of bytes read.
+       Blocks are read into a reused buffer, except that files of at least
+       mmap_threshold bytes (if non-zero) are mapped and hashed in place.'''
+    h = new_hash()
+    bytes_read = 0
+    with io.open(path, 'rb', buffering = 0) as f:
+        size = os.fstat(f.fileno()).st_size
+        if mmap_threshold and size >= mmap_threshold:
+            # Reads happen as page faults while hashing
+            with run_metrics.phase('mmap_hash'):
+                m = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+                try:
+                    h.update(m)
+                    bytes_read = len(m)
+                finally:
+                    m.close()
+        else:
+            buf = read_buffer()
+            view = memoryview(buf)
+            (read_seconds, hash_seconds, reads) = (0.0, 0.0, 1)
+            start = time.time()
+            count = f.readinto(buf)
+            while count:
+                hash_start = time.time()
+                read_seconds += hash_start - start
+                h.update(view[:count])
+                start = time.time()
+                hash_seconds += start - hash_start
+                bytes_read += count
+                reads += 1
+                count = f.readinto(buf)
+            read_seconds += time.time() - start
+            run_metrics.add_time('read', read_seconds)
+            run_metrics.add_time('hash', hash_seconds)
+            run_metrics.count('read_calls', reads)
+    run_metrics.count('files_hashed')
+    run_metrics.count('bytes_read', bytes_read)
+    return (h.hexdigest(), bytes_read)
+
+def hash_file_ends(path):
+    '''Returns the hex digest of the first and last PARTIAL_HASH_BLOCKSIZE
+       bytes of a file and the number of bytes read'''
+    h = new_hash()
+    with run_metrics.phase('partial_hash'):
+        with open(path, 'rb') as f:
+            head = f.read(PARTIAL_HASH_BLOCKSIZE)
+            h.update(head)
+            size = os.fstat(f.fileno()).st_size
+            f.seek(max(len(head), size - PARTIAL_HASH_BLOCKSIZE))
+            tail = f.read(PARTIAL_HASH_BLOCKSIZE)
+            h.update(tail)
+    run_metrics.count('read_calls', 2)
+    run_metrics.count('bytes_read', len(head) + len(tail))
+    return (h.hexdigest(), len(head) + len(tail))
+
+def glob_to_regex(pattern):
+    '''Translates a glob to a regular expression. * and ? do not match /,
+       ** matches anything and [...] matches a character class.'''
+    regex = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**', i):
+            regex.append('.*')
+            i += 1
+        elif c == '*':
+            regex.append('[^/]*')
+        elif c == '?':
+            regex.append('[^/]')
+        elif c == '[' and pattern.find(']', i + 2) > 0:
+            end = pattern.find(']', i + 2)
+            chars = pattern[i + 1:end].replace('\\', '\\\\')
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            regex.append('[%s]' % chars)
+            i = end
+        else:
+            regex.append(re.escape(c))
+        i += 1
+    return ''.join(regex)
+
+class Excluder(object):
+    '''Decides which paths a scan skips. A pattern containing a / matches
+       the whole path, relative to base if one is given; other patterns
+       match the name of any entry. A trailing / restricts a pattern to
+       directories. All patterns are compiled into one regular expression
+       per kind, so matching costs the same however many there are.
+       globs holds the patterns in force with those of ignore files made
+       absolute, so another process can rebuild the same Excluder.'''
+    def __init__(self, patterns = (), base = None, parent = None):
+        # (path patterns, name patterns) for all entries and for directories only
+        self.patterns = dict((key, list(parent.patterns[key]) if parent else [])
+                             for key in ('path', 'name', 'dir_path', 'dir_name'))
+        self.globs = list(parent.globs) if parent else []
+        for pattern in patterns:
+            dirs_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            if not pattern:
+                continue
+            if '/' in pattern:
+                if base is not None:
+                    pattern = os.path.join(base, pattern.lstrip('/'))
+                kind = 'path'
+            else:
+                kind = 'name'
+            self.patterns[('dir_' if dirs_only else '') + kind].append(glob_to_regex(pattern))
+            self.globs.append(pattern + ('/' if dirs_only else ''))
+        self.compiled = dict((key, re.compile('(?:%s)\\Z' % '|'.join(regexes)) if regexes else None)
+                             for key, regexes in self.patterns.items())
+
+    def excluded(self, path, name, is_dir):
+        for kind, value in (('path', path), ('name', name)):
+            for key in (kind, 'dir_' + kind) if is_dir else (kind,):
+                if self.compiled[key] is not None and self.compiled[key].match(value):
+                    return True
+        return False
+
+    def with_ignore_file(self, dirpath):
+        '''Returns an Excluder adding the patterns of dirpath's ignore file,
+           which apply below dirpath'''
+        with open(os.path.join(dirpath, IGNORE_FILE)) as f:
+            return Excluder(read_patterns(f), dirpath, self)
+
+def read_patterns(lines):
+    '''Returns the patterns of an ignore file, skipping blank lines and comments'''
+    return [line.strip() for line in lines if line.strip() and not line.lstrip().startswith('#')]
+
+def list_dir(dirpath):
+    '''Returns (name, lstat result, is a directory, is a link to a directory) for
+       each entry of dirpath, stat'ing each entry once through scandir if it is
+       available'''
+    entries = []
+    if scandir is not None:
+        for entry in scandir(dirpath):
+            st = entry.stat(follow_symlinks = False)
+            is_link_dir = stat.S_ISLNK(st.st_mode) and entry.is_dir()
+            entries.append((entry.name, st, stat.S_ISDIR(st.st_mode), is_link_dir))
+    else:
+        for name in os.listdir(dirpath):
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            is_link_dir = stat.S_ISLNK(st.st_mode) and os.path.isdir(path)
+            entries.append((name, st, stat.S_ISDIR(st.st_mode), is_link_dir))
+    return entries
+
+def walk_tree(root, excluder):
+    '''Walks a tree top-down like os.walk, yielding (dirpath, stat, subdirs, files)
+       for each directory, where subdirs and files are sorted lists of (name,
+       lstat result). Subdirectories deleted from subdirs are not visited.
+       Links to directories are left out, as os.walk lists them with the
+       directories but does not descend into them. Excluded entries are left
+       out, and ignore files found along the way add to the excludes below
+       their directory.'''
+    if excluder.excluded(root, os.path.basename(root), True):
+        logging.info('Skipping %s' % root)
+        return
+    stack = [(root, os.lstat(root), excluder)]
+    while stack:
+        (dirpath, dstat, excluder) = stack.pop()
+        try:
+            with run_metrics.phase('walk'):
+                entries = list_dir(dirpath)
+        except OSError as e:
+            logging.warning('Skipping %s: %s' % (dirpath, e))
+            continue
+        run_metrics.count('dirs_listed')
+        run_metrics.count('stat_calls', len(entries))
+        if any(entry[0] == IGNORE_FILE for entry in entries):
+            excluder = excluder.with_ignore_file(dirpath)
+
+        subdirs = []
+        files = []
+        for (name, st, is_dir, is_link_dir) in entries:
+            if is_link_dir:
+                continue
+            path = os.path.join(dirpath, name)
+            if excluder.excluded(path, name, is_dir):
+                if is_dir:
+                    logging.info('Skipping %s' % path)
+                else:
+                    logging.debug('Skipping %s' % path)
+            elif is_dir:
+                subdirs.append((name, st))
+            else:
+                files.append((name, st))
+        subdirs.sort()
+        files.sort()
+        yield (dirpath, dstat, subdirs, files)
+
+        for (name, st) in reversed(subdirs):
+            stack.append((os.path.join(dirpath, name), st, excluder))
+
+class HashJob(object):
+    '''A file queued for hashing by a HashPool'''
+    def __init__(self, path, device, func):
+        self.path = path
+        self.device = device
+        self.func = func
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.value = self.func(self.path)
+        except Exception as e:
+            # Raised again in the thread waiting for the result
+            self.error = e
+        finally:
+            self.done.set()
+
+    def result(self):
+        '''Waits for the job and returns (hash_str, bytes_read), raising
+           any exception the job raised'''
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class HashPool(object):
+    '''Hashes files on worker threads. hashlib releases the GIL while
+       hashing, so several workers keep both the disks and the CPUs busy.
+       At most per_device jobs run at once against the same st_dev (0 is
+       unlimited). With no workers, jobs are hashed as they are submitted.'''
+    def __init__(self, workers, queue_depth, per_device = 0):
+        self.per_device = per_device
+        self.device_semaphores = {}
+        self.semaphore_lock = threading.Lock()
+        self.jobs = queue.Queue(queue_depth)
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target = self._work, name = 'hash-%d' % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, path, device, func = hash_file):
+        '''Queues a file to be hashed by func, blocking while the queue is full'''
+        job = HashJob(path, device, func)
+        if self.threads:
+            self.jobs.put(job)
+        else:
+            job.run()
+        return job
+
+    def close(self):
+        '''Stops the workers once all queued jobs are finished'''
+        for t in self.threads:
+            self.jobs.put(None)
+        for t in self.threads:
+            t.join()
+
+    def _device_semaphore(self, device):
+        with self.semaphore_lock:
+            if device not in self.device_semaphores:
+                self.device_semaphores[device] = threading.BoundedSemaphore(self.per_device)
+            return self.device_semaphores[device]
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            if self.per_device > 0:
+                with self._device_semaphore(job.device):
+                    job.run()
+            else:
+                job.run()
+
+def next_file_id(cursor):
+    '''Returns the id AUTOINCREMENT would assign to the next row of the files table'''
+    cursor.execute('select coalesce(max(id), 0) from files')
+    max_id = cursor.fetchone()[0]
+    cursor.execute("select seq from sqlite_sequence where name = 'files'")
+    row = cursor.fetchone()
+    if row is not None:
+        max_id = max(max_id, row[0])
+    return max_id + 1
+
+class RowWriter(object):
+    '''Writes rows to the files table in batches with executemany. Ids are
+       assigned here rather than by SQLite, in the same sequence AUTOINCREMENT
+       would use, so a row's id is known before its batch is written.
+       Inserts are always written before updates, which may refer to them.'''
+    def __init__(self, conn, batch_size = 1, rows_per_commit = FILES_PER_COMMIT):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.batch_size = batch_size
+        self.rows_per_commit = rows_per_commit
+        self.next_id = next_file_id(self.cursor)
+        self.inserts = []
+        self.hash_updates = []
+        self.dir_updates = []
+        self.uncommitted = 0
+        self.row_count = 0
+
+    def insert(self, parent_id, path, st, hash_str):
+        '''Queues a file or directory row and returns its id'''
+        file_id = self.next_id
+        self.next_id += 1
+        self.inserts.append((file_id,
+                             parent_id,
+                             path,
+                             stat.S_IFMT(st.st_mode),
+                             st.st_mode,
+                             st.st_uid,
+                             st.st_gid,
+                             st.st_nlink,
+                             hash_str,
+                             st.st_size,
+                             st.st_mtime,
+                             st.st_ino,
+                             st.st_ctime,
+                             HASH_NONE if hash_str is None else HASH_FULL))
+        self._row_added()
+        return file_id
+
+    def update_hash(self, file_id, hash_str, hash_level):
+        '''Queues an update of a file's hash'''
+        self.hash_updates.append((hash_str, hash_level, file_id))
+        self._row_added()
+
+    def update_dir(self, dir_id, hash_str, total_size):
+        '''Queues an update of a directory's hash and total size'''
+        self.dir_updates.append((hash_str, total_size, HASH_FULL, dir_id))
+        self._row_added()
+
+    def flush(self):
+        '''Writes all queued rows'''
+        with run_metrics.phase('sqlite_write'):
+            self._write()
+
+    def _write(self):
+        if self.inserts:
+            self.cursor.executemany('''insert into files (id, parent, path, type, mode, uid, gid, nlink,
+                                                          hash, size, mtime, inode, ctime, hash_level)
+                                       values (?,?,?,?,?,?,?,?,?,?,?,?,?,?)''', self.inserts)
+            self.inserts = []
+        if self.hash_updates:
+            self.cursor.executemany('update files set hash = ?, hash_level = ? where id = ?',
+                                    self.hash_updates)
+            self.hash_updates = []
+        if self.dir_updates:
+            self.cursor.executemany('update files set hash = ?, total_size = ?, hash_level = ? where id = ?',
+                                    self.dir_updates)
+            self.dir_updates = []
+
+    def commit(self):
+        '''Writes all queued rows and commits the transaction'''
+        self.flush()
+        with run_metrics.phase('sqlite_commit'):
+            self.conn.commit()
+        self.uncommitted = 0
+
+    def _row_added(self):
+        self.row_count += 1
+        self.uncommitted += 1
+        if self.uncommitted >= self.rows_per_commit:
+            self.commit()
+        elif len(self.inserts) + len(self.hash_updates) + len(self.dir_updates) >= self.batch_size:
+            self.flush()
+
+def begin_bulk_load(conn):
+    '''Tunes the connection for loading many rows and drops the indexes of
+       the files table. Returns the statements to recreate the indexes.'''
+    conn.execute('pragma journal_mode = wal')
+    conn.execute('pragma synchronous = normal')
+    conn.execute('pragma cache_size = -%d' % BULK_CACHE_SIZE_KB)
+    conn.execute('pragma temp_store = memory')
+
+    index_sql = [row for row in conn.execute('''select name, sql from sqlite_master
+                                                where type = 'index' and tbl_name = 'files'
+                                                and sql is not null''')]
+    for (name, sql) in index_sql:
+        logging.info('Dropping index %s until loading is complete.' % name)
+        conn.execute('drop index %s' % name)
+    conn.commit()
+    return [sql for (name, sql) in index_sql]
+
+def end_bulk_load(conn, index_sql):
+    '''Rebuilds the indexes of the files table after loading'''
+    for sql in index_sql:
+        logging.info('Rebuilding index: %s' % sql)
+        conn.execute(sql)
+    logging.info('Building hash index.')
+    conn.execute('create index if not exists files_hash_type on files (hash, type)')
+    conn.commit()
+
+def write_candidate_hash(writer, candidate):
+    '''Records the hash of a pending duplicate candidate and returns the number of bytes read'''
+    (file_id, level, hash_str, job) = candidate
+    bytes_read = 0
+    if job is not None:
+        with run_metrics.phase('hash_wait'):
+            (hash_str, bytes_read) = job.result()
+    writer.update_hash(file_id, hash_str, level)
+    return bytes_read
+
+def hash_duplicate_candidates(writer, rows, hash_pool, partial, queue_depth, reuse_previous):
+    '''Hashes the (id, path, size) rows and records the hashes in the files table.
+       If partial is set, only the ends of files larger than two partial blocks
+       are hashed. Returns the number of bytes read.'''
+    bytes_read = 0
+    pending = collections.deque()
+    for (file_id, path, size) in rows:
+        try:
+            st = os.lstat(path)
+        except OSError as e:
+            logging.warning('Skipping %s: %s' % (path, e))
+            continue
+
+        if partial and size > 2 * PARTIAL_HASH_BLOCKSIZE:
+            (func, level) = (hash_file_ends, HASH_PARTIAL)
+        else:
+            (func, level) = (hash_file, HASH_FULL)
+
+        hash_str = None
+        if reuse_previous and level == HASH_FULL:
+            hash_str = previous_hash(writer.cursor, path, st)
+
+        job = None
+        if hash_str is None:
+            job = hash_pool.submit(path, st.st_dev, func)
+        pending.append((file_id, level, hash_str, job))
+        while len(pending) > queue_depth:
+            bytes_read += write_candidate_hash(writer, pending.popleft())
+
+    while pending:
+        bytes_read += write_candidate_hash(writer, pending.popleft())
+    writer.flush()
+    return bytes_read
+
+def find_duplicate_files(writer, first_id, hash_pool, queue_depth, reuse_previous):
+    '''Hashes only the regular files with id >= first_id that may have a duplicate.
+       Files are grouped by size, then the ends of each file in a size group
+       are hashed, then files whose size and partial hash still collide are
+       hashed in full. Returns the number of bytes read.'''
+    cursor = writer.conn.cursor()
+    writer.flush()
+    cursor.execute('''select id, path, size from files
+                      where id >= ? and type = ? and size in
+                        (select size from files where id >= ? and type = ?
+                         group by size having count(*) > 1)
+                      order by size, id''', (first_id, stat.S_IFREG, first_id, stat.S_IFREG))
+    rows = cursor.fetchall()
+    logging.info('Hashing the ends of %d files with non-unique sizes.' % len(rows))
+    bytes_read = hash_duplicate_candidates(writer, rows, hash_pool, True, queue_depth, reuse_previous)
+
+    cursor.execute('''select f.id, f.path, f.size from files f
+                      join (select size, hash from files where id >= ? and hash_level = ?
+                            group by size, hash having count(*) > 1) d
+                        on f.size = d.size and f.hash = d.hash
+                      where f.id >= ? and f.hash_level = ?
+                      order by f.size, f.id''', (first_id, HASH_PARTIAL, first_id, HASH_PARTIAL))
+    rows = cursor.fetchall()
+    logging.info('Hashing %d files whose ends collide in full.' % len(rows))
+    bytes_read += hash_duplicate_candidates(writer, rows, hash_pool, False, queue_depth, reuse_previous)
+    return bytes_read
+
+def finish_dir(dir_entry, writer, hash_dict = None, keep_children = False, hash_dirs = True):
+    '''Computes the hash of a directory whose files and subdirectories have
+       all been hashed, then releases its children unless keep_children is
+       set. A directory holding an unhashed file is not hashed, and none are
+       if hash_dirs is not set (as in --dups-only). If hash_dict is given,
+       the path is added under its hash.'''
+    child_files = dir_entry[D_IDX_CHILD_FILES]
+    child_dirs = dir_entry[D_IDX_CHILD_DIRS]
+    if not keep_children:
+        dir_entry[D_IDX_CHILD_FILES] = []
+        dir_entry[D_IDX_CHILD_DIRS] = []
+
+    if not hash_dirs:
+        return
+    if any(f[F_IDX_HASH] is None for f in child_files) or \
+       any(d[D_IDX_HASH] is None for d in child_dirs):
+        return
 
     # hash all child file and directory hashes
-    h = hashlib.sha256()
+    h = new_hash()
 
     # Size of a directory is the recursive sum of all child files and child directories
     total_size = 0
@@ -63,14 +768,12 @@ def compute_dir_hashes(dir_entry, cursor, hash_dict):
     logging.debug('Hashing %s..' % dir_entry[D_IDX_PATH])
     
     # hash the hashes of all child files in alpha order of their names
-    for file_ent in dir_entry[D_IDX_CHILD_FILES]:
-        assert file_ent[F_IDX_HASH] is not None
+    for file_ent in child_files:
         h.update(file_ent[F_IDX_HASH])
         total_size += file_ent[F_IDX_STAT].st_size
 
     # hash the hashes of all child dirs in alpha order of their names
-    for child in dir_entry[D_IDX_CHILD_DIRS]:
-        assert child[D_IDX_HASH] is not None
+    for child in child_dirs:
         h.update(child[D_IDX_HASH])
         total_size += child[D_IDX_TOTAL_SIZE]
 
@@ -78,9 +781,278 @@ def compute_dir_hashes(dir_entry, cursor, hash_dict):
     dir_entry[D_IDX_HASH] = hash_str
     dir_entry[D_IDX_TOTAL_SIZE] = total_size
     logging.debug('Hash for %s is %s' % (dir_entry[D_IDX_PATH], dir_entry[D_IDX_HASH]))
-    hash_dict.setdefault(hash_str, []).append(dir_entry[D_IDX_PATH]) 
-    cursor.execute('update files set hash = ?, total_size = ? where id = ?',
-                   (hash_str, total_size, dir_entry[D_IDX_ID]))
+    if hash_dict is not None:
+        hash_dict.setdefault(hash_str, []).append(dir_entry[D_IDX_PATH]) 
+    writer.update_dir(dir_entry[D_IDX_ID], hash_str, total_size)
+
+# Kinds of change reported by zfs diff
+(ZFS_DIFF_REMOVED,
+ ZFS_DIFF_CREATED,
+ ZFS_DIFF_MODIFIED,
+ ZFS_DIFF_RENAMED) = ('-', '+', 'M', 'R')
+
+ZfsChange = collections.namedtuple('ZfsChange', ['kind', 'path', 'new_path'])
+
+def zfs_unescape(path):
+    '''Decodes the \\0ooo octal escapes zfs diff uses for unusual characters'''
+    return re.sub(r'\\0([0-7]{3})', lambda m: chr(int(m.group(1), 8)), path)
+
+def zfs_diff(old_snapshot, new_snapshot):
+    '''Returns the ZfsChanges between two snapshots of a dataset, from zfs diff -H'''
+    cmd_list = ['zfs', 'diff', '-H', old_snapshot, new_snapshot]
+    with run_metrics.phase('zfs_diff'):
+        diff_str = subprocess.check_output(cmd_list)
+    changes = []
+    for line in diff_str.splitlines():
+        fields = line.split('\t')
+        if isinstance(line, bytes) and not isinstance(line, str):
+            fields = [f.decode(DEFAULT_ENCODING, 'surrogateescape') for f in fields]
+        new_path = zfs_unescape(fields[2]) if len(fields) > 2 else None
+        changes.append(ZfsChange(fields[0], zfs_unescape(fields[1]), new_path))
+    return changes
+
+def zfs_snapshot_root(snapshot):
+    '''Returns (mountpoint, directory holding the snapshot's files) for a
+       dataset snapshot. The directory is the mountpoint itself if the
+       snapshot is not reachable under .zfs.'''
+    (dataset, snap_name) = snapshot.split('@', 1)
+    mountpoint = subprocess.check_output(['zfs', 'list', '-H', '-o', 'mountpoint', dataset])
+    mountpoint = mountpoint.decode(DEFAULT_ENCODING).strip()
+    snapshot_dir = os.path.join(mountpoint, '.zfs', 'snapshot', snap_name)
+    if os.path.isdir(snapshot_dir):
+        return (mountpoint, snapshot_dir)
+    logging.warning('%s is not accessible. Reading the live files in %s.' % (snapshot_dir, mountpoint))
+    return (mountpoint, mountpoint)
+
+def find_row(cursor, path):
+    '''Returns (id, type) of the newest row for path, or None'''
+    cursor.execute('select id, type from files where path = ? order by id desc limit 1', (path,))
+    return cursor.fetchone()
+
+def subtree_condition(path):
+    '''Returns a where clause and its parameters matching path and everything below it'''
+    prefix = path.rstrip(os.sep) + os.sep
+    # os.sep is followed by chr(ord(os.sep) + 1) in sort order
+    return ('(path = ? or (path >= ? and path < ?))',
+            (path, prefix, prefix[:-1] + chr(ord(os.sep) + 1)))
+
+def mark_dirty(cursor, dirty, dir_id):
+    '''Adds dir_id and its ancestors to the dict of directory id to path
+       whose hashes must be recomputed'''
+    while dir_id is not None and dir_id not in dirty:
+        cursor.execute('select parent, path from files where id = ?', (dir_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return
+        dirty[dir_id] = row[1]
+        dir_id = row[0]
+
+def update_row_stat(cursor, file_id, st):
+    cursor.execute('''update files set type = ?, mode = ?, uid = ?, gid = ?, nlink = ?,
+                                        size = ?, mtime = ?, inode = ?, ctime = ?
+                      where id = ?''', (stat.S_IFMT(st.st_mode), st.st_mode, st.st_uid, st.st_gid,
+                                        st.st_nlink, st.st_size, st.st_mtime, st.st_ino,
+                                        st.st_ctime, file_id))
+
+def rehash_dir(cursor, dir_id):
+    '''Recomputes the hash and total size of a directory from the rows of
+       its children, the same way finish_dir does while scanning'''
+    cursor.execute('''select type, hash, size, total_size from files
+                      where parent = ? order by path''', (dir_id,))
+    rows = cursor.fetchall()
+    # Like finish_dir, a directory holding an unhashed entry is not hashed
+    (hash_str, total_size) = (None, None)
+    if all(row[1] is not None for row in rows):
+        (h, total_size) = (new_hash(), 0)
+        for (file_type, child_hash, size, child_total) in rows:
+            if file_type != stat.S_IFDIR:
+                h.update(child_hash)
+                total_size += size
+        for (file_type, child_hash, size, child_total) in rows:
+            if file_type == stat.S_IFDIR:
+                h.update(child_hash)
+                total_size += child_total
+        hash_str = h.hexdigest()
+    cursor.execute('update files set hash = ?, total_size = ?, hash_level = ? where id = ?',
+                   (hash_str, total_size, HASH_FULL if hash_str else HASH_NONE, dir_id))
+
+def update_from_zfs_diff(conn, old_snapshot, new_snapshot, hash_pool):
+    '''Brings the rows of a tree scanned at the mountpoint of a dataset up to
+       date with new_snapshot, given that they matched old_snapshot. Only
+       the paths zfs diff reports are read and hashed, and only their
+       ancestor directories are rehashed. Returns (changes, bytes read).'''
+    changes = zfs_diff(old_snapshot, new_snapshot)
+    (mountpoint, read_root) = zfs_snapshot_root(new_snapshot)
+    logging.info('%d changes between %s and %s.' % (len(changes), old_snapshot, new_snapshot))
+
+    def read_path(path):
+        return read_root + path[len(mountpoint):]
+
+    cursor = conn.cursor()
+    cursor.execute('create index if not exists files_path on files (path)')
+    cursor.execute('create index if not exists files_parent on files (parent)')
+    writer = RowWriter(conn)
+    dirty = {}
+
+    # Removals and renames first, so created paths can reuse the names
+    refresh = set()
+    for change in changes:
+        if change.kind == ZFS_DIFF_REMOVED:
+            row = find_row(cursor, change.path)
+            if row is not None:
+                cursor.execute('select parent from files where id = ?', (row[0],))
+                mark_dirty(cursor, dirty, cursor.fetchone()[0])
+                (condition, params) = subtree_condition(change.path)
+                cursor.execute('delete from files where ' + condition, params)
+        elif change.kind == ZFS_DIFF_RENAMED:
+            row = find_row(cursor, change.path)
+            new_parent = find_row(cursor, os.path.dirname(change.new_path))
+            if row is None or new_parent is None:
+                refresh.add(change.new_path)
+                continue
+            cursor.execute('select parent from files where id = ?', (row[0],))
+            mark_dirty(cursor, dirty, cursor.fetchone()[0])
+            (condition, params) = subtree_condition(change.path)
+            cursor.execute('update files set path = ? || substr(path, ?) where ' + condition,
+                           (change.new_path, len(change.path) + 1) + params)
+            cursor.execute('update files set parent = ? where id = ?', (new_parent[0], row[0]))
+            refresh.add(change.new_path)
+        else:
+            refresh.add(change.path)
+    for dir_id in list(dirty):
+        # Ids of removed directories
+        cursor.execute('select 1 from files where id = ?', (dir_id,))
+        if cursor.fetchone() is None:
+            del dirty[dir_id]
+
+    # Parents sort before their children
+    jobs = []
+    for path in sorted(refresh):
+        try:
+            st = os.lstat(read_path(path))
+        except OSError as e:
+            logging.warning('Skipping %s: %s' % (path, e))
+            continue
+        if stat.S_ISLNK(st.st_mode) and os.path.isdir(read_path(path)):
+            # os.walk lists these with the directories without descending, so scans skip them
+            continue
+
+        row = find_row(cursor, path)
+        if row is None:
+            parent = find_row(cursor, os.path.dirname(path))
+            if parent is None:
+                logging.warning('Skipping %s, its directory is not in the database.' % path)
+                continue
+            (file_id, parent_id) = (writer.insert(parent[0], path, st, None), parent[0])
+            writer.flush()
+        else:
+            file_id = row[0]
+            update_row_stat(cursor, file_id, st)
+            cursor.execute('select parent from files where id = ?', (file_id,))
+            parent_id = cursor.fetchone()[0]
+        mark_dirty(cursor, dirty, parent_id)
+
+        if stat.S_ISREG(st.st_mode):
+            jobs.append((file_id, hash_pool.submit(read_path(path), st.st_dev)))
+        elif stat.S_ISDIR(st.st_mode):
+            mark_dirty(cursor, dirty, file_id)
+        else:
+            writer.update_hash(file_id, new_hash().hexdigest(), HASH_FULL)
+
+    bytes_read = 0
+    for (file_id, job) in jobs:
+        with run_metrics.phase('hash_wait'):
+            (hash_str, count) = job.result()
+        writer.update_hash(file_id, hash_str, HASH_FULL)
+        bytes_read += count
+    writer.flush()
+
+    logging.info('Rehashing %d directories.' % len(dirty))
+    with run_metrics.phase('dir_hash'):
+        for dir_id in sorted(dirty, key = lambda d: dirty[d].count(os.sep), reverse = True):
+            rehash_dir(cursor, dir_id)
+    writer.commit()
+    return (len(changes), bytes_read)
+
+def plan_shards(paths, shards, excluder):
+    '''Returns (directory, Excluder) for each directory to scan in a separate
+       process: the roots themselves if there are at least as many roots as
+       shards, otherwise the top-level subdirectories of each root. The
+       Excluder of a subdirectory includes its root's ignore file.'''
+    if len(paths) >= shards:
+        return [(path, excluder) for path in paths]
+    units = []
+    for path in paths:
+        path_excluder = excluder
+        if os.path.isfile(os.path.join(path, IGNORE_FILE)):
+            path_excluder = excluder.with_ignore_file(path)
+        for (dirpath, dstat, subdirs, files) in walk_tree(path, excluder):
+            units += [(os.path.join(path, name), path_excluder) for (name, st) in subdirs]
+            break
+    return units
+
+def run_shards(commands, max_procs, results):
+    '''Runs the shard commands, at most max_procs at once, setting
+       results[n] to the exit code of commands[n]'''
+    running = []
+    waiting = list(enumerate(commands))
+    while waiting or running:
+        while waiting and len(running) < max_procs:
+            (n, cmd) = waiting.pop(0)
+            logging.debug('Starting shard: %s' % ' '.join(cmd))
+            running.append((n, subprocess.Popen(cmd)))
+        time.sleep(0.05)
+        for (n, proc) in list(running):
+            if proc.poll() is not None:
+                results[n] = proc.returncode
+                running.remove((n, proc))
+
+def merge_shard(conn, shard_db, parent_id):
+    '''Copies the rows of a shard database into the files table, renumbering
+       their ids to follow the existing rows. The shard's root gets parent_id
+       as its parent. Returns the (number of rows, bytes hashed in full).'''
+    cursor = conn.cursor()
+    offset = next_file_id(cursor) - 1
+    cursor.execute("attach database ? as shard", (shard_db,))
+    try:
+        cursor.execute('''insert into files (id, parent, path, type, mode, uid, gid, nlink, hash,
+                                             size, mtime, total_size, inode, ctime, hash_level)
+                          select id + ?, case when parent is null then ? else parent + ? end,
+                                 path, type, mode, uid, gid, nlink, hash,
+                                 size, mtime, total_size, inode, ctime, hash_level
+                          from shard.files order by id''', (offset, parent_id, offset))
+        row_count = cursor.rowcount
+        cursor.execute('''select coalesce(sum(size), 0) from shard.files
+                          where type = ? and hash_level = ?''', (stat.S_IFREG, HASH_FULL))
+        byte_count = cursor.fetchone()[0]
+        conn.commit()
+    finally:
+        cursor.execute('detach database shard')
+    return (row_count, byte_count)
+
+def write_dir_index(cursor, filename, first_id = None):
+    '''Writes the hashed directories of this run, from first_id on, to a
+       fingerprint index. If first_id is None, the directories of the latest
+       run of each scanned root are written instead, as after --zfs-diff,
+       so earlier runs of the same tree don't show up as its duplicates.'''
+    def rows():
+        if first_id is not None:
+            cursor.execute('''select id, parent, hash, total_size, path from files
+                              where id >= ? and type = ? and hash is not null
+                              order by total_size desc, hash, id''', (first_id, stat.S_IFDIR))
+            return cursor
+        cursor.execute('''with recursive tree(id) as
+                            (select max(id) from files where parent is null and type = ?
+                             group by path
+                             union all
+                             select f.id from files f join tree t on f.parent = t.id
+                             where f.type = ?)
+                          select f.id, f.parent, f.hash, f.total_size, f.path
+                          from files f join tree t on f.id = t.id
+                          where f.hash is not null
+                          order by f.total_size desc, f.hash, f.id''', (stat.S_IFDIR, stat.S_IFDIR))
+        return cursor
+    fingerprint_index.write_index(filename, rows)
 
 if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s %(message)s', level = logging.INFO)
@@ -90,14 +1062,124 @@ if __name__ == '__main__':
                         required = True,
                         help = 'Sqlite3 database')
 
-    parser.add_argument('--exclude', metavar = 'DIR', 
+    parser.add_argument('--exclude', metavar = 'PATTERN', 
                         dest = 'exclude', default = [],
                         action = 'append',
-                        help = 'Full path to exclude')
+                        help = 'Path or glob to exclude. Patterns without a / match names '
+                               'anywhere in the tree, a trailing / only matches directories '
+                               'and ** matches across directories. Directories may also hold '
+                               'a %s file of patterns relative to the directory.' % IGNORE_FILE)
+
+    parser.add_argument('--exclude-from', metavar = 'FILE', dest = 'exclude_from',
+                        default = None,
+                        help = 'File of exclude patterns, one per line')
+
+    parser.add_argument('--metadata-only', dest = 'metadata_only',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Record paths and stat information without hashing anything')
+
+    parser.add_argument('--incremental', dest = 'incremental',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Replace the results of earlier runs below the PATHs, reusing the hashes '
+                               'of files whose size, mtime, inode and ctime are unchanged')
+
+    parser.add_argument('--dups-only', dest = 'dups_only',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Only hash files that may have a duplicate: files are grouped by '
+                               'size, then by a hash of their first and last blocks, and only '
+                               'files that still collide are hashed in full. Directory hashes '
+                               'are not computed.')
 
-    parser.add_argument('path', nargs='+', metavar = 'PATH')
+    parser.add_argument('--index', metavar = 'FILE', dest = 'index_file',
+                        default = DEFAULT_INDEX_FILE,
+                        help = 'Directory fingerprint index read by show_dups.py '
+                               '(default %s)' % DEFAULT_INDEX_FILE)
+
+    parser.add_argument('--pickle', metavar = 'FILE', dest = 'pickle_file',
+                        default = None,
+                        help = 'Also export the directory tree and hashes as a pickle '
+                               'in the format of earlier versions')
+
+    parser.add_argument('--hash', metavar = 'NAME', dest = 'hash_algorithm',
+                        choices = sorted(HASH_ALGORITHMS),
+                        default = DEFAULT_HASH_ALGORITHM,
+                        help = 'Hash algorithm, one of %s (default %s). A database only '
+                               'holds hashes of one algorithm.' % \
+                               (', '.join(sorted(HASH_ALGORITHMS)), DEFAULT_HASH_ALGORITHM))
+
+    parser.add_argument('--block-size', metavar = 'KB', dest = 'block_size',
+                        type = int, default = HASH_READ_BLOCKSIZE // 1024,
+                        help = 'Size of the reads made while hashing a file '
+                               '(default %d)' % (HASH_READ_BLOCKSIZE // 1024))
+
+    parser.add_argument('--mmap-threshold', metavar = 'MB', dest = 'mmap_threshold',
+                        type = int, default = 0,
+                        help = 'Hash files of at least this size through mmap rather than '
+                               'reads, 0 to always read (default 0)')
+
+    parser.add_argument('--workers', metavar = 'N', dest = 'workers',
+                        type = int, default = DEFAULT_HASH_WORKERS,
+                        help = 'Number of hashing threads. 0 hashes on the main thread '
+                               '(default %d)' % DEFAULT_HASH_WORKERS)
+
+    parser.add_argument('--queue-depth', metavar = 'N', dest = 'queue_depth',
+                        type = int, default = DEFAULT_QUEUE_DEPTH,
+                        help = 'Maximum number of files walked ahead of the database '
+                               'writer (default %d)' % DEFAULT_QUEUE_DEPTH)
+
+    parser.add_argument('--per-device', metavar = 'N', dest = 'per_device',
+                        type = int, default = 0,
+                        help = 'Maximum number of files hashed at once on a single '
+                               'device, 0 for no limit')
+
+    parser.add_argument('--bulk-load', dest = 'bulk_load',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Load rows in large batches and transactions with WAL journaling, '
+                               'relaxed syncing and a large cache, rebuilding indexes afterwards')
+
+    parser.add_argument('--batch-size', metavar = 'ROWS', dest = 'batch_size',
+                        type = int, default = None,
+                        help = 'Rows written per executemany call (default 1, or %d with '
+                               '--bulk-load)' % BULK_BATCH_SIZE)
+
+    parser.add_argument('--commit-rows', metavar = 'ROWS', dest = 'commit_rows',
+                        type = int, default = None,
+                        help = 'Rows written per transaction (default %d, or %d with '
+                               '--bulk-load)' % (FILES_PER_COMMIT, BULK_ROWS_PER_COMMIT))
+
+    parser.add_argument('--zfs-diff', metavar = 'SNAPSHOT', dest = 'zfs_diff',
+                        nargs = 2, default = None,
+                        help = 'Instead of scanning PATHs, update a database holding a scan of '
+                               'a dataset\'s mountpoint from the first snapshot to the second, '
+                               'rehashing only the paths zfs diff reports and their parents. '
+                               'For example --zfs-diff data/docs@20240101-0000 data/docs@20240102-0000')
+
+    parser.add_argument('--shards', metavar = 'N', dest = 'shards',
+                        type = int, default = 1,
+                        help = 'Scan in N processes, each writing its own database which is then '
+                               'merged into DB. PATHs are shared among the processes, or split '
+                               'into their top-level directories if there are fewer than N.')
+
+    # Set for the processes of a sharded scan, which leave the duplicate
+    # search and the index to the merge
+    parser.add_argument('--shard-worker', dest = 'shard_worker',
+                        action = 'store_true', default = False,
+                        help = argparse.SUPPRESS)
+
+    metrics.add_arguments(parser)
+
+    parser.add_argument('path', nargs='*', metavar = 'PATH')
 
     args = parser.parse_args()
+    if bool(args.zfs_diff) == bool(args.path):
+        parser.error('Either PATHs or --zfs-diff must be given')
+    if args.shards > 1 and (args.incremental or args.pickle_file or args.zfs_diff):
+        parser.error('--shards can\'t be combined with --incremental, --pickle or --zfs-diff')
+    run_metrics.write_at_exit(args.metrics_file, args.profile_file)
     
     logging.info('Connecting to DB: %s' % args.db)
 
@@ -105,137 +1187,347 @@ if __name__ == '__main__':
     conn.text_factory = str
 
     cursor = conn.cursor()
-    cursor.execute('''create table if not exists files 
-                        (id     integer primary key asc autoincrement, 
-                         parent integer references files (id),
-                         path   text,
-                         type   integer,
-                         mode   integer,
-                         uid    integer,
-                         gid    integer,
-                         nlink  integer,
-                         hash   text,
-                         size   integer,
-                         mtime  real,
-                         total_size integer)''')
+    create_files_table(cursor)
+    create_meta_table(cursor)
+    fix_file_types(cursor)
+    stored_algorithm = stored_hash_algorithm(cursor)
+    if stored_algorithm is not None and stored_algorithm != args.hash_algorithm:
+        parser.error('%s holds %s hashes, which can\'t be compared with %s hashes. '
+                     'Use --hash %s or another database.' % \
+                     (args.db, stored_algorithm, args.hash_algorithm, stored_algorithm))
+    record_hash_algorithm(cursor, args.hash_algorithm)
+    logging.info('Hash algorithm: %s' % args.hash_algorithm)
+
+    hash_algorithm = args.hash_algorithm
+    read_blocksize = max(1, args.block_size) * 1024
+    mmap_threshold = args.mmap_threshold * 1024 * 1024
+    empty_hash = new_hash().hexdigest()
+
+    if args.zfs_diff:
+        hash_pool = HashPool(args.workers, args.queue_depth, args.per_device)
+        start_time = time.time()
+        (change_count, byte_count) = update_from_zfs_diff(conn, args.zfs_diff[0], args.zfs_diff[1],
+                                                           hash_pool)
+        hash_pool.close()
+        if not args.dups_only:
+            logging.info('Writing index %s.' % args.index_file)
+            with run_metrics.phase('index'):
+                write_dir_index(cursor, args.index_file)
+        logging.info('Applied %d changes in %0.1f seconds, reading %s.' % (
+                  change_count, time.time() - start_time, pretty_bytes(byte_count)))
+        run_metrics.set('changes', change_count)
+        run_metrics.set('success', 1)
+        sys.exit(0)
+
+    if not (args.dups_only or args.metadata_only):
+        progress.total = previous_total_size(cursor, args.path)
+
+    if args.incremental:
+        for path in args.path:
+            root = enclosing_root(cursor, path.rstrip(os.sep) or os.sep)
+            if root is not None:
+                parser.error('%s was scanned as part of %s and can\'t be rescanned on its own '
+                             'with --incremental. Rescan %s instead.' % (path, root, root))
+        logging.info('Incremental mode: reusing hashes of unchanged files.')
+        begin_incremental(cursor, args.path)
     conn.commit()
 
+    if args.bulk_load:
+        logging.info('Bulk load mode.')
+        index_sql = begin_bulk_load(conn)
+        batch_size = args.batch_size or BULK_BATCH_SIZE
+        commit_rows = args.commit_rows or BULK_ROWS_PER_COMMIT
+    else:
+        batch_size = args.batch_size or 1
+        commit_rows = args.commit_rows or FILES_PER_COMMIT
+    writer = RowWriter(conn, batch_size, commit_rows)
+
     file_count = 0
     byte_count = 0
-    last_commit_count = 0
+    regular_byte_count = 0
+
+    # Files and bytes whose hashes were reused from the previous run
+    reused_count = 0
+    skipped_byte_count = 0
+
+    # Directory hashes are left null when file contents are not all hashed,
+    # even for directories holding no regular files
+    hash_dirs = not (args.dups_only or args.metadata_only)
 
+    # The whole tree is only kept in memory when it is to be pickled
+    keep_tree = args.pickle_file is not None
     dir_hashes = {}
     dir_data = {}
 
-    if args.exclude:
-        for exclude in args.exclude:
-            logging.info('Excluding path: %s' % exclude)
+    # Rows of this run start after the rows of any earlier runs
+    first_id = writer.next_id
+
+    exclude_patterns = list(args.exclude)
+    if args.exclude_from:
+        with open(args.exclude_from) as f:
+            exclude_patterns += read_patterns(f)
+    for exclude in exclude_patterns:
+        logging.info('Excluding: %s' % exclude)
+    excluder = Excluder(exclude_patterns)
+
+    hash_pool = HashPool(args.workers, args.queue_depth, args.per_device)
+    start_time = time.time()
+    progress.start_time = start_time
+
+    # Directories scanned by shard processes, which the walk below skips.
+    # It still writes the roots that were split and their files, but leaves
+    # their hashes null until the shards below them have been merged.
+    shard_dirs = []
+    if args.shards > 1:
+        args.path = [path.rstrip(os.sep) or os.sep for path in args.path]
+        shard_units = plan_shards(args.path, args.shards, excluder)
+        shard_dirs = [shard_dir for (shard_dir, shard_excluder) in shard_units]
+    shard_dir_set = set(shard_dirs)
+    split_roots = set(path for path in args.path if shard_dirs and path not in shard_dir_set)
+    if shard_dirs:
+        shard_tmpdir = tempfile.mkdtemp(prefix = 'fingerprint-shards-', dir = os.path.dirname(os.path.abspath(args.db)))
+        shard_dbs = [os.path.join(shard_tmpdir, 'shard%d.db' % n) for n in range(len(shard_dirs))]
+        worker_args = ['--hash', args.hash_algorithm,
+                       '--block-size', str(args.block_size),
+                       '--mmap-threshold', str(args.mmap_threshold),
+                       '--workers', str(args.workers),
+                       '--queue-depth', str(args.queue_depth),
+                       '--per-device', str(args.per_device),
+                       '--shard-worker']
+        for flag in ['dups_only', 'metadata_only', 'bulk_load']:
+            if getattr(args, flag):
+                worker_args.append('--' + flag.replace('_', '-'))
+        for flag in ['batch_size', 'commit_rows']:
+            if getattr(args, flag) is not None:
+                worker_args += ['--' + flag.replace('_', '-'), str(getattr(args, flag))]
+        # Each shard gets the patterns in force at its directory, including
+        # those of ignore files above it that its own walk would not read
+        commands = []
+        for n, ((shard_dir, shard_excluder), shard_db) in enumerate(zip(shard_units, shard_dbs)):
+            exclude_file = os.path.join(shard_tmpdir, 'shard%d.exclude' % n)
+            with open(exclude_file, 'w') as f:
+                f.writelines(glob + '\n' for glob in shard_excluder.globs)
+            commands.append([sys.executable, os.path.abspath(__file__), '--db', shard_db,
+                             '--index', os.path.join(shard_tmpdir, 'shard%d.idx' % n),
+                             '--metrics', os.path.join(shard_tmpdir, 'shard%d.json' % n),
+                             '--exclude-from', exclude_file] + worker_args + [shard_dir])
+        logging.info('Scanning %d shards in %d processes.' % (len(shard_dirs), args.shards))
+        shard_results = [None] * len(commands)
+        shard_thread = threading.Thread(target = run_shards,
+                                        args = (commands, args.shards, shard_results))
+        shard_thread.start()
+
+    # Entries waiting to be written, in walk order. Files are hashed by the
+    # pool while they wait, and rows are written in the same order as a
+    # single threaded scan so ids and directory hashes do not depend on
+    # which worker finishes first. A directory's PENDING_DIR_END follows
+    # all of its descendants, so it is hashed as soon as they are written.
+    pending = collections.deque()
+
+    # Directories from the current root down to the one being walked.
+    # Only these hold child entries, so memory is bounded by the depth
+    # and fan-out of the tree rather than the number of files.
+    open_dirs = []
+
+    def write_pending():
+        '''Writes the oldest pending entry, waiting for its hash if necessary'''
+        global file_count, byte_count
+        (kind, dir_ent, data) = pending.popleft()
+        if kind == PENDING_DIR_END:
+            with run_metrics.phase('dir_hash'):
+                finish_dir(dir_ent, writer, dir_hashes if keep_tree else None, keep_tree,
+                           hash_dirs and dir_ent[D_IDX_PATH] not in split_roots)
+            return
+
+        if kind == PENDING_DIR:
+            parent = data
+            if parent is not None:
+                dir_ent[D_IDX_PARENT_ID] = parent[D_IDX_ID]
+            dir_ent[D_IDX_ID] = writer.insert(dir_ent[D_IDX_PARENT_ID], dir_ent[D_IDX_PATH],
+                                              dir_ent[D_IDX_STAT], None)
+            log_progress(dir_ent[D_IDX_PATH], file_count, byte_count)
+            return
+
+        (fullname, pstat, hash_str, job) = data
+        if job is not None:
+            with run_metrics.phase('hash_wait'):
+                (hash_str, bytes_read) = job.result()
+            byte_count += bytes_read
+
+        dir_id = dir_ent[D_IDX_ID]
+        file_id = writer.insert(dir_id, fullname, pstat, hash_str)
+        dir_ent[D_IDX_CHILD_FILES].append((fullname, file_id, dir_id, pstat, hash_str))
+        file_count += 1
+
+        log_progress(fullname, file_count, byte_count, skipped_byte_count)
+
+    def head_ready():
+        (kind, dir_ent, data) = pending[0]
+        return kind != PENDING_FILE or data[3] is None or data[3].done.is_set()
+
+    def drain_pending():
+        '''Writes pending entries while there are more than the queue depth
+           or the oldest is ready to be written, so directories with no files
+           to hash do not pile up'''
+        while pending and (len(pending) > args.queue_depth or head_ready()):
+            write_pending()
+
+    def close_dirs(parent_path = None):
+        '''Queues the end of each open directory that is not parent_path or an ancestor of it'''
+        while open_dirs and open_dirs[-1][D_IDX_PATH] != parent_path:
+            pending.append((PENDING_DIR_END, open_dirs.pop(), None))
 
     for path in args.path:
         is_root = True
+        path = path.rstrip(os.sep) or os.sep
+        if path in shard_dir_set:
+            continue
         logging.info('Scanning path: %s' % path)
         
         # Walk the directory tree in top-down order (directories visited after files)
-        for dirpath, dirnames, filenames in os.walk(path, topdown = True):        
+        for dirpath, dstat, subdirs, files in walk_tree(path, excluder):
             file_count += 1
-            
-            # sort directory names (allowed with topdown visitation)
-            dirnames.sort()
-            
-            if dirpath in args.exclude:
-                logging.info('Skipping %s dirpath' % dirpath)
-                del dirnames[:]
-                continue
+
+            if shard_dirs:
+                # Left to the shard processes
+                subdirs[:] = [entry for entry in subdirs
+                              if os.path.join(dirpath, entry[0]) not in shard_dir_set]
                 
             if is_root:
+                close_dirs()
                 parent = None
                 is_root = False
-                parent_id = None
             else:
-                parent_dir = os.path.dirname(dirpath)
-                parent = dir_data[parent_dir]
-                parent_id = parent[D_IDX_ID]
-
-            # Insert Directory
-            dstat = os.lstat(dirpath)
-            cursor.execute('''insert into files (parent, path, type, mode, uid, gid, nlink, hash, size, mtime)
-                              values (?,?,?,?,?,?,?,?,?,?)''',
-                       (parent_id,
-                        dirpath,
-                        stat.S_IFMT(dstat.st_mode),
-                        dstat.st_mode,
-                        dstat.st_uid,
-                        dstat.st_gid,
-                        dstat.st_nlink,
-                        None,
-                        dstat.st_size,
-                        dstat.st_mtime))
-
-            dir_id = cursor.lastrowid
-            file_ents = []
-            dir_ents = []
-            cur_dir_ent = [dir_id, parent_id, dirpath, dstat, dir_ents, file_ents, None, 0] # id, parent_id, stat info, dir children, file children, hash, total_size
-            dir_data[dirpath] = cur_dir_ent
+                close_dirs(os.path.dirname(dirpath))
+                parent = open_dirs[-1]
+
+            # Directory ids are assigned when the entry is written
+            cur_dir_ent = [None, None, dirpath, dstat, [], [], None, 0] # id, parent_id, stat info, dir children, file children, hash, total_size
+            if keep_tree:
+                dir_data[dirpath] = cur_dir_ent
             # add directory to parent
             if parent:
                 parent[D_IDX_CHILD_DIRS].append(cur_dir_ent)
-                
-            if parent_id is None:
-                parent_id = -1
-                
-            log_progress(dirpath, file_count, byte_count)
+            open_dirs.append(cur_dir_ent)
+            pending.append((PENDING_DIR, cur_dir_ent, parent))
             
             # visit the files in sorted order
-            for fname in sorted(filenames):
+            for fname, pstat in files:
                 fullname = os.path.join(dirpath, fname)
-                pstat = os.lstat(fullname)
-                ftype = stat.S_IFMT(pstat.st_mode)
                 
-                h = hashlib.sha256()            
                 # Only hash the contents regular files
+                job = None
                 if stat.S_ISREG(pstat.st_mode):
-                    with open(fullname, 'rb') as f:
-                        data = f.read(HASH_READ_BLOCKSIZE)
-                        while len(data) > 0:
-                            h.update(data)
-                            byte_count += len(data)
-                            data = f.read(HASH_READ_BLOCKSIZE)
-                            
-                hash_str = h.hexdigest()
-                
-                cursor.execute('''insert into files (parent, path, type, mode, uid, gid, nlink, hash, size, mtime)
-                                      values (?,?,?,?,?,?,?,?,?,?)''',
-                           (dir_id,
-                            fullname,
-                            stat.S_IFMT(dstat.st_mode),
-                            pstat.st_mode,
-                            pstat.st_uid,
-                            pstat.st_gid,
-                            pstat.st_nlink,
-                            hash_str,
-                            pstat.st_size,
-                            pstat.st_mtime))
-                
-                file_ents.append((fullname, cursor.lastrowid, dir_id, pstat, hash_str)) 
-                file_count += 1
-                if file_count - last_commit_count > FILES_PER_COMMIT:
-                    conn.commit()
-                    last_commit_count = file_count
-                    
-                log_progress(fullname, file_count, byte_count)
+                    regular_byte_count += pstat.st_size
+                    hash_str = None
+                    if args.dups_only or args.metadata_only:
+                        # Hashed later if another file has the same size, or never
+                        pass
+                    elif args.incremental:
+                        hash_str = previous_hash(cursor, fullname, pstat)
 
-    conn.commit()
+                    if hash_str is not None:
+                        reused_count += 1
+                        skipped_byte_count += pstat.st_size
+                    elif not args.dups_only and not args.metadata_only:
+                        job = hash_pool.submit(fullname, pstat.st_dev)
+                elif args.metadata_only:
+                    hash_str = None
+                else:
+                    hash_str = empty_hash
 
-    # Visit all directories and compute hashes
-    logging.info('Computing directory hashes.')
-    compute_dir_hashes(dir_data[args.path], cursor, dir_hashes)
+                pending.append((PENDING_FILE, cur_dir_ent, (fullname, pstat, hash_str, job)))
+                drain_pending()
+            drain_pending()
+
+    close_dirs()
+    while pending:
+        write_pending()
+
+    writer.commit()
+
+    if shard_dirs:
+        try:
+            with run_metrics.phase('shard_wait'):
+                shard_thread.join()
+            failed = [shard_dirs[n] for n, result in enumerate(shard_results) if result != 0]
+            if failed:
+                logging.error('Scans of %s failed. Nothing was merged and the hashes of %s '
+                              'were not computed.' % (', '.join(failed), ', '.join(sorted(split_roots))))
+                sys.exit(1)
+
+            for (shard_dir, shard_db) in zip(shard_dirs, shard_dbs):
+                logging.info('Merging shard %s.' % shard_dir)
+                parent = None
+                if shard_dir not in args.path:
+                    parent = find_row(cursor, os.path.dirname(shard_dir))[0]
+                with run_metrics.phase('shard_merge'):
+                    (row_count, shard_bytes) = merge_shard(conn, shard_db, parent)
+                shard_metrics = os.path.splitext(shard_db)[0] + '.json'
+                if os.path.exists(shard_metrics):
+                    with open(shard_metrics) as f:
+                        run_metrics.merge(json.load(f))
+                writer.row_count += row_count
+                file_count += row_count
+                byte_count += shard_bytes
+        finally:
+            shutil.rmtree(shard_tmpdir)
+
+        # The hashes of the split roots now cover their shards
+        for path in split_roots:
+            if hash_dirs:
+                rehash_dir(cursor, find_row(cursor, path)[0])
+        conn.commit()
+        writer.next_id = next_file_id(cursor)
+
+    if args.shard_worker or args.metadata_only:
+        pass
+    elif args.dups_only:
+        logging.info('Finding duplicate files.')
+        with run_metrics.phase('find_dups'):
+            byte_count += find_duplicate_files(writer, first_id, hash_pool,
+                                               args.queue_depth, args.incremental)
+    hash_pool.close()
+    writer.commit()
+    load_seconds = time.time() - start_time
+
+    if args.incremental:
+        end_incremental(cursor)
 
     conn.commit()
 
-    logging.info('Pickling.')
-    with file('treedata.pickle', 'wb') as pfile:
-        pickler = cPickle.Pickler(pfile)
-        pickler.dump(dir_data)
-        pickler.dump(dir_hashes)
+    if args.bulk_load:
+        with run_metrics.phase('sqlite_index'):
+            end_bulk_load(conn, index_sql)
+
+    if not (args.dups_only or args.metadata_only or args.shard_worker):
+        logging.info('Writing index %s.' % args.index_file)
+        with run_metrics.phase('index'):
+            write_dir_index(cursor, args.index_file, first_id)
+
+    if args.pickle_file:
+        logging.info('Pickling to %s.' % args.pickle_file)
+        with file(args.pickle_file, 'wb') as pfile:
+            pickler = cPickle.Pickler(pfile)
+            pickler.dump(dir_data)
+            pickler.dump(dir_hashes)
     logging.info('Completed processing of %d files and %d bytes.' % (
               file_count, byte_count))
+    if load_seconds > 0:
+        logging.info('Wrote %d rows in %0.1f seconds (%0.0f rows/s).' % (
+                  writer.row_count, load_seconds, writer.row_count / load_seconds))
+    if args.dups_only and regular_byte_count > 0:
+        logging.info('Read %s of %s (%0.1f%%) in regular files.' % (
+                  pretty_bytes(byte_count), pretty_bytes(regular_byte_count),
+                  100.0 * byte_count / regular_byte_count))
+    elif args.incremental:
+        logging.info('Reused hashes of %d unchanged files, skipping %s. Re-read %s.' % (
+                  reused_count, pretty_bytes(skipped_byte_count), pretty_bytes(byte_count)))
+
+    run_metrics.set('files', file_count)
+    run_metrics.set('rows', writer.row_count)
+    run_metrics.set('reused_files', reused_count)
+    run_metrics.set('skipped_bytes', skipped_byte_count)
+    run_metrics.set('regular_bytes', regular_byte_count)
+    run_metrics.set('success', 1)
+    logging.info('Time by phase: %s' % run_metrics.phase_summary())
@@ -0,0 +1,201 @@
+'''Phase timers, counters and progress estimates shared by make_tree_fingerprints
+   and backup, written at exit as JSON or in the Prometheus text format
+
+A Prometheus file is meant for node_exporter's textfile collector: point
+--metrics at a .prom file in its directory. The file is written to a
+temporary name and renamed so the collector never reads a partial file.
+'''
+
+import atexit
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+
+class Metrics(object):
+    '''Timers and counters of one run of a tool, named for Prometheus as
+       <job>_<name>. Each may have labels, given as a dict. Any thread may
+       update them. Phase times are summed over the threads running the
+       phase, so phases run by several threads at once may add up to more
+       than the run time.'''
+    def __init__(self, job):
+        self.job = job
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+        self.phase_seconds = {}
+        self.phase_calls = {}
+        self.counters = {}
+        self.gauges = {}
+
+    @contextlib.contextmanager
+    def phase(self, name, labels = None):
+        '''Times the enclosed block as phase name'''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start, labels)
+
+    def add_time(self, name, seconds, labels = None):
+        key = _key(dict(labels or {}, phase = name))
+        with self.lock:
+            self.phase_seconds[key] = self.phase_seconds.get(key, 0.0) + seconds
+            self.phase_calls[key] = self.phase_calls.get(key, 0) + 1
+
+    def count(self, name, n = 1, labels = None):
+        '''Adds n to counter name'''
+        key = (name, _key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def set(self, name, value, labels = None):
+        '''Sets gauge name'''
+        with self.lock:
+            self.gauges[(name, _key(labels))] = value
+
+    def value(self, name, labels = None):
+        '''Returns the value of counter name, or 0'''
+        with self.lock:
+            return self.counters.get((name, _key(labels)), 0)
+
+    def merge(self, snapshot):
+        '''Adds the phase times and counters of a snapshot, such as the JSON
+           metrics of a child process'''
+        with self.lock:
+            for phase in snapshot['phases']:
+                key = _key(dict((k, v) for (k, v) in phase.items() if k not in ('seconds', 'calls')))
+                self.phase_seconds[key] = self.phase_seconds.get(key, 0.0) + phase['seconds']
+                self.phase_calls[key] = self.phase_calls.get(key, 0) + phase['calls']
+            for counter in snapshot['counters']:
+                key = (counter['name'], _key(counter['labels']))
+                self.counters[key] = self.counters.get(key, 0) + counter['value']
+
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    def phase_summary(self):
+        '''Describes the time of each phase, longest first'''
+        with self.lock:
+            phases = sorted(self.phase_seconds.items(), key = lambda p: p[1], reverse = True)
+        return ', '.join('%s %0.1fs' % (' '.join(str(v) for (k, v) in labels_key), seconds)
+                         for (labels_key, seconds) in phases) or 'none'
+
+    def snapshot(self):
+        '''Returns the metrics as a dict that can be dumped as JSON'''
+        with self.lock:
+            return {'job': self.job,
+                    'start_time': self.start_time,
+                    'elapsed_seconds': self.elapsed(),
+                    'phases': [dict(dict(labels_key), seconds = self.phase_seconds[labels_key],
+                                    calls = self.phase_calls[labels_key])
+                               for labels_key in sorted(self.phase_seconds)],
+                    'counters': [{'name': name, 'labels': dict(labels_key), 'value': value}
+                                 for ((name, labels_key), value) in sorted(self.counters.items())],
+                    'gauges': [{'name': name, 'labels': dict(labels_key), 'value': value}
+                               for ((name, labels_key), value) in sorted(self.gauges.items())]}
+
+    def prometheus(self):
+        '''Returns the metrics in the Prometheus text format'''
+        lines = []
+        def add(name, kind, samples):
+            name = '%s_%s' % (self.job, name)
+            lines.append('# TYPE %s %s' % (name, kind))
+            for (labels_key, value) in samples:
+                lines.append('%s%s %s' % (name, _label_str(labels_key), _number_str(value)))
+
+        with self.lock:
+            add('last_run_timestamp_seconds', 'gauge', [((), self.start_time)])
+            add('run_seconds', 'gauge', [((), self.elapsed())])
+            if self.phase_seconds:
+                add('phase_seconds_total', 'counter', sorted(self.phase_seconds.items()))
+                add('phase_calls_total', 'counter', sorted(self.phase_calls.items()))
+            for (kind, values, suffix) in [('counter', self.counters, '_total'),
+                                           ('gauge', self.gauges, '')]:
+                for name in sorted(set(name for (name, labels_key) in values)):
+                    add(name + suffix, kind, sorted((labels_key, value)
+                                                    for ((n, labels_key), value) in values.items()
+                                                    if n == name))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        '''Writes the metrics to filename, as JSON if it ends in .json and
+           otherwise in the Prometheus text format'''
+        if filename.endswith('.json'):
+            text = json.dumps(self.snapshot(), indent = 2, sort_keys = True) + '\n'
+        else:
+            text = self.prometheus()
+        tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmp_filename, 'w') as f:
+            f.write(text)
+        os.rename(tmp_filename, filename)
+
+    def write_at_exit(self, metrics_file = None, profile_file = None):
+        '''Writes the metrics to metrics_file when the process exits. If
+           profile_file is given, the calling thread is profiled until then
+           and its statistics written to profile_file for python -m pstats.'''
+        profiler = None
+        if profile_file:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        def write():
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(profile_file)
+                logging.info('Wrote profile %s.' % profile_file)
+            if metrics_file:
+                try:
+                    self.write(metrics_file)
+                    logging.info('Wrote metrics %s.' % metrics_file)
+                except EnvironmentError as e:
+                    logging.error('Can\'t write metrics %s: %s' % (metrics_file, e))
+        atexit.register(write)
+
+class Progress(object):
+    '''Throughput and the estimated time left of work whose total, such as
+       a number of bytes, may be known in advance'''
+    def __init__(self, total = None):
+        self.total = total
+        self.start_time = time.time()
+
+    def rate(self, done):
+        '''Returns the work done per second so far'''
+        elapsed = time.time() - self.start_time
+        return done / elapsed if elapsed > 0 else 0.0
+
+    def eta(self, done):
+        '''Returns the seconds left at the current rate, or None if unknown'''
+        rate = self.rate(done)
+        if not self.total or rate <= 0:
+            return None
+        return max(0, self.total - done) / rate
+
+def add_arguments(parser):
+    '''Adds the --metrics and --profile options to an ArgumentParser'''
+    parser.add_argument('--metrics', metavar = 'FILE', dest = 'metrics_file',
+                        default = None,
+                        help = 'At exit, write phase timings and counters to FILE, as JSON if '
+                               'it ends in .json and otherwise in the Prometheus text format '
+                               'for node_exporter\'s textfile collector')
+
+    parser.add_argument('--profile', metavar = 'FILE', dest = 'profile_file',
+                        default = None,
+                        help = 'Profile the main thread with cProfile and write the '
+                               'statistics to FILE')
+
+def _key(labels):
+    return tuple(sorted((labels or {}).items()))
+
+def _number_str(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
+
+def _label_str(labels_key):
+    if not labels_key:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                             for (k, v) in labels_key)
@@ -1,10 +1,23 @@
 #!/usr/bin/env python
-"""Opens Pickled hash files and finds duplicative directory trees"""
+"""Opens a fingerprint database, index or pickled hash files and finds duplicative directory trees"""
  
 import cPickle
 import argparse
+import collections
+import csv
+import itertools
+import json
 import logging
 import os.path
+import sqlite3
+import stat
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+import fingerprint_index
+import make_tree_fingerprints as mtf
+import metrics
 
 # Directory entry indexes
 (D_IDX_ID, 
@@ -23,6 +36,17 @@ import os.path
  F_IDX_STAT,
  F_IDX_HASH) = range(5)
 
+DEFAULT_CHECK_THREADS = 16
+CHECK_BATCH_SIZE = 256
+OUTPUT_FORMATS = ['text', 'json', 'csv']
+
+# A set of identical directories. parent_hashes holds the hash of each
+# path's parent directory, or None if it is unknown.
+DupGroup = collections.namedtuple('DupGroup', ['hash', 'size', 'paths', 'parent_hashes'])
+
+# Time spent loading the source and listing its groups
+run_metrics = metrics.Metrics('fnas_show_dups')
+
 def pretty_bytes(bytes):
     '''Print bytes in friendly units'''
     (MB, GB) = (1024**2, 1024**3)
@@ -31,13 +55,115 @@ def pretty_bytes(bytes):
     else:
         return '%0.2f MB' % (float(bytes) / MB)
 
+def query_duplicates(conn, min_size = 0, limit = None):
+    '''Yields a DupGroup for directories sharing a hash in a
+       make_tree_fingerprints database, largest first'''
+    cursor = conn.cursor()
+    mtf.create_meta_table(cursor)
+    mtf.fix_file_types(cursor)
+    logging.info('Creating hash index if needed.')
+    conn.execute('create index if not exists files_hash_type on files (hash, type)')
+    conn.commit()
+
+    # Rows of a path repeated by earlier non-incremental runs are not duplicates
+    sql = '''select hash, max(total_size) from files
+             where type = ? and hash is not null
+             group by hash having count(distinct path) > 1 and max(total_size) >= ?
+             order by max(total_size) desc'''
+    params = [stat.S_IFDIR, min_size]
+    if limit is not None:
+        sql += ' limit ?'
+        params.append(limit)
+
+    path_cursor = conn.cursor()
+    for (hash_str, total_size) in conn.execute(sql, params):
+        path_cursor.execute('''select f.path, p.hash from files f left join files p on p.id = f.parent
+                               where f.hash = ? and f.type = ?
+                               group by f.path order by min(f.id)''', (hash_str, stat.S_IFDIR))
+        rows = path_cursor.fetchall()
+        yield DupGroup(hash_str, total_size, [row[0] for row in rows], [row[1] for row in rows])
+
+def index_duplicates(index):
+    '''Yields a DupGroup for each group of a fingerprint index, largest first.
+       Parents are found by binary search on the index's id table.'''
+    for group in index.duplicate_groups():
+        parent_hashes = []
+        for record in group:
+            parent = index.find_id(record.parent) if record.parent is not None else None
+            parent_hashes.append(parent.hash if parent else None)
+        yield DupGroup(group[0].hash, group[0].total_size, [r.path for r in group], parent_hashes)
+
+def is_maximal(group):
+    '''A group is redundant when each of its directories is in a different
+       parent and the parents all share a hash, as the parents are then a
+       duplicate group themselves that includes this one'''
+    parent_hashes = set(group.parent_hashes)
+    if len(parent_hashes) != 1 or None in parent_hashes:
+        return True
+    return len(set(os.path.dirname(path) for path in group.paths)) < len(group.paths)
+
+def existing_groups(groups, pool):
+    '''Yields groups with the paths that no longer exist removed. The paths
+       of CHECK_BATCH_SIZE groups at a time are checked on the pool's threads.'''
+    while True:
+        batch = list(itertools.islice(groups, CHECK_BATCH_SIZE))
+        if not batch:
+            return
+        exists = iter(pool.map(os.path.exists, [path for group in batch for path in group.paths]))
+        for group in batch:
+            keep = [next(exists) for path in group.paths]
+            yield group._replace(paths = [p for p, k in zip(group.paths, keep) if k],
+                                 parent_hashes = [h for h, k in zip(group.parent_hashes, keep) if k])
+
+def reclaimable(group):
+    '''Bytes freed by keeping one copy of the group'''
+    return group.size * (len(group.paths) - 1)
+
+class GroupPrinter(object):
+    '''Writes groups to stdout as text, a JSON array or CSV'''
+    def __init__(self, output_format):
+        self.format = output_format
+        self.count = 0
+        if self.format == 'csv':
+            self.csv = csv.writer(sys.stdout)
+            self.csv.writerow(['group', 'size', 'reclaimable', 'hash', 'path'])
+        elif self.format == 'json':
+            sys.stdout.write('[')
+
+    def write(self, group):
+        self.count += 1
+        if self.format == 'csv':
+            for path in group.paths:
+                self.csv.writerow([self.count, group.size, reclaimable(group), group.hash, path])
+        elif self.format == 'json':
+            sys.stdout.write('%s\n%s' % (',' if self.count > 1 else '',
+                                         json.dumps({'size': group.size,
+                                                     'reclaimable': reclaimable(group),
+                                                     'hash': group.hash,
+                                                     'paths': group.paths})))
+        else:
+            print('%12s %12s %s' % (pretty_bytes(group.size), pretty_bytes(reclaimable(group)),
+                                    group.paths[0]))
+            for path in group.paths[1:] :
+                print('%12s %12s %s' % (' ', ' ', path))
+
+    def close(self):
+        if self.format == 'json':
+            sys.stdout.write('\n]\n')
+
 if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s %(message)s', level = logging.INFO)
 
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('-p', metavar = 'pickle file', dest = 'pickle_file', 
-                        required = True,
+    source = parser.add_mutually_exclusive_group(required = True)
+    source.add_argument('--db', metavar = 'DB', dest = 'db',
+                        help = 'Sqlite3 database written by the make_tree_fingerprints command')
+
+    source.add_argument('-i', metavar = 'index file', dest = 'index_file',
+                        help = 'Fingerprint index written by the make_tree_fingerprints command')
+
+    source.add_argument('-p', metavar = 'pickle file', dest = 'pickle_file', 
                         help = 'File containing pickled output from the make_tree_fingerprints command')
 
     parser.add_argument('-e', dest = 'check_exists',
@@ -45,35 +171,87 @@ if __name__ == '__main__':
                         default = False,
                         help = 'Check the existence of files/directories before listing')
 
+    parser.add_argument('--min-size', metavar = 'BYTES', dest = 'min_size',
+                        type = int, default = 0,
+                        help = 'Only list duplicates of at least this many bytes')
+
+    parser.add_argument('-n', metavar = 'N', dest = 'top',
+                        type = int, default = None,
+                        help = 'Only list the N largest duplicates')
+
+    parser.add_argument('-a', dest = 'all',
+                        action = "store_true",
+                        default = False,
+                        help = 'List every duplicate group, including those inside larger '
+                               'duplicates')
+
+    parser.add_argument('--check-threads', metavar = 'N', dest = 'check_threads',
+                        type = int, default = DEFAULT_CHECK_THREADS,
+                        help = 'Threads checking existence with -e (default %d)' % DEFAULT_CHECK_THREADS)
+
+    parser.add_argument('--format', dest = 'format',
+                        choices = OUTPUT_FORMATS, default = 'text',
+                        help = 'Output format (default text)')
+
+    metrics.add_arguments(parser)
+
     args = parser.parse_args()
+    run_metrics.write_at_exit(args.metrics_file, args.profile_file)
+    load_start = time.time()
 
     if args.check_exists:
         logging.info('Will check paths for existence.')
 
-    logging.info('Loading pickled data structures from %s' % args.pickle_file)
-    with open(args.pickle_file, 'rb') as infile:
-        unpickler = cPickle.Unpickler(infile)
-        logging.info('Loading dirents.')
-        dir_ents = unpickler.load()
+    if args.db:
+        logging.info('Querying database %s' % args.db)
+        conn = sqlite3.connect(args.db)
+        conn.text_factory = str
+        # Paths removed since the scan, or groups inside larger ones, would
+        # make a SQL limit list too few groups
+        dup_list = query_duplicates(conn, args.min_size,
+                                    None if args.check_exists or not args.all else args.top)
+    elif args.index_file:
+        logging.info('Opening index %s' % args.index_file)
+        index = fingerprint_index.FingerprintIndex(args.index_file)
+
+        # Groups are stored largest first, so they can be listed as they are read
+        dup_list = index_duplicates(index)
+    else:
+        logging.info('Loading pickled data structures from %s' % args.pickle_file)
+        with open(args.pickle_file, 'rb') as infile:
+            unpickler = cPickle.Unpickler(infile)
+            logging.info('Loading dirents.')
+            dir_ents = unpickler.load()
         
-        logging.info('Loading hashes.')
-        hashes = unpickler.load()
+            logging.info('Loading hashes.')
+            hashes = unpickler.load()
     
-    logging.info('Creating duplicate list.')    
-    dup_list = []
-    for hash_str, paths in hashes.items():
-        if len(paths) > 1:
-            dup_list.append((paths, dir_ents[paths[0]][D_IDX_TOTAL_SIZE]))
-
-    logging.info('Sorting duplicate list by size')
-    dup_list.sort(key = lambda d: d[1], reverse = True)
-
-    for paths, size in dup_list:
-        if args.check_exists:
-            # Keep only existing paths
-            paths = [p for p in paths if os.path.exists(p)]
-
-        if len(paths) > 1:
-            print('%20s %s' % (pretty_bytes(size), paths[0]))
-            for path in paths[1:] :
-                print('%20s %s' % (' ', path))
+        logging.info('Creating duplicate list.')    
+        dup_list = []
+        for hash_str, paths in hashes.items():
+            if len(paths) > 1:
+                parents = [dir_ents.get(os.path.dirname(p)) for p in paths]
+                dup_list.append(DupGroup(hash_str, dir_ents[paths[0]][D_IDX_TOTAL_SIZE], paths,
+                                         [e[D_IDX_HASH] if e else None for e in parents]))
+
+        logging.info('Sorting duplicate list by size')
+        dup_list.sort(key = lambda d: d.size, reverse = True)
+    run_metrics.add_time('load', time.time() - load_start)
+
+    dup_list = iter(dup_list)
+    if not args.all:
+        dup_list = (group for group in dup_list if is_maximal(group))
+    if args.check_exists:
+        dup_list = existing_groups(dup_list, ThreadPool(args.check_threads))
+
+    printer = GroupPrinter(args.format)
+    with run_metrics.phase('query'):
+        for group in dup_list:
+            if group.size < args.min_size or (args.top is not None and printer.count >= args.top):
+                break
+
+            if len(group.paths) > 1:
+                printer.write(group)
+        printer.close()
+    run_metrics.set('groups', printer.count)
+    logging.info('Listed %d duplicate groups.' % printer.count)
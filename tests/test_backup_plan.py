@@ -0,0 +1,91 @@
+'''Plans backups with backup.py --plan against the fake zfs in scripts/fake,
+   including to a destination pool that is not imported
+
+Run with python3 -m unittest discover tests
+'''
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts')
+FAKE_DIR = os.path.join(SCRIPTS_DIR, 'fake')
+SNAPSHOT_BYTES = 1024 * 1024
+
+class PlanTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix = 'backup-plan-')
+        self.zfs_state = os.path.join(self.tmpdir, 'zfs.json')
+        self.backup_state = os.path.join(self.tmpdir, 'backup.json')
+        snapshots = [{'name': name, 'guid': guid, 'createtxg': guid, 'written': SNAPSHOT_BYTES}
+                     for (name, guid) in [('20240101-0000', 10), ('20240102-0000', 11)]]
+        self.write_zfs({'pools': {'data': {}, 'bkup0': {}},
+                        'datasets': {'data/docs': {'guid': 2, 'createtxg': 2,
+                                                   'snapshots': snapshots},
+                                     'bkup0/docs': {'guid': 3, 'createtxg': 3,
+                                                    'snapshots': [dict(snapshots[0], createtxg = 4)]}},
+                        'next_id': 100})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read_zfs(self):
+        with open(self.zfs_state) as f:
+            return json.load(f)
+
+    def write_zfs(self, data):
+        with open(self.zfs_state, 'w') as f:
+            json.dump(data, f)
+
+    def backup(self, *args):
+        '''Runs backup.py -e on data/docs to bkup0 with the extra arguments
+           args, returning its exit code and output'''
+        env = dict(os.environ, FAKE_ZFS_STATE = self.zfs_state,
+                   PATH = FAKE_DIR + os.pathsep + os.environ['PATH'])
+        proc = subprocess.Popen([sys.executable, os.path.join(SCRIPTS_DIR, 'backup.py'), '-e',
+                                 '-d', 'bkup0', '--state', self.backup_state] + list(args) + ['data/docs'],
+                                env = env, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+        output = proc.communicate()[0].decode('utf-8', 'replace')
+        return (proc.returncode, output)
+
+    def export_and_snapshot(self):
+        '''Exports bkup0 and adds a snapshot to data/docs'''
+        data = self.read_zfs()
+        data['pools']['bkup0']['exported'] = True
+        data['datasets']['data/docs']['snapshots'].append(
+            {'name': '20240103-0000', 'guid': 12, 'createtxg': 12, 'written': SNAPSHOT_BYTES})
+        self.write_zfs(data)
+
+    def test_imported(self):
+        (returncode, output) = self.backup('--plan')
+        self.assertEqual(returncode, 0, output)
+        self.assertIn('docs@20240101-0000 -> docs@20240102-0000', output)
+
+    def test_not_imported(self):
+        (returncode, output) = self.backup()
+        self.assertEqual(returncode, 0, output)
+        self.export_and_snapshot()
+        (returncode, output) = self.backup('--plan')
+        self.assertEqual(returncode, 0, output)
+        self.assertIn('bkup0 is not imported. Planning from its recorded snapshots', output)
+        self.assertIn('docs@20240102-0000 -> docs@20240103-0000', output)
+        self.assertIn('1.00 MB', output)
+
+    def test_not_imported_unrecorded(self):
+        self.export_and_snapshot()
+        (returncode, output) = self.backup('--plan')
+        self.assertEqual(returncode, 0, output)
+        self.assertIn('has no recorded snapshot of data/docs', output)
+        self.assertIn('unknown', output)
+
+    def test_backup_needs_pool(self):
+        self.export_and_snapshot()
+        output = self.backup()[1]
+        self.assertIn('Destination pools unusable: bkup0 is not imported', output)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+'''Interrupts a backup.py transfer with the fake zfs in scripts/fake and
+   checks that the next run resumes it from the receive resume token
+
+Run with python3 -m unittest discover tests
+'''
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts')
+FAKE_DIR = os.path.join(SCRIPTS_DIR, 'fake')
+SNAPSHOT_BYTES = 1024 * 1024
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix = 'backup-resume-')
+        self.zfs_state = os.path.join(self.tmpdir, 'zfs.json')
+        self.backup_state = os.path.join(self.tmpdir, 'backup.json')
+        snapshots = [{'name': name, 'guid': guid, 'createtxg': guid, 'written': SNAPSHOT_BYTES}
+                     for (name, guid) in [('20240101-0000', 10), ('20240102-0000', 11)]]
+        self.write_zfs({'pools': {'data': {}, 'bkup0': {}},
+                        'datasets': {'data/docs': {'guid': 2, 'createtxg': 2,
+                                                   'snapshots': snapshots},
+                                     'bkup0/docs': {'guid': 3, 'createtxg': 3,
+                                                    'snapshots': [dict(snapshots[0], createtxg = 4)]}},
+                        'next_id': 100})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read_zfs(self):
+        with open(self.zfs_state) as f:
+            return json.load(f)
+
+    def write_zfs(self, data):
+        with open(self.zfs_state, 'w') as f:
+            json.dump(data, f)
+
+    def partial(self):
+        if not os.path.exists(self.backup_state):
+            return {}
+        with open(self.backup_state) as f:
+            return json.load(f)['partial']
+
+    def backup(self, **env):
+        '''Runs backup.py on data/docs to bkup0 with the extra environment
+           variables env, returning its log'''
+        env = dict(os.environ, FAKE_ZFS_STATE = self.zfs_state,
+                   PATH = FAKE_DIR + os.pathsep + os.environ['PATH'], **env)
+        proc = subprocess.Popen([sys.executable, os.path.join(SCRIPTS_DIR, 'backup.py'), '-e',
+                                 '-d', 'bkup0', '--state', self.backup_state, 'data/docs'],
+                                env = env, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+        return proc.communicate()[0].decode('utf-8', 'replace')
+
+    def interrupt(self):
+        self.backup(FAKE_ZFS_INTERRUPT_AFTER = str(SNAPSHOT_BYTES // 2))
+        dest = self.read_zfs()['datasets']['bkup0/docs']
+        self.assertIn('receive_resume_token', dest)
+        self.assertEqual([s['name'] for s in dest['snapshots']], ['20240101-0000'])
+        self.assertIn('bkup0/docs', self.partial())
+
+    def test_resume(self):
+        self.interrupt()
+        log = self.backup()
+        self.assertIn('Resuming interrupted receive on bkup0/docs', log)
+        dest = self.read_zfs()['datasets']['bkup0/docs']
+        self.assertNotIn('receive_resume_token', dest)
+        self.assertEqual([(s['name'], s['guid']) for s in dest['snapshots']],
+                         [('20240101-0000', 10), ('20240102-0000', 11)])
+        self.assertEqual(self.partial(), {})
+
+    def test_failed_estimate_keeps_token(self):
+        self.interrupt()
+        log = self.backup(FAKE_ZFS_FAIL = 'zfs send')
+        self.assertIn('Keeping its resume state', log)
+        self.assertIn('receive_resume_token', self.read_zfs()['datasets']['bkup0/docs'])
+        self.assertIn('bkup0/docs', self.partial())
+
+        self.backup()
+        dest = self.read_zfs()['datasets']['bkup0/docs']
+        self.assertNotIn('receive_resume_token', dest)
+        self.assertEqual(len(dest['snapshots']), 2)
+
+    def test_destroyed_source_aborts(self):
+        self.interrupt()
+        data = self.read_zfs()
+        del data['datasets']['data/docs']['snapshots'][-1]
+        self.write_zfs(data)
+        log = self.backup()
+        self.assertIn('no longer exists', log)
+        dest = self.read_zfs()['datasets']['bkup0/docs']
+        self.assertNotIn('receive_resume_token', dest)
+        self.assertEqual([s['name'] for s in dest['snapshots']], ['20240101-0000'])
+        self.assertEqual(self.partial(), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+'''Checks the snapshots backup.py --retain and --dest-retain keep and the
+   zfs destroy commands they run, the latter against the fake zfs in
+   scripts/fake
+
+Run with python3 -m unittest discover tests
+'''
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts')
+FAKE_DIR = os.path.join(SCRIPTS_DIR, 'fake')
+sys.path.insert(0, SCRIPTS_DIR)
+
+import backup
+
+def snapshots(dataset, names):
+    return [backup.Snapshot('%s@%s' % (dataset, name), n + 1, n + 1) for (n, name) in enumerate(names)]
+
+def kept(names, policy):
+    return sorted(backup.snapshot_suffix(name) for name in
+                  backup.retained_snapshots(snapshots('data/docs', names), policy))
+
+class RetainedTest(unittest.TestCase):
+    def test_daily_boundary(self):
+        names = ['20240101-2359', '20240102-0000', '20240102-2359', '20240103-0000']
+        self.assertEqual(kept(names, {'daily': 2}), ['20240102-2359', '20240103-0000'])
+
+    def test_weekly_boundary(self):
+        # 2024-01-07 is a Sunday, the last day of ISO week 1
+        names = ['20240101-0000', '20240107-2359', '20240108-0000', '20240109-0000']
+        self.assertEqual(kept(names, {'weekly': 2}), ['20240107-2359', '20240109-0000'])
+
+    def test_periods_combine(self):
+        names = ['20231231-1200', '20240101-0000', '20240101-0100', '20240101-0130', '20240101-0200']
+        self.assertEqual(kept(names, {'hourly': 2, 'yearly': 2}),
+                         ['20231231-1200', '20240101-0130', '20240101-0200'])
+
+    def test_newest_and_foreign_kept(self):
+        names = ['20240101-0000', 'manual', '20240102-0000', '20240103-0000']
+        self.assertEqual(kept(names, {}), ['20240103-0000', 'manual'])
+
+    def test_protected(self):
+        snaps = snapshots('data/docs', ['20240101-0000', '20240102-0000', '20240103-0000'])
+        entry = backup.retention_entry('data/docs', snaps, {'daily': 1},
+                                       set(['data/docs@20240101-0000']))
+        self.assertEqual([snap.name for snap in entry.destroy], ['data/docs@20240102-0000'])
+
+class DestroyCommandsTest(unittest.TestCase):
+    def commands(self, names, doomed):
+        snaps = snapshots('data/docs', names)
+        entry = backup.RetentionEntry('data/docs', snaps, [snap for snap in snaps
+                                                           if backup.snapshot_suffix(snap.name) in doomed])
+        return backup.destroy_commands(entry)
+
+    def test_ranges_split_at_kept(self):
+        self.assertEqual(self.commands(['a', 'b', 'c', 'd', 'e', 'f', 'g'], ['a', 'b', 'd', 'f', 'g']),
+                         [['zfs', 'destroy', 'data/docs@a%b,d,f%g']])
+
+    def test_nothing_to_destroy(self):
+        self.assertEqual(self.commands(['a', 'b'], []), [])
+
+    def test_batches(self):
+        names = ['s%04d' % n for n in range(2 * backup.DESTROY_BATCH_SIZE + 1)]
+        # Every other snapshot, so each is a range of its own
+        commands = self.commands(names, names[::2])
+        self.assertEqual(len(commands), 2)
+        self.assertEqual(sum(len(cmd[2].split('@')[1].split(',')) for cmd in commands),
+                         backup.DESTROY_BATCH_SIZE + 1)
+
+class RetentionRunTest(unittest.TestCase):
+    '''Runs backup.py --dry-run with a retention policy, so bkup0 stays
+       behind and its newest common snapshot must survive, then runs the
+       destroy commands it logged'''
+    HOURS = ['20240101-%02d00' % hour for hour in range(6)]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix = 'backup-retention-')
+        self.zfs_state = os.path.join(self.tmpdir, 'zfs.json')
+        self.backup_state = os.path.join(self.tmpdir, 'backup.json')
+        snaps = [{'name': name, 'guid': 10 + n, 'createtxg': 10 + n, 'written': 1024}
+                 for (n, name) in enumerate(self.HOURS)]
+        self.write_json(self.zfs_state,
+                        {'pools': {'data': {}, 'bkup0': {}},
+                         'datasets': {'data/docs': {'guid': 2, 'createtxg': 2, 'snapshots': snaps},
+                                      'bkup0/docs': {'guid': 3, 'createtxg': 3,
+                                                     'snapshots': [dict(snap, createtxg = 30 + n)
+                                                                   for (n, snap) in enumerate(snaps[:3])]}},
+                         'next_id': 100})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_json(self, filename, data):
+        with open(filename, 'w') as f:
+            json.dump(data, f)
+
+    def snapshot_names(self, dataset):
+        with open(self.zfs_state) as f:
+            return [snap['name'] for snap in json.load(f)['datasets'][dataset]['snapshots']]
+
+    def backup(self, *args):
+        '''Runs backup.py --dry-run -e on data/docs to bkup0 with the extra
+           arguments args, then the zfs destroy commands it would have run.
+           Returns its log.'''
+        env = dict(os.environ, FAKE_ZFS_STATE = self.zfs_state,
+                   PATH = FAKE_DIR + os.pathsep + os.environ['PATH'])
+        proc = subprocess.Popen([sys.executable, os.path.join(SCRIPTS_DIR, 'backup.py'), '--dry-run', '-e',
+                                 '-d', 'bkup0', '--state', self.backup_state] + list(args) + ['data/docs'],
+                                env = env, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+        log = proc.communicate()[0].decode('utf-8', 'replace')
+        for line in log.splitlines():
+            (head, sep, cmd) = line.partition('Would execute: ')
+            if cmd.startswith('zfs destroy '):
+                subprocess.check_call(cmd.split(), env = env)
+        return log
+
+    def test_source_keeps_common(self):
+        log = self.backup('--retain', 'hourly=1')
+        self.assertIn('Destroying 4 of 6 snapshots of data/docs', log)
+        self.assertIn('zfs destroy data/docs@%s%%%s,%s%%%s' % tuple(self.HOURS[:2] + self.HOURS[3:5]), log)
+        self.assertEqual(self.snapshot_names('data/docs'), [self.HOURS[2], self.HOURS[5]])
+        self.assertEqual(self.snapshot_names('bkup0/docs'), self.HOURS[:3])
+
+    def test_source_keeps_recorded_common(self):
+        # bkup1 is not being backed up to, but last held the second snapshot
+        self.write_json(self.backup_state, {'common': {'data/docs': {'bkup1': self.HOURS[1]}}})
+        self.backup('--retain', 'hourly=1')
+        self.assertEqual(self.snapshot_names('data/docs'),
+                         [self.HOURS[1], self.HOURS[2], self.HOURS[5]])
+
+    def test_dest_keeps_common(self):
+        # A newer snapshot only bkup0 has, in the same hour as the common one
+        with open(self.zfs_state) as f:
+            data = json.load(f)
+        data['datasets']['bkup0/docs']['snapshots'].append(
+            {'name': '20240101-0230', 'guid': 50, 'createtxg': 50, 'written': 1024})
+        self.write_json(self.zfs_state, data)
+        self.backup('--dest-retain', 'hourly=1')
+        self.assertEqual(self.snapshot_names('bkup0/docs'), [self.HOURS[2], '20240101-0230'])
+        self.assertEqual(self.snapshot_names('data/docs'), self.HOURS)
+
+if __name__ == '__main__':
+    unittest.main()
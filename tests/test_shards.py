@@ -0,0 +1,76 @@
+'''Scans a tree with make_tree_fingerprints.py with and without --shards and
+   checks that both give the same root hash, including when the root has an
+   ignore file that the shard processes do not walk through
+
+make_tree_fingerprints.py needs Python 2; set PYTHON2 to its interpreter
+if it is not python2. Run with python3 -m unittest discover tests
+'''
+
+import os
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import unittest
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts')
+PYTHON2 = os.environ.get('PYTHON2', 'python2')
+
+def have_python2():
+    try:
+        return subprocess.call([PYTHON2, '-c', 'import sys; sys.exit(sys.version_info[0] != 2)'],
+                               stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL) == 0
+    except OSError:
+        return False
+
+@unittest.skipUnless(have_python2(), 'needs Python 2 as %s' % PYTHON2)
+class ShardTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix = 'fingerprint-shards-test-')
+        self.root = os.path.join(self.tmpdir, 'tree')
+        for (path, data) in [('a/f', 'a'), ('a/x/g', 'g'), ('a/x/j.tmp', 'j'),
+                             ('b/h', 'h'), ('b/k.tmp', 'k'), ('c/i', 'i'), ('l', 'l')]:
+            path = os.path.join(self.root, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def scan(self, name, *args):
+        '''Scans the tree into the database name, returning the root hash and
+           the paths that were stored'''
+        db = os.path.join(self.tmpdir, name)
+        subprocess.check_call([PYTHON2, os.path.join(SCRIPTS_DIR, 'make_tree_fingerprints.py'),
+                               '--db', db, '--index', db + '.idx'] + list(args) + [self.root],
+                              stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+        conn = sqlite3.connect(db)
+        try:
+            root_hash = conn.execute('select hash from files where path = ?', (self.root,)).fetchone()[0]
+            paths = set(row[0] for row in conn.execute('select path from files'))
+        finally:
+            conn.close()
+        return root_hash, paths
+
+    def check_same(self):
+        (root_hash, paths) = self.scan('single.db')
+        (sharded_hash, sharded_paths) = self.scan('sharded.db', '--shards', '3')
+        self.assertIsNotNone(root_hash)
+        self.assertEqual(sharded_hash, root_hash)
+        self.assertEqual(sharded_paths, paths)
+        return paths
+
+    def test_same_hash(self):
+        self.check_same()
+
+    def test_root_ignore_file(self):
+        with open(os.path.join(self.root, '.fingerprintignore'), 'w') as f:
+            f.write('*.tmp\na/x/\n')
+        paths = self.check_same()
+        self.assertNotIn(os.path.join(self.root, 'b', 'k.tmp'), paths)
+        self.assertNotIn(os.path.join(self.root, 'a', 'x'), paths)
+
+if __name__ == '__main__':
+    unittest.main()